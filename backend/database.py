@@ -21,3 +21,107 @@ db = client[os.environ.get('DB_NAME')]
 def get_database():
     """Get database instance"""
     return db
+
+async def ensure_replica_set():
+    """
+    Fail fast unless MongoDB supports transactions
+    Order approval, stock movements, payments and lead conversion write in
+    multi-document transactions, which a standalone mongod rejects.
+    """
+    hello = await client.admin.command("hello")
+    if not hello.get("setName") and hello.get("msg") != "isdbgrid":
+        raise RuntimeError(
+            "MongoDB at MONGO_URL is a standalone server; transactions need a replica set. "
+            "Start mongod with --replSet and run rs.initiate() (see README)"
+        )
+
+async def run_transaction(work):
+    """
+    Run `await work(session)` in a multi-document transaction (requires a replica set)
+    and return its result. On a TransientTransactionError, such as a write
+    conflict with a concurrent transaction, the whole of `work` is run again,
+    so in-memory side effects belong after this returns.
+    """
+    async with await client.start_session() as session:
+        return await session.with_transaction(work)
+
+
+async def ensure_indexes():
+    """Create the indexes the routes rely on (idempotent)"""
+    # SKU is the upsert key of the bulk product import
+    await db.products.create_index("sku", unique=True)
+    # Open FIFO cost layers per product, consumed oldest first
+    await db.stock_movements.create_index(
+        [("product_id", 1), ("remaining_quantity", 1), ("date", 1)]
+    )
+    # Commission reporting: sold orders per salesperson and date
+    await db.orders.create_index([("status", 1), ("created_by", 1), ("date", 1)])
+    await db.commission_buckets.create_index(
+        [("period", 1), ("user_id", 1), ("store_id", 1)], unique=True
+    )
+    # Sales rollups, one document per bucket, dimension and key
+    for collection in ["sales_rollups_hourly", "sales_rollups_daily"]:
+        await db[collection].create_index(
+            [("dimension", 1), ("bucket", 1), ("key", 1)], unique=True
+        )
+    # Cost-center and store P&L over posted journal entries
+    await db.journal_entries.create_index([("cost_center_id", 1), ("date", 1)])
+    await db.journal_entries.create_index([("store_id", 1), ("date", 1)])
+    # Ledger queries by account
+    await db.journal_entries.create_index([("account_id", 1), ("date", 1)])
+    # Overdue sweep and aging report
+    await db.invoices.create_index([("status", 1), ("due_date", 1)])
+    # Payments per invoice and remittance lookups by invoice number
+    await db.payments.create_index([("invoice_id", 1), ("date", 1)])
+    # Invoice numbers are fiscal document numbers and must never repeat
+    invoice_number_index = (await db.invoices.index_information()).get("invoice_number_1")
+    if invoice_number_index and not invoice_number_index.get("unique"):
+        await db.invoices.drop_index("invoice_number_1")
+    await db.invoices.create_index("invoice_number", unique=True)
+    # Batch invoicing of approved orders per store and date
+    await db.orders.create_index([("status", 1), ("store_id", 1), ("date", 1)])
+    # Customer 360 overview
+    await db.orders.create_index([("customer_id", 1), ("date", -1)])
+    await db.invoices.create_index([("customer_id", 1), ("date", -1)])
+    # Search: normalized prefix keys and full-text indexes
+    from services.search import PT_COLLATION, TEXT_INDEX_FIELDS
+    for collection, fields in TEXT_INDEX_FIELDS.items():
+        await db[collection].create_index("search_keys")
+        await db[collection].create_index(
+            [(field, "text") for field in fields],
+            name=f"{collection}_text",
+            default_language="portuguese"
+        )
+    # Accent- and case-insensitive contact lookups
+    await db.contacts.create_index("name", name="name_pt", collation=PT_COLLATION)
+    await db.contacts.create_index(
+        [("billing_city", 1), ("name", 1)], name="billing_city_name_pt", collation=PT_COLLATION
+    )
+    # Lead pipeline board: the per-salesperson $match; the top-leads sort runs
+    # inside $facet on a computed rank, which no index can serve
+    await db.leads.create_index([("assigned_to", 1), ("stage", 1)])
+    if "stage_1_priority_1_updated_at_-1" in await db.leads.index_information():
+        await db.leads.drop_index("stage_1_priority_1_updated_at_-1")
+    # Lead forecast buckets
+    await db.lead_forecasts.create_index([("period", 1), ("user_id", 1)], unique=True)
+    # Lead stage history and funnel cohorts
+    await db.lead_stage_events.create_index([("cohort", 1), ("lead_id", 1)])
+    await db.lead_stage_events.create_index([("lead_id", 1), ("date", 1)])
+    await db.lead_funnel_cohorts.create_index("cohort", unique=True)
+    # Lead conversion matches contacts by NIF or email
+    await db.contacts.create_index("nif")
+    await db.contacts.create_index("email", name="email_ci", collation={"locale": "en", "strength": 2})
+    # Lead import deduplication
+    await db.leads.create_index(
+        "dedup_key",
+        unique=True,
+        partialFilterExpression={"dedup_key": {"$exists": True}}
+    )
+    # Job queue: due queued jobs and expired leases
+    await db.jobs.create_index([("status", 1), ("run_at", 1)])
+    await db.jobs.create_index([("status", 1), ("lease_until", 1)])
+    # Outbox: due pending events and expired leases
+    await db.outbox.create_index([("status", 1), ("run_at", 1)])
+    await db.outbox.create_index([("status", 1), ("lease_until", 1)])
+    from services.outbox import DELIVERED_RETENTION_SECONDS
+    await db.outbox.create_index("delivered_at", expireAfterSeconds=DELIVERED_RETENTION_SECONDS)
@@ -33,5 +33,6 @@ class AccountInDB(AccountBase):
 
 class AccountResponse(AccountBase):
     id: str
+    version: int = 0
     created_at: datetime
     updated_at: datetime
\ No newline at end of file
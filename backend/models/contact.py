@@ -84,5 +84,8 @@ class ContactInDB(ContactBase):
 
 class ContactResponse(ContactBase):
     id: str
+    version: int = 0
+    exposure_open_invoices: float = 0  # Saldo de faturas em aberto
+    exposure_uninvoiced_orders: float = 0  # Encomendas aprovadas por faturar
     created_at: datetime
     updated_at: datetime
@@ -29,5 +29,6 @@ class CostCenterInDB(CostCenterBase):
 
 class CostCenterResponse(CostCenterBase):
     id: str
+    version: int = 0
     created_at: datetime
     updated_at: datetime
@@ -20,6 +20,14 @@ class InvoiceBase(BaseModel):
 class InvoiceCreate(InvoiceBase):
     due_date: datetime
 
+class InvoiceBatchCreate(BaseModel):
+    store_id: Optional[str] = None
+    start: Optional[datetime] = None  # Data inicial das encomendas (inclusive)
+    end: Optional[datetime] = None  # Data final das encomendas (exclusive)
+    due_days: int = Field(default=30, ge=0)  # Prazo de pagamento em dias
+    status: InvoiceStatus = InvoiceStatus.draft
+    limit: int = Field(default=1000, gt=0, le=10000)  # Máximo de encomendas por lote
+
 class InvoiceUpdate(BaseModel):
     status: Optional[InvoiceStatus] = None
     paid: Optional[float] = Field(None, ge=0)
@@ -38,6 +46,7 @@ class InvoiceInDB(InvoiceBase):
 
 class InvoiceResponse(InvoiceBase):
     id: str
+    version: int = 0
     invoice_number: str
     date: datetime
     due_date: datetime
@@ -15,6 +15,8 @@ class JournalEntryBase(BaseModel):
     debit: float = Field(ge=0, default=0)
     credit: float = Field(ge=0, default=0)
     status: JournalStatus = JournalStatus.draft
+    cost_center_id: Optional[str] = None
+    store_id: Optional[str] = None
 
 class JournalEntryCreate(JournalEntryBase):
     date: Optional[datetime] = None
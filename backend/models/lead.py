@@ -1,8 +1,10 @@
 from pydantic import BaseModel, Field, EmailStr
-from typing import Optional
+from typing import List, Optional
 from datetime import datetime
 from enum import Enum
 
+from models.order import OrderItem
+
 class LeadStage(str, Enum):
     new = "new"
     qualified = "qualified"
@@ -25,6 +27,7 @@ class LeadBase(BaseModel):
     priority: LeadPriority = LeadPriority.medium
     expected_revenue: float
     probability: int = Field(ge=0, le=100, default=20)
+    expected_close_date: Optional[datetime] = None  # Data prevista de fecho (mês da previsão)
     notes: Optional[str] = None
 
 class LeadCreate(LeadBase):
@@ -39,9 +42,24 @@ class LeadUpdate(BaseModel):
     priority: Optional[LeadPriority] = None
     expected_revenue: Optional[float] = None
     probability: Optional[int] = Field(None, ge=0, le=100)
+    expected_close_date: Optional[datetime] = None
     assigned_to: Optional[str] = None
     notes: Optional[str] = None
 
+class LeadConvert(BaseModel):
+    # Contacto existente procurado por NIF e depois por email
+    nif: Optional[str] = None
+    # Dados para criar o contacto quando não existe
+    type: str = "pessoa_coletiva"
+    billing_address_line1: Optional[str] = None
+    billing_postal_code: Optional[str] = None
+    billing_city: Optional[str] = None
+    billing_country: str = "Portugal"
+    # Encomenda em rascunho
+    items: List[OrderItem] = []
+    store_id: Optional[str] = None
+    cost_center_id: Optional[str] = None
+
 class LeadInDB(LeadBase):
     id: str = Field(alias="_id")
     assigned_to: str
@@ -53,6 +71,7 @@ class LeadInDB(LeadBase):
 
 class LeadResponse(LeadBase):
     id: str
+    version: int = 0
     assigned_to: str
     created_at: datetime
     updated_at: datetime
\ No newline at end of file
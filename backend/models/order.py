@@ -18,7 +18,7 @@ class OrderItem(BaseModel):
     variant_name: Optional[str] = None  # Nome da variante
     price_tier_name: Optional[str] = None  # Nome da faixa de preço (ex: "normal", "site", "promo")
     quantity: int = Field(gt=0)
-    price: float = Field(ge=0)  # Preço unitário aplicado
+    price: Optional[float] = Field(default=None, ge=0)  # Preço unitário aplicado (definido pelo servidor)
     commission_percent: Optional[float] = None  # Percentual de comissão
     commission_value: Optional[float] = None  # Valor da comissão calculado (quantity * price * commission_percent / 100)
 
@@ -47,6 +47,7 @@ class OrderInDB(OrderBase):
     date: datetime
     total: float
     total_commission: Optional[float] = 0  # Comissão total do pedido
+    total_cost: Optional[float] = None  # Custo das mercadorias vendidas (definido na aprovação)
     approved_by: Optional[str] = None
     created_by: str
     created_at: datetime
@@ -57,10 +58,12 @@ class OrderInDB(OrderBase):
 
 class OrderResponse(OrderBase):
     id: str
+    version: int = 0
     order_number: str
     date: datetime
     total: float
     total_commission: Optional[float] = 0
+    total_cost: Optional[float] = None
     approved_by: Optional[str] = None
     created_by: str
     store_id: Optional[str] = None
@@ -0,0 +1,44 @@
+from pydantic import BaseModel, Field
+from typing import List, Optional
+from datetime import datetime
+
+class PaymentBase(BaseModel):
+    amount: float = Field(gt=0)
+    method: str = "transfer"  # 'transfer' | 'cash' | 'card' | 'check' | 'manual'
+    reference: Optional[str] = None  # Referência bancária / do documento
+
+class PaymentCreate(PaymentBase):
+    date: Optional[datetime] = None
+
+class PaymentInDB(PaymentBase):
+    id: str = Field(alias="_id")
+    invoice_id: str
+    invoice_number: str
+    customer_id: str
+    date: datetime
+    created_by: str
+    created_at: datetime
+
+    class Config:
+        populate_by_name = True
+
+class PaymentResponse(PaymentBase):
+    id: str
+    invoice_id: str
+    invoice_number: str
+    customer_id: str
+    date: datetime
+    created_by: str
+    created_at: datetime
+
+# Linha de um ficheiro de remessa bancária
+class RemittanceLine(BaseModel):
+    invoice_number: str
+    amount: float = Field(gt=0)
+    reference: Optional[str] = None
+
+class RemittanceCreate(BaseModel):
+    method: str = "transfer"
+    reference: Optional[str] = None
+    date: Optional[datetime] = None
+    lines: List[RemittanceLine] = Field(min_length=1)
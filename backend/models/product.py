@@ -70,5 +70,7 @@ class ProductInDB(ProductBase):
 
 class ProductResponse(ProductBase):
     id: str
+    version: int = 0
+    avg_cost: Optional[float] = None  # Custo médio ponderado (mantido pelos movimentos de stock)
     created_at: datetime
     updated_at: datetime
\ No newline at end of file
@@ -1,5 +1,6 @@
 from pydantic import BaseModel, Field
 from datetime import datetime
+from typing import Optional
 from enum import Enum
 
 class MovementType(str, Enum):
@@ -13,6 +14,7 @@ class StockMovementBase(BaseModel):
     quantity: int = Field(gt=0)
     reference: str  # PO-XXX or SO-XXX
     location: str = "Main Warehouse"
+    unit_cost: Optional[float] = Field(default=None, ge=0)  # Custo unitário (entradas: custo de compra)
 
 class StockMovementCreate(StockMovementBase):
     pass
@@ -28,6 +30,8 @@ class StockMovementInDB(StockMovementBase):
 
 class StockMovementResponse(StockMovementBase):
     id: str
+    total_cost: Optional[float] = None
+    remaining_quantity: Optional[int] = None  # Quantidade ainda por consumir na camada FIFO
     date: datetime
     created_by: str
     created_at: datetime
\ No newline at end of file
@@ -35,5 +35,6 @@ class StoreInDB(StoreBase):
 
 class StoreResponse(StoreBase):
     id: str
+    version: int = 0
     created_at: datetime
     updated_at: datetime
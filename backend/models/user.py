@@ -41,6 +41,7 @@ class UserInDB(UserBase):
 
 class UserResponse(UserBase):
     id: str
+    version: int = 0
     avatar: str
     store_id: Optional[str] = None
     is_active: bool = True
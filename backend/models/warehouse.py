@@ -27,5 +27,6 @@ class WarehouseInDB(WarehouseBase):
 
 class WarehouseResponse(WarehouseBase):
     id: str
+    version: int = 0
     created_at: datetime
     updated_at: datetime
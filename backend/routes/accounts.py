@@ -1,12 +1,15 @@
-from fastapi import APIRouter, HTTPException, status, Depends
-from typing import List
+from fastapi import APIRouter, HTTPException, status, Depends, Request, Response, Header
+from typing import List, Optional
 
 from datetime import datetime
 from bson import ObjectId
+from pymongo import ReturnDocument
 
 from models.account import AccountCreate, AccountUpdate, AccountResponse
 from models.journal_entry import JournalEntryCreate, JournalEntryResponse
 from auth.dependencies import get_current_user, require_roles
+from services.ledger import post_entries, invalidate_chart
+from services.concurrency import VERSION_BUMP, etag, version_filter, not_modified, raise_conflict_or_missing
 
 router = APIRouter(prefix="/accounts", tags=["Accounting"])
 
@@ -22,6 +25,7 @@ async def get_accounts(current_user: dict = Depends(require_roles(["admin", "man
     return [
         {
             "id": str(account["_id"]),
+            "version": account.get("version", 0),
             "code": account["code"],
             "name": account["name"],
             "type": account["type"],
@@ -33,7 +37,7 @@ async def get_accounts(current_user: dict = Depends(require_roles(["admin", "man
     ]
 
 @router.get("/{account_id}", response_model=AccountResponse)
-async def get_account(account_id: str, current_user: dict = Depends(require_roles(["admin", "manager"]))):
+async def get_account(account_id: str, request: Request, response: Response, current_user: dict = Depends(require_roles(["admin", "manager"]))):
     """
     Get account by ID
     """
@@ -41,8 +45,14 @@ async def get_account(account_id: str, current_user: dict = Depends(require_role
     if not account:
         raise HTTPException(status_code=404, detail="Account not found")
     
+    cached = not_modified(request, account)
+    if cached:
+        return cached
+    response.headers["ETag"] = etag(account)
+    
     return {
         "id": str(account["_id"]),
+        "version": account.get("version", 0),
         "code": account["code"],
         "name": account["name"],
         "type": account["type"],
@@ -69,6 +79,7 @@ async def create_account(
     account_dict["updated_at"] = datetime.utcnow()
     
     result = await db.accounts.insert_one(account_dict)
+    await invalidate_chart()
     
     return {
         "message": "Account created successfully",
@@ -79,6 +90,8 @@ async def create_account(
 async def update_account(
     account_id: str,
     account_data: AccountUpdate,
+    response: Response,
+    if_match: Optional[str] = Header(None),
     current_user: dict = Depends(require_roles(["admin"]))
 ):
     """
@@ -90,13 +103,17 @@ async def update_account(
     
     update_dict["updated_at"] = datetime.utcnow()
     
-    result = await db.accounts.update_one(
-        {"_id": ObjectId(account_id)},
-        {"$set": update_dict}
+    updated = await db.accounts.find_one_and_update(
+        {"_id": ObjectId(account_id), **version_filter(if_match)},
+        {"$set": update_dict, "$inc": VERSION_BUMP},
+        projection={"version": 1},
+        return_document=ReturnDocument.AFTER
     )
     
-    if result.matched_count == 0:
-        raise HTTPException(status_code=404, detail="Account not found")
+    if not updated:
+        await raise_conflict_or_missing("accounts", {"_id": ObjectId(account_id)}, "Account")
+    response.headers["ETag"] = etag(updated)
+    await invalidate_chart()
     
     return {"message": "Account updated successfully"}
 
@@ -118,6 +135,8 @@ async def get_journal_entries(current_user: dict = Depends(require_roles(["admin
             "debit": entry["debit"],
             "credit": entry["credit"],
             "status": entry["status"],
+            "cost_center_id": entry.get("cost_center_id"),
+            "store_id": entry.get("store_id"),
             "created_by": entry["created_by"],
             "created_at": entry["created_at"]
         }
@@ -138,9 +157,9 @@ async def create_journal_entry(
     entry_dict["created_by"] = str(current_user["_id"])
     entry_dict["created_at"] = datetime.utcnow()
     
-    result = await db.journal_entries.insert_one(entry_dict)
+    await post_entries([entry_dict])
     
     return {
         "message": "Journal entry created successfully",
-        "entry_id": str(result.inserted_id)
+        "entry_id": str(entry_dict["_id"])
     }
\ No newline at end of file
@@ -1,10 +1,17 @@
-from fastapi import APIRouter, HTTPException, status, Depends, Query
+from fastapi import APIRouter, HTTPException, status, Depends, Query, Request, Response, Header
 from typing import List, Optional
 from datetime import datetime
 from bson import ObjectId
+from pymongo import ReturnDocument
 
 from models.contact import ContactCreate, ContactUpdate, ContactResponse
 from auth.dependencies import get_current_user, require_roles
+from services.credit import OPEN_INVOICES, UNINVOICED_ORDERS
+from services.jobs import enqueue
+from services import customer_overview
+from services.search import PT_COLLATION, normalize, search_keys, refresh_search_keys
+from services.concurrency import VERSION_BUMP, etag, version_filter, not_modified, raise_conflict_or_missing
+import re
 
 router = APIRouter(prefix="/contacts", tags=["Contacts"])
 
@@ -14,10 +21,15 @@ from database import db
 async def get_contacts(
     is_customer: Optional[bool] = Query(None),
     is_supplier: Optional[bool] = Query(None),
+    name: Optional[str] = Query(None, description="Exact name, ignoring case and accents"),
+    city: Optional[str] = Query(None, description="Billing city, ignoring case and accents"),
+    q: Optional[str] = Query(None, description="Prefix of name, trade name, NIF or email"),
     current_user: dict = Depends(get_current_user)
 ):
     """
     Get all contacts with optional filters
+    Name and city filters use the Portuguese collation indexes, so
+    "conceicao" finds "Conceição".
     """
     query = {}
     
@@ -27,11 +39,24 @@ async def get_contacts(
     if is_supplier is not None:
         query["is_supplier"] = is_supplier
     
-    contacts = await db.contacts.find(query).to_list(1000)
+    if name:
+        query["name"] = name
+    
+    if city:
+        query["billing_city"] = city
+    
+    if q:
+        query["search_keys"] = {"$regex": f"^{re.escape(normalize(q))}"}
+    
+    cursor = db.contacts.find(query)
+    if name or city:
+        cursor = cursor.collation(PT_COLLATION).sort("name", 1)
+    contacts = await cursor.to_list(1000)
     
     return [
         {
             "id": str(contact["_id"]),
+            "version": contact.get("version", 0),
             "is_customer": contact["is_customer"],
             "is_supplier": contact["is_supplier"],
             "type": contact["type"],
@@ -54,6 +79,8 @@ async def get_contacts(
             "customer_type": contact.get("customer_type"),
             "payment_terms": contact.get("payment_terms"),
             "credit_limit": contact.get("credit_limit"),
+            "exposure_open_invoices": contact.get(OPEN_INVOICES, 0),
+            "exposure_uninvoiced_orders": contact.get(UNINVOICED_ORDERS, 0),
             "supplier_type": contact.get("supplier_type"),
             "iban": contact.get("iban"),
             "bank_name": contact.get("bank_name"),
@@ -69,6 +96,8 @@ async def get_contacts(
 @router.get("/{contact_id}", response_model=ContactResponse)
 async def get_contact(
     contact_id: str,
+    request: Request,
+    response: Response,
     current_user: dict = Depends(get_current_user)
 ):
     """
@@ -78,8 +107,14 @@ async def get_contact(
     if not contact:
         raise HTTPException(status_code=404, detail="Contact not found")
     
+    cached = not_modified(request, contact)
+    if cached:
+        return cached
+    response.headers["ETag"] = etag(contact)
+    
     return {
         "id": str(contact["_id"]),
+        "version": contact.get("version", 0),
         "is_customer": contact["is_customer"],
         "is_supplier": contact["is_supplier"],
         "type": contact["type"],
@@ -102,6 +137,8 @@ async def get_contact(
         "customer_type": contact.get("customer_type"),
         "payment_terms": contact.get("payment_terms"),
         "credit_limit": contact.get("credit_limit"),
+        "exposure_open_invoices": contact.get(OPEN_INVOICES, 0),
+        "exposure_uninvoiced_orders": contact.get(UNINVOICED_ORDERS, 0),
         "supplier_type": contact.get("supplier_type"),
         "iban": contact.get("iban"),
         "bank_name": contact.get("bank_name"),
@@ -112,6 +149,20 @@ async def get_contact(
         "updated_at": contact["updated_at"]
     }
 
+@router.get("/{contact_id}/overview")
+async def get_contact_overview(
+    contact_id: str,
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Customer 360: recent orders and invoices, open balance and lifetime value
+    """
+    overview = await customer_overview.customer_overview(contact_id)
+    if not overview:
+        raise HTTPException(status_code=404, detail="Contact not found")
+    
+    return overview
+
 @router.post("", status_code=status.HTTP_201_CREATED)
 async def create_contact(
     contact_data: ContactCreate,
@@ -129,6 +180,7 @@ async def create_contact(
         )
     
     contact_dict = contact_data.dict()
+    contact_dict["search_keys"] = search_keys("contacts", contact_dict)
     contact_dict["created_at"] = datetime.utcnow()
     contact_dict["updated_at"] = datetime.utcnow()
     
@@ -139,10 +191,20 @@ async def create_contact(
         "contact_id": str(result.inserted_id)
     }
 
+@router.post("/exposure/rebuild", status_code=status.HTTP_202_ACCEPTED)
+async def rebuild_credit_exposure(current_user: dict = Depends(require_roles(["admin"]))):
+    """
+    Queue recomputing every customer's credit exposure from invoices and orders (Admin only)
+    """
+    job_id = await enqueue("exposure.rebuild", {}, str(current_user["_id"]))
+    return {"message": "Credit exposure rebuild queued", "job_id": str(job_id)}
+
 @router.put("/{contact_id}")
 async def update_contact(
     contact_id: str,
     contact_data: ContactUpdate,
+    response: Response,
+    if_match: Optional[str] = Header(None),
     current_user: dict = Depends(require_roles(["admin", "manager"]))
 ):
     """
@@ -154,13 +216,19 @@ async def update_contact(
     
     update_data["updated_at"] = datetime.utcnow()
     
-    result = await db.contacts.update_one(
-        {"_id": ObjectId(contact_id)},
-        {"$set": update_data}
+    updated = await db.contacts.find_one_and_update(
+        {"_id": ObjectId(contact_id), **version_filter(if_match)},
+        {"$set": update_data, "$inc": VERSION_BUMP},
+        projection={"version": 1},
+        return_document=ReturnDocument.AFTER
     )
     
-    if result.matched_count == 0:
-        raise HTTPException(status_code=404, detail="Contact not found")
+    if not updated:
+        await raise_conflict_or_missing("contacts", {"_id": ObjectId(contact_id)}, "Contact")
+    response.headers["ETag"] = etag(updated)
+    await customer_overview.invalidate(contact_id)
+    if {"name", "trade_name", "nif", "email"} & update_data.keys():
+        await refresh_search_keys("contacts", ObjectId(contact_id))
     
     return {"message": "Contact updated successfully"}
 
@@ -174,10 +242,11 @@ async def delete_contact(
     """
     result = await db.contacts.update_one(
         {"_id": ObjectId(contact_id)},
-        {"$set": {"status": "inactive", "updated_at": datetime.utcnow()}}
+        {"$set": {"status": "inactive", "updated_at": datetime.utcnow()}, "$inc": VERSION_BUMP}
     )
     
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Contact not found")
+    await customer_overview.invalidate(contact_id)
     
     return {"message": "Contact marked as inactive"}
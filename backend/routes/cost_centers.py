@@ -1,10 +1,15 @@
-from fastapi import APIRouter, HTTPException, status, Depends, Query
+from fastapi import APIRouter, HTTPException, status, Depends, Query, Request, Response, Header
 from typing import List, Optional
 from datetime import datetime
 from bson import ObjectId
+from pymongo import ReturnDocument
 
 from models.cost_center import CostCenterCreate, CostCenterUpdate, CostCenterResponse
 from auth.dependencies import get_current_user, require_roles
+from services.ledger import cost_center_pnl, store_pnl_rollup, period_key
+from services.concurrency import VERSION_BUMP, etag, version_filter, not_modified, raise_conflict_or_missing
+from services import change_tokens
+from services import reference_data
 
 router = APIRouter(prefix="/cost-centers", tags=["Cost Centers"])
 
@@ -12,21 +17,26 @@ from database import db
 
 @router.get("", response_model=List[CostCenterResponse])
 async def get_cost_centers(
+    request: Request,
+    response: Response,
     type: Optional[str] = Query(None),
     current_user: dict = Depends(get_current_user)
 ):
     """
     Get all cost centers with optional type filter
     """
-    query = {}
-    if type:
-        query["type"] = type
+    cached = await change_tokens.conditional(request, response, "cost_centers")
+    if cached:
+        return cached
     
-    cost_centers = await db.cost_centers.find(query).to_list(1000)
+    cost_centers = await reference_data.get_all("cost_centers")
+    if type:
+        cost_centers = [cc for cc in cost_centers if cc["type"] == type]
     
     return [
         {
             "id": str(cc["_id"]),
+            "version": cc.get("version", 0),
             "code": cc["code"],
             "name": cc["name"],
             "type": cc["type"],
@@ -38,20 +48,71 @@ async def get_cost_centers(
         for cc in cost_centers
     ]
 
+@router.get("/pnl/stores")
+async def get_store_pnl_rollup(
+    period: Optional[str] = Query(None, pattern=r"^\d{4}-\d{2}$", description="Month (YYYY-MM), defaults to current"),
+    current_user: dict = Depends(require_roles(["admin", "manager"]))
+):
+    """
+    P&L of every store for a month (Admin and Manager only)
+    """
+    period = period or period_key(datetime.utcnow())
+    rollup = await store_pnl_rollup(period)
+    
+    stores = {store_id: await reference_data.get("stores", store_id) for store_id in {s["store_id"] for s in rollup}}
+    
+    return [
+        {
+            **summary,
+            "store_code": (stores[summary["store_id"]] or {}).get("code"),
+            "store_name": (stores[summary["store_id"]] or {}).get("name")
+        }
+        for summary in rollup
+    ]
+
+@router.get("/{cost_center_id}/pnl")
+async def get_cost_center_pnl(
+    cost_center_id: str,
+    period: Optional[str] = Query(None, pattern=r"^\d{4}-\d{2}$", description="Month (YYYY-MM), defaults to current"),
+    current_user: dict = Depends(require_roles(["admin", "manager"]))
+):
+    """
+    Revenue, expenses and net income of a cost center for a month (Admin and Manager only)
+    """
+    cost_center = await reference_data.get("cost_centers", cost_center_id)
+    if not cost_center:
+        raise HTTPException(status_code=404, detail="Cost center not found")
+    
+    summary = await cost_center_pnl(cost_center_id, period or period_key(datetime.utcnow()))
+    
+    return {
+        **summary,
+        "cost_center_code": cost_center["code"],
+        "cost_center_name": cost_center["name"]
+    }
+
 @router.get("/{cost_center_id}", response_model=CostCenterResponse)
 async def get_cost_center(
     cost_center_id: str,
+    request: Request,
+    response: Response,
     current_user: dict = Depends(get_current_user)
 ):
     """
     Get cost center by ID
     """
-    cost_center = await db.cost_centers.find_one({"_id": ObjectId(cost_center_id)})
+    cost_center = await reference_data.get("cost_centers", cost_center_id)
     if not cost_center:
         raise HTTPException(status_code=404, detail="Cost center not found")
     
+    cached = not_modified(request, cost_center)
+    if cached:
+        return cached
+    response.headers["ETag"] = etag(cost_center)
+    
     return {
         "id": str(cost_center["_id"]),
+        "version": cost_center.get("version", 0),
         "code": cost_center["code"],
         "name": cost_center["name"],
         "type": cost_center["type"],
@@ -70,7 +131,7 @@ async def create_cost_center(
     Create a new cost center
     """
     # Check if code already exists
-    existing_cc = await db.cost_centers.find_one({"code": cost_center_data.code})
+    existing_cc = await reference_data.find_by("cost_centers", "code", cost_center_data.code)
     if existing_cc:
         raise HTTPException(
             status_code=400,
@@ -82,6 +143,7 @@ async def create_cost_center(
     cost_center_dict["updated_at"] = datetime.utcnow()
     
     result = await db.cost_centers.insert_one(cost_center_dict)
+    await change_tokens.bump("cost_centers")
     
     return {
         "message": "Cost center created successfully",
@@ -92,6 +154,8 @@ async def create_cost_center(
 async def update_cost_center(
     cost_center_id: str,
     cost_center_data: CostCenterUpdate,
+    response: Response,
+    if_match: Optional[str] = Header(None),
     current_user: dict = Depends(require_roles(["admin", "manager"]))
 ):
     """
@@ -103,13 +167,17 @@ async def update_cost_center(
     
     update_data["updated_at"] = datetime.utcnow()
     
-    result = await db.cost_centers.update_one(
-        {"_id": ObjectId(cost_center_id)},
-        {"$set": update_data}
+    updated = await db.cost_centers.find_one_and_update(
+        {"_id": ObjectId(cost_center_id), **version_filter(if_match)},
+        {"$set": update_data, "$inc": VERSION_BUMP},
+        projection={"version": 1},
+        return_document=ReturnDocument.AFTER
     )
     
-    if result.matched_count == 0:
-        raise HTTPException(status_code=404, detail="Cost center not found")
+    if not updated:
+        await raise_conflict_or_missing("cost_centers", {"_id": ObjectId(cost_center_id)}, "Cost center")
+    await change_tokens.bump("cost_centers")
+    response.headers["ETag"] = etag(updated)
     
     return {"message": "Cost center updated successfully"}
 
@@ -123,10 +191,11 @@ async def delete_cost_center(
     """
     result = await db.cost_centers.update_one(
         {"_id": ObjectId(cost_center_id)},
-        {"$set": {"status": "inactive", "updated_at": datetime.utcnow()}}
+        {"$set": {"status": "inactive", "updated_at": datetime.utcnow()}, "$inc": VERSION_BUMP}
     )
     
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Cost center not found")
+    await change_tokens.bump("cost_centers")
     
     return {"message": "Cost center marked as inactive"}
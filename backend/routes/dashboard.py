@@ -2,6 +2,7 @@ from fastapi import APIRouter, Depends
 
 
 from auth.dependencies import get_current_user
+from services.inventory import current_unit_cost
 
 router = APIRouter(prefix="/dashboard", tags=["Dashboard"])
 
@@ -18,10 +19,10 @@ async def get_dashboard_stats(current_user: dict = Depends(get_current_user)):
     active_leads = await db.leads.count_documents({"stage": {"$nin": ["won", "lost"]}})
     won_leads = await db.leads.count_documents({"stage": "won"})
     
-    leads_cursor = db.leads.find({})
-    expected_revenue = 0
-    async for lead in leads_cursor:
-        expected_revenue += lead.get("expected_revenue", 0)
+    revenue_rows = await db.leads.aggregate([
+        {"$group": {"_id": None, "expected_revenue": {"$sum": "$expected_revenue"}}}
+    ]).to_list(1)
+    expected_revenue = revenue_rows[0]["expected_revenue"] if revenue_rows else 0
     
     conversion_rate = (won_leads / total_leads * 100) if total_leads > 0 else 0
     
@@ -45,7 +46,7 @@ async def get_dashboard_stats(current_user: dict = Depends(get_current_user)):
     total_value = 0
     reorder_needed = []
     async for product in products_cursor:
-        total_value += product.get("stock", 0) * product.get("cost", 0)
+        total_value += (product.get("stock") or 0) * current_unit_cost(product)
         if product.get("stock", 0) < product.get("reorder_level", 0):
             reorder_needed.append(product.get("sku", ""))
     
@@ -1,26 +1,40 @@
-from fastapi import APIRouter, HTTPException, status, Depends
-from typing import List
+from fastapi import APIRouter, HTTPException, status, Depends, Request, Response, Header
+from typing import List, Optional
 
 from datetime import datetime, timedelta
 from bson import ObjectId
 
-from models.invoice import InvoiceCreate, InvoiceUpdate, InvoiceResponse
+from models.invoice import InvoiceCreate, InvoiceUpdate, InvoiceResponse, InvoiceBatchCreate
+from models.payment import PaymentCreate, PaymentResponse, RemittanceCreate
 from auth.dependencies import get_current_user, require_roles
+from pymongo import UpdateOne
+from services.sequences import allocate
+from services.credit import adjust_exposure
+from services import customer_overview
+from services.receivables import aging_report
+from services.payments import apply_payments, payment_error, BALANCE_TOLERANCE
+from services.concurrency import VERSION_BUMP, etag, version_filter, not_modified, check_version, raise_conflict_or_missing
 
 router = APIRouter(prefix="/invoices", tags=["Sales"])
 
 # Get database
-from database import db
+from database import db, run_transaction
 
-async def generate_invoice_number():
-    """Generate next invoice number"""
+async def last_invoice_number() -> int:
+    """Number of the most recent invoice, used to start the invoice counter"""
     last_invoice = await db.invoices.find_one(sort=[("created_at", -1)])
     if last_invoice and "invoice_number" in last_invoice:
-        num = int(last_invoice["invoice_number"].split("-")[1]) + 1
-    else:
-        num = 1
+        return int(last_invoice["invoice_number"].split("-")[1])
+    return 0
+
+def format_invoice_number(num: int) -> str:
     return f"INV-{num:03d}"
 
+async def generate_invoice_number():
+    """Generate next invoice number"""
+    num = await allocate("invoice_number", 1, last_invoice_number)
+    return format_invoice_number(num)
+
 @router.get("", response_model=List[InvoiceResponse])
 async def get_invoices(current_user: dict = Depends(get_current_user)):
     """
@@ -30,6 +44,7 @@ async def get_invoices(current_user: dict = Depends(get_current_user)):
     return [
         {
             "id": str(invoice["_id"]),
+            "version": invoice.get("version", 0),
             "invoice_number": invoice["invoice_number"],
             "order_id": invoice["order_id"],
             "customer_id": invoice["customer_id"],
@@ -46,8 +61,15 @@ async def get_invoices(current_user: dict = Depends(get_current_user)):
         for invoice in invoices
     ]
 
+@router.get("/aging")
+async def get_aging_report(current_user: dict = Depends(require_roles(["admin", "manager"]))):
+    """
+    Accounts receivable aging (0-30/31-60/61-90/90+ days past due) per customer
+    """
+    return await aging_report()
+
 @router.get("/{invoice_id}", response_model=InvoiceResponse)
-async def get_invoice(invoice_id: str, current_user: dict = Depends(get_current_user)):
+async def get_invoice(invoice_id: str, request: Request, response: Response, current_user: dict = Depends(get_current_user)):
     """
     Get invoice by ID
     """
@@ -55,8 +77,14 @@ async def get_invoice(invoice_id: str, current_user: dict = Depends(get_current_
     if not invoice:
         raise HTTPException(status_code=404, detail="Invoice not found")
     
+    cached = not_modified(request, invoice)
+    if cached:
+        return cached
+    response.headers["ETag"] = etag(invoice)
+    
     return {
         "id": str(invoice["_id"]),
+        "version": invoice.get("version", 0),
         "invoice_number": invoice["invoice_number"],
         "order_id": invoice["order_id"],
         "customer_id": invoice["customer_id"],
@@ -96,68 +124,284 @@ async def create_invoice(
     # Update order status to invoiced
     await db.orders.update_one(
         {"_id": ObjectId(invoice_data.order_id)},
-        {"$set": {"status": "invoiced", "updated_at": datetime.utcnow()}}
+        {"$set": {"status": "invoiced", "updated_at": datetime.utcnow()}, "$inc": VERSION_BUMP}
     )
     
+    # Move the order's credit exposure from uninvoiced orders to open invoices
+    deltas = {invoice_dict["customer_id"]: (invoice_dict["balance"], 0)}
+    if order["status"] == "approved":
+        open_delta, _ = deltas.get(order["customer_id"], (0, 0))
+        deltas[order["customer_id"]] = (open_delta, -order["total"])
+    await adjust_exposure(deltas)
+    await customer_overview.invalidate(*deltas)
+    
     return {
         "message": "Invoice created successfully",
         "invoice_id": str(result.inserted_id),
         "invoice_number": invoice_dict["invoice_number"]
     }
 
+@router.post("/generate-batch", status_code=status.HTTP_201_CREATED)
+async def generate_invoice_batch(
+    batch_data: InvoiceBatchCreate,
+    current_user: dict = Depends(require_roles(["admin", "manager"]))
+):
+    """
+    Invoice every approved order matching a store and date filter (Admin and Manager only)
+    Invoice numbers are allocated as one contiguous block in the same
+    transaction that inserts the invoices and flips the orders to
+    'invoiced', so a failed batch leaves no gap in the numbering.
+    """
+    query = {"status": "approved"}
+    if batch_data.store_id:
+        query["store_id"] = batch_data.store_id
+    if batch_data.start or batch_data.end:
+        query["date"] = {}
+        if batch_data.start:
+            query["date"]["$gte"] = batch_data.start
+        if batch_data.end:
+            query["date"]["$lt"] = batch_data.end
+    
+    orders = await db.orders.find(
+        query,
+        {"customer_id": 1, "customer_name": 1, "total": 1}
+    ).sort("date", 1).to_list(batch_data.limit)
+    if not orders:
+        return {"message": "No approved orders to invoice", "count": 0}
+    
+    now = datetime.utcnow()
+    due_date = now + timedelta(days=batch_data.due_days)
+    
+    # Move credit exposure from uninvoiced orders to open invoices
+    deltas = {}
+    for order in orders:
+        open_delta, uninvoiced_delta = deltas.get(order["customer_id"], (0, 0))
+        deltas[order["customer_id"]] = (open_delta + order["total"], uninvoiced_delta - order["total"])
+    
+    async def record(session):
+        first = await allocate("invoice_number", len(orders), last_invoice_number, session=session)
+        invoices = [
+            {
+                "order_id": str(order["_id"]),
+                "customer_id": order["customer_id"],
+                "customer_name": order["customer_name"],
+                "total": order["total"],
+                "paid": 0,
+                "status": batch_data.status,
+                "invoice_number": format_invoice_number(first + i),
+                "date": now,
+                "due_date": due_date,
+                "balance": order["total"],
+                "created_at": now,
+                "updated_at": now
+            }
+            for i, order in enumerate(orders)
+        ]
+        await db.invoices.insert_many(invoices, session=session)
+        result = await db.orders.bulk_write(
+            [
+                UpdateOne(
+                    {"_id": order["_id"], "status": "approved"},
+                    {"$set": {"status": "invoiced", "updated_at": now}, "$inc": VERSION_BUMP}
+                )
+                for order in orders
+            ],
+            ordered=False,
+            session=session
+        )
+        if result.modified_count != len(orders):
+            raise ValueError("Some orders were invoiced concurrently; nothing was created")
+        await adjust_exposure(deltas, session=session)
+        return invoices
+    
+    try:
+        invoices = await run_transaction(record)
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    await customer_overview.invalidate(*deltas)
+    
+    return {
+        "message": "Invoices created successfully",
+        "count": len(invoices),
+        "first_invoice_number": invoices[0]["invoice_number"],
+        "last_invoice_number": invoices[-1]["invoice_number"]
+    }
+
 @router.put("/{invoice_id}/status")
 async def update_invoice_status(
     invoice_id: str,
     update_data: InvoiceUpdate,
+    response: Response,
+    if_match: Optional[str] = Header(None),
     current_user: dict = Depends(require_roles(["admin", "manager"]))
 ):
     """
     Update invoice status and payment
+    Raising `paid` or marking the invoice as paid records a payment for the
+    difference, so balances and journal entries stay consistent.
     """
     invoice = await db.invoices.find_one({"_id": ObjectId(invoice_id)})
     if not invoice:
         raise HTTPException(status_code=404, detail="Invoice not found")
+    # Fail fast on a stale If-Match; the writes below re-check it atomically
+    check_version(invoice, if_match, "Invoice")
+    guard = version_filter(if_match)
     
     update_dict = {k: v for k, v in update_data.dict(exclude_unset=True).items()}
     
-    # Calculate balance
-    paid = update_dict.get("paid", invoice["paid"])
-    update_dict["balance"] = invoice["total"] - paid
-    update_dict["updated_at"] = datetime.utcnow()
+    amount = 0
+    paid = update_dict.pop("paid", None)
+    if paid is not None:
+        if paid < invoice["paid"]:
+            raise HTTPException(status_code=400, detail="Paid amount cannot be lowered")
+        amount = round(paid - invoice["paid"], 2)
     
-    # If marked as paid, create journal entry
     if update_dict.get("status") == "paid" and invoice["status"] != "paid":
-        journal_entries = [
-            {
-                "date": datetime.utcnow(),
-                "reference": invoice["invoice_number"],
-                "description": f"Payment received from {invoice['customer_name']}",
-                "account_id": "cash_account",
-                "account_name": "Cash",
-                "debit": invoice["total"],
-                "credit": 0,
-                "status": "posted",
-                "created_by": str(current_user["_id"]),
-                "created_at": datetime.utcnow()
-            },
-            {
-                "date": datetime.utcnow(),
-                "reference": invoice["invoice_number"],
-                "description": f"Payment received from {invoice['customer_name']}",
-                "account_id": "ar_account",
-                "account_name": "Accounts Receivable",
-                "debit": 0,
-                "credit": invoice["total"],
-                "status": "posted",
-                "created_by": str(current_user["_id"]),
-                "created_at": datetime.utcnow()
-            }
-        ]
-        await db.journal_entries.insert_many(journal_entries)
+        if invoice["balance"] > BALANCE_TOLERANCE:
+            # Marking as paid settles whatever balance is left
+            amount = max(amount, invoice["balance"])
+            update_dict.pop("status")
+        else:
+            # Nothing left to settle, so no payment will flip the status
+            update_dict["balance"] = 0
     
-    result = await db.invoices.update_one(
-        {"_id": ObjectId(invoice_id)},
-        {"$set": update_dict}
-    )
+    if amount > 0:
+        error = payment_error(invoice, amount)
+        if error:
+            raise HTTPException(status_code=400, detail=error)
+        # Any other fields are written in the same guarded update as the payment
+        try:
+            await apply_payments(
+                [{"invoice": invoice, "amount": amount, "guard": guard, "set": update_dict}],
+                str(current_user["_id"]),
+                method="manual"
+            )
+        except ValueError as e:
+            raise HTTPException(status_code=409, detail=str(e))
+    elif update_dict:
+        update_dict["updated_at"] = datetime.utcnow()
+        result = await db.invoices.update_one(
+            {"_id": ObjectId(invoice_id), **guard},
+            {"$set": update_dict, "$inc": VERSION_BUMP}
+        )
+        if not result.matched_count:
+            await raise_conflict_or_missing("invoices", {"_id": ObjectId(invoice_id)}, "Invoice")
+        await customer_overview.invalidate(invoice["customer_id"])
     
-    return {"message": "Invoice updated successfully"}
\ No newline at end of file
+    updated = await db.invoices.find_one({"_id": ObjectId(invoice_id)}, {"version": 1})
+    response.headers["ETag"] = etag(updated)
+    
+    return {"message": "Invoice updated successfully"}
+
+@router.get("/{invoice_id}/payments", response_model=List[PaymentResponse])
+async def get_invoice_payments(invoice_id: str, current_user: dict = Depends(get_current_user)):
+    """
+    Get payments applied to an invoice
+    """
+    payments = await db.payments.find({"invoice_id": invoice_id}).sort("date", 1).to_list(1000)
+    return [
+        {
+            "id": str(payment["_id"]),
+            "invoice_id": payment["invoice_id"],
+            "invoice_number": payment["invoice_number"],
+            "customer_id": payment["customer_id"],
+            "amount": payment["amount"],
+            "method": payment["method"],
+            "reference": payment.get("reference"),
+            "date": payment["date"],
+            "created_by": payment["created_by"],
+            "created_at": payment["created_at"]
+        }
+        for payment in payments
+    ]
+
+@router.post("/{invoice_id}/payments", status_code=status.HTTP_201_CREATED)
+async def create_invoice_payment(
+    invoice_id: str,
+    payment_data: PaymentCreate,
+    current_user: dict = Depends(require_roles(["admin", "manager"]))
+):
+    """
+    Record a (partial) payment against an invoice
+    """
+    invoice = await db.invoices.find_one({"_id": ObjectId(invoice_id)})
+    if not invoice:
+        raise HTTPException(status_code=404, detail="Invoice not found")
+    
+    amount = round(payment_data.amount, 2)
+    error = payment_error(invoice, amount)
+    if error:
+        raise HTTPException(status_code=400, detail=error)
+    
+    try:
+        payments = await apply_payments(
+            [{"invoice": invoice, "amount": amount}],
+            str(current_user["_id"]),
+            method=payment_data.method,
+            reference=payment_data.reference,
+            date=payment_data.date
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    
+    balance = max(round(invoice["balance"] - amount, 2), 0)
+    return {
+        "message": "Payment recorded successfully",
+        "payment_id": str(payments[0]["_id"]),
+        "paid": round(invoice["paid"] + amount, 2),
+        "balance": balance,
+        "status": "paid" if balance == 0 else invoice["status"]
+    }
+
+@router.post("/payments/bulk")
+async def apply_remittance(
+    remittance: RemittanceCreate,
+    current_user: dict = Depends(require_roles(["admin", "manager"]))
+):
+    """
+    Apply a bank remittance file across many invoices in one call
+    Valid lines are applied together in one transaction; invalid lines are
+    returned with the reason they were skipped.
+    """
+    numbers = list({line.invoice_number for line in remittance.lines})
+    invoices = await db.invoices.find({"invoice_number": {"$in": numbers}}).to_list(None)
+    invoices = {invoice["invoice_number"]: invoice for invoice in invoices}
+    
+    applications = []
+    rejected = []
+    pending = {}
+    for line_number, line in enumerate(remittance.lines, start=1):
+        invoice = invoices.get(line.invoice_number)
+        amount = round(line.amount, 2)
+        if not invoice:
+            rejected.append({"line": line_number, "invoice_number": line.invoice_number, "error": "Invoice not found"})
+            continue
+        # Check against the balance left after earlier lines for the same invoice
+        remaining = {**invoice, "balance": invoice["balance"] - pending.get(line.invoice_number, 0)}
+        error = payment_error(remaining, amount)
+        if error:
+            rejected.append({"line": line_number, "invoice_number": line.invoice_number, "error": error})
+            continue
+        pending[line.invoice_number] = pending.get(line.invoice_number, 0) + amount
+        applications.append({"invoice": invoice, "amount": amount, "reference": line.reference})
+    
+    payments = []
+    if applications:
+        try:
+            payments = await apply_payments(
+                applications,
+                str(current_user["_id"]),
+                method=remittance.method,
+                reference=remittance.reference,
+                date=remittance.date
+            )
+        except ValueError as e:
+            raise HTTPException(status_code=409, detail=str(e))
+    
+    return {
+        "message": "Remittance applied",
+        "applied": len(payments),
+        "total_applied": round(sum(payment["amount"] for payment in payments), 2),
+        "invoices": len(pending),
+        "rejected": rejected
+    }
@@ -0,0 +1,33 @@
+from fastapi import APIRouter, HTTPException, Depends
+from bson import ObjectId
+
+from auth.dependencies import get_current_user
+
+router = APIRouter(prefix="/jobs", tags=["Jobs"])
+
+# Get database
+from database import db
+
+@router.get("/{job_id}")
+async def get_job(job_id: str, current_user: dict = Depends(get_current_user)):
+    """
+    Status, progress and result of a background job
+    """
+    job = await db.jobs.find_one({"_id": ObjectId(job_id)})
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    
+    return {
+        "id": str(job["_id"]),
+        "type": job["type"],
+        "status": job["status"],
+        "attempts": job["attempts"],
+        "max_attempts": job["max_attempts"],
+        "progress": job["progress"],
+        "result": job["result"],
+        "error": job["error"],
+        "created_by": job["created_by"],
+        "created_at": job["created_at"],
+        "started_at": job.get("started_at"),
+        "finished_at": job.get("finished_at")
+    }
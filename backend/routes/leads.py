@@ -1,16 +1,31 @@
-from fastapi import APIRouter, HTTPException, status, Depends
+from fastapi import APIRouter, HTTPException, status, Depends, Query, UploadFile, File, Request, Response, Header
 from typing import List, Optional
 
 from datetime import datetime
 from bson import ObjectId
 
-from models.lead import LeadCreate, LeadUpdate, LeadResponse
+from models.lead import LeadCreate, LeadUpdate, LeadResponse, LeadStage, LeadConvert
 from auth.dependencies import get_current_user, require_roles
+from services.search import search_keys, refresh_search_keys
+from services.forecast import FORECAST_FIELDS, apply_forecast
+from services.lead_funnel import stage_event, record_stage_events, funnel
+from services.pricing import price_order_items
+from services.credit import check_credit
+from services import customer_overview
+from routes.orders import generate_order_number
+from services.lead_import import dedup_key, enqueue_lead_import
+from services.jobs import enqueue
+from services.concurrency import VERSION_BUMP, etag, version_filter, not_modified, raise_conflict_or_missing
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
 
 router = APIRouter(prefix="/leads", tags=["CRM"])
 
 # Get database
-from database import db
+from database import db, run_transaction
+
+# Case-insensitive email match, served by the contacts email index
+EMAIL_COLLATION = {"locale": "en", "strength": 2}
 
 @router.get("", response_model=List[LeadResponse])
 async def get_leads(current_user: dict = Depends(get_current_user)):
@@ -21,6 +36,7 @@ async def get_leads(current_user: dict = Depends(get_current_user)):
     return [
         {
             "id": str(lead["_id"]),
+            "version": lead.get("version", 0),
             "name": lead["name"],
             "contact": lead["contact"],
             "email": lead["email"],
@@ -29,6 +45,7 @@ async def get_leads(current_user: dict = Depends(get_current_user)):
             "priority": lead["priority"],
             "expected_revenue": lead["expected_revenue"],
             "probability": lead["probability"],
+            "expected_close_date": lead.get("expected_close_date"),
             "assigned_to": lead["assigned_to"],
             "notes": lead.get("notes"),
             "created_at": lead["created_at"],
@@ -37,8 +54,222 @@ async def get_leads(current_user: dict = Depends(get_current_user)):
         for lead in leads
     ]
 
+PRIORITY_RANK = {"$switch": {
+    "branches": [
+        {"case": {"$eq": ["$priority", "high"]}, "then": 0},
+        {"case": {"$eq": ["$priority", "medium"]}, "then": 1}
+    ],
+    "default": 2
+}}
+
+@router.get("/pipeline")
+async def get_pipeline(
+    assigned_to: Optional[str] = Query(None),
+    top: int = Query(5, ge=0, le=50, description="Leads returned per stage"),
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Pipeline board: per-stage counts, revenue, weighted revenue and top leads
+    """
+    match = {}
+    if assigned_to:
+        match["assigned_to"] = assigned_to
+    
+    top_leads = {
+        stage.value: [
+            {"$match": {"stage": stage.value}},
+            {"$set": {"priority_rank": PRIORITY_RANK}},
+            {"$sort": {"priority_rank": 1, "updated_at": -1}},
+            {"$limit": top},
+            {"$project": {
+                "name": 1, "contact": 1, "priority": 1, "expected_revenue": 1,
+                "probability": 1, "assigned_to": 1, "updated_at": 1
+            }}
+        ]
+        for stage in LeadStage
+    } if top else {}
+    
+    result = await db.leads.aggregate([
+        {"$match": match},
+        {
+            "$facet": {
+                "totals": [
+                    {
+                        "$group": {
+                            "_id": "$stage",
+                            "count": {"$sum": 1},
+                            "revenue": {"$sum": "$expected_revenue"},
+                            "weighted_revenue": {
+                                "$sum": {"$multiply": ["$expected_revenue", {"$divide": ["$probability", 100]}]}
+                            }
+                        }
+                    }
+                ],
+                **top_leads
+            }
+        }
+    ]).to_list(1)
+    facets = result[0] if result else {"totals": []}
+    totals = {row["_id"]: row for row in facets["totals"]}
+    
+    stages = []
+    for stage in LeadStage:
+        row = totals.get(stage.value, {})
+        stages.append({
+            "stage": stage.value,
+            "count": row.get("count", 0),
+            "revenue": round(row.get("revenue", 0), 2),
+            "weighted_revenue": round(row.get("weighted_revenue", 0), 2),
+            "leads": [
+                {
+                    "id": str(lead["_id"]),
+                    "name": lead["name"],
+                    "contact": lead["contact"],
+                    "priority": lead["priority"],
+                    "expected_revenue": lead["expected_revenue"],
+                    "probability": lead["probability"],
+                    "assigned_to": lead["assigned_to"],
+                    "updated_at": lead["updated_at"]
+                }
+                for lead in facets.get(stage.value, [])
+            ]
+        })
+    
+    return stages
+
+@router.get("/forecast")
+async def get_forecast(
+    assigned_to: Optional[str] = Query(None),
+    start: Optional[str] = Query(None, pattern=r"^\d{4}-\d{2}$", description="First month (YYYY-MM)"),
+    end: Optional[str] = Query(None, pattern=r"^\d{4}-\d{2}$", description="Last month (YYYY-MM)"),
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Weighted revenue forecast per salesperson and month
+    """
+    query = {}
+    if assigned_to:
+        query["user_id"] = assigned_to
+    if start or end:
+        query["period"] = {}
+        if start:
+            query["period"]["$gte"] = start
+        if end:
+            query["period"]["$lte"] = end
+    
+    buckets = await db.lead_forecasts.find(query).sort([("period", 1), ("user_id", 1)]).to_list(None)
+    rows = [
+        {
+            "period": bucket["period"],
+            "user_id": bucket["user_id"],
+            "lead_count": bucket["lead_count"],
+            "pipeline": round(bucket["pipeline"], 2),
+            "weighted": round(bucket["weighted"], 2),
+            "won": round(bucket["won"], 2)
+        }
+        for bucket in buckets
+        if bucket["lead_count"] > 0
+    ]
+    
+    return {
+        "rows": rows,
+        "total_pipeline": round(sum(row["pipeline"] for row in rows), 2),
+        "total_weighted": round(sum(row["weighted"] for row in rows), 2),
+        "total_won": round(sum(row["won"] for row in rows), 2)
+    }
+
+@router.post("/forecast/rebuild", status_code=status.HTTP_202_ACCEPTED)
+async def rebuild_lead_forecast(current_user: dict = Depends(require_roles(["admin"]))):
+    """
+    Queue a rebuild of the forecast buckets from leads (Admin only)
+    """
+    job_id = await enqueue("forecast.rebuild", {}, str(current_user["_id"]))
+    return {"message": "Forecast rebuild queued", "job_id": str(job_id)}
+
+@router.get("/funnel")
+async def get_funnel(
+    start: Optional[str] = Query(None, pattern=r"^\d{4}-\d{2}$", description="First cohort month (YYYY-MM)"),
+    end: Optional[str] = Query(None, pattern=r"^\d{4}-\d{2}$", description="Last cohort month (YYYY-MM)"),
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Conversion funnel per monthly cohort of new leads: leads reaching each stage,
+    conversion to the next stage and median time spent in each stage.
+    Cohorts are rebuilt in the background; built_at tells how fresh each one is.
+    """
+    cohorts = await funnel(start, end)
+    
+    def conversion(stages, index):
+        if index + 1 >= len(stages) or not stages[index]["reached"]:
+            return None
+        return round(stages[index + 1]["reached"] / stages[index]["reached"] * 100, 1)
+    
+    def stage_rows(stages):
+        return [
+            {
+                "stage": stage["stage"],
+                "reached": stage["reached"],
+                "conversion_to_next": conversion(stages, index),
+                "median_dwell_hours": (
+                    round(stage["median_dwell_seconds"] / 3600, 1)
+                    if stage.get("median_dwell_seconds") is not None else None
+                )
+            }
+            for index, stage in enumerate(stages)
+        ]
+    
+    # Reach counts add up across cohorts; medians only exist per cohort
+    totals = {}
+    for cohort in cohorts:
+        for stage in cohort.get("stages", []):
+            totals[stage["stage"]] = totals.get(stage["stage"], 0) + stage["reached"]
+    overall = [{"stage": stage, "reached": reached} for stage, reached in totals.items()]
+    
+    return {
+        "cohorts": [
+            {
+                "cohort": cohort["cohort"],
+                "leads": cohort.get("leads", 0),
+                "lost": cohort.get("lost", 0),
+                "built_at": cohort.get("built_at"),
+                "stages": stage_rows(cohort.get("stages", []))
+            }
+            for cohort in cohorts
+        ],
+        "overall": [
+            {"stage": stage["stage"], "reached": stage["reached"], "conversion_to_next": conversion(overall, index)}
+            for index, stage in enumerate(overall)
+        ]
+    }
+
+@router.post("/funnel/rebuild", status_code=status.HTTP_202_ACCEPTED)
+async def rebuild_funnel(current_user: dict = Depends(require_roles(["admin"]))):
+    """
+    Queue seeding stage history for leads without any and rebuilding every cohort (Admin only)
+    """
+    job_id = await enqueue("funnel.rebuild", {}, str(current_user["_id"]))
+    return {"message": "Funnel rebuild queued", "job_id": str(job_id)}
+
+@router.post("/import", status_code=status.HTTP_202_ACCEPTED)
+async def import_leads(
+    file: UploadFile = File(...),
+    current_user: dict = Depends(require_roles(["admin", "manager"]))
+):
+    """
+    Bulk import leads from a CSV file (Admin and Manager only)
+    The file is imported by a background job; poll GET /jobs/{job_id} for
+    progress. Emails and phones are normalized and leads whose email
+    already exists are skipped.
+    """
+    job_id = await enqueue_lead_import(file.file, file.filename, str(current_user["_id"]))
+    
+    return {
+        "message": "Lead import queued",
+        "job_id": str(job_id)
+    }
+
 @router.get("/{lead_id}", response_model=LeadResponse)
-async def get_lead(lead_id: str, current_user: dict = Depends(get_current_user)):
+async def get_lead(lead_id: str, request: Request, response: Response, current_user: dict = Depends(get_current_user)):
     """
     Get lead by ID
     """
@@ -46,8 +277,14 @@ async def get_lead(lead_id: str, current_user: dict = Depends(get_current_user))
     if not lead:
         raise HTTPException(status_code=404, detail="Lead not found")
     
+    cached = not_modified(request, lead)
+    if cached:
+        return cached
+    response.headers["ETag"] = etag(lead)
+    
     return {
         "id": str(lead["_id"]),
+        "version": lead.get("version", 0),
         "name": lead["name"],
         "contact": lead["contact"],
         "email": lead["email"],
@@ -56,6 +293,7 @@ async def get_lead(lead_id: str, current_user: dict = Depends(get_current_user))
         "priority": lead["priority"],
         "expected_revenue": lead["expected_revenue"],
         "probability": lead["probability"],
+        "expected_close_date": lead.get("expected_close_date"),
         "assigned_to": lead["assigned_to"],
         "notes": lead.get("notes"),
         "created_at": lead["created_at"],
@@ -73,10 +311,24 @@ async def create_lead(
     lead_dict = lead_data.dict()
     if not lead_dict.get("assigned_to"):
         lead_dict["assigned_to"] = str(current_user["_id"])
+    lead_dict["search_keys"] = search_keys("leads", lead_dict)
+    lead_dict["dedup_key"] = dedup_key(lead_dict["email"])
     lead_dict["created_at"] = datetime.utcnow()
     lead_dict["updated_at"] = datetime.utcnow()
+    lead_dict["stage_entered_at"] = lead_dict["created_at"]
     
-    result = await db.leads.insert_one(lead_dict)
+    try:
+        result = await db.leads.insert_one(lead_dict)
+    except DuplicateKeyError:
+        # Only imports are deduplicated; a lead whose email is already keyed
+        # is kept unkeyed, and marked so the backfill does not retry it
+        del lead_dict["dedup_key"], lead_dict["_id"]
+        lead_dict["dedup_skipped"] = True
+        result = await db.leads.insert_one(lead_dict)
+    await apply_forecast([], [lead_dict])
+    await record_stage_events([
+        stage_event({**lead_dict, "stage": None}, lead_dict["stage"], str(current_user["_id"]), lead_dict["created_at"])
+    ])
     
     return {
         "message": "Lead created successfully",
@@ -87,6 +339,8 @@ async def create_lead(
 async def update_lead(
     lead_id: str,
     lead_data: LeadUpdate,
+    response: Response,
+    if_match: Optional[str] = Header(None),
     current_user: dict = Depends(get_current_user)
 ):
     """
@@ -97,17 +351,191 @@ async def update_lead(
         raise HTTPException(status_code=400, detail="No fields to update")
     
     update_data["updated_at"] = datetime.utcnow()
+    if "email" in update_data:
+        update_data["dedup_key"] = dedup_key(update_data["email"])
     
-    result = await db.leads.update_one(
-        {"_id": ObjectId(lead_id)},
-        {"$set": update_data}
-    )
+    # A stage change restarts the stage clock; only claim it if the stage really differs
+    query = {"_id": ObjectId(lead_id), **version_filter(if_match)}
     
-    if result.matched_count == 0:
-        raise HTTPException(status_code=404, detail="Lead not found")
+    async def write(unset: dict):
+        previous = None
+        if "stage" in update_data:
+            previous = await db.leads.find_one_and_update(
+                {**query, "stage": {"$ne": update_data["stage"]}},
+                {"$set": {**update_data, "stage_entered_at": update_data["updated_at"]}, "$inc": VERSION_BUMP, **unset},
+                return_document=ReturnDocument.BEFORE
+            )
+            if previous:
+                await record_stage_events([
+                    stage_event(previous, update_data["stage"], str(current_user["_id"]), update_data["updated_at"])
+                ])
+        if not previous:
+            previous = await db.leads.find_one_and_update(
+                query,
+                {"$set": update_data, "$inc": VERSION_BUMP, **unset},
+                return_document=ReturnDocument.BEFORE
+            )
+        return previous
+    
+    try:
+        previous = await write({"$unset": {"dedup_skipped": ""}} if "dedup_key" in update_data else {})
+    except DuplicateKeyError:
+        # Only imports are deduplicated; a lead moved onto an email that is
+        # already keyed is kept, unkeyed and marked like in create_lead
+        del update_data["dedup_key"]
+        update_data["dedup_skipped"] = True
+        previous = await write({"$unset": {"dedup_key": ""}})
+    
+    if not previous:
+        await raise_conflict_or_missing("leads", {"_id": ObjectId(lead_id)}, "Lead")
+    response.headers["ETag"] = etag({"version": (previous.get("version") or 0) + 1})
+    if FORECAST_FIELDS & update_data.keys():
+        await apply_forecast([previous], [{**previous, **update_data}])
+    if {"name", "contact", "email"} & update_data.keys():
+        await refresh_search_keys("leads", ObjectId(lead_id))
     
     return {"message": "Lead updated successfully"}
 
+@router.post("/{lead_id}/convert", status_code=status.HTTP_201_CREATED)
+async def convert_lead(
+    lead_id: str,
+    convert_data: LeadConvert,
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Convert a lead into a customer and a draft order
+    The customer is matched by NIF, then by email, and created from the lead
+    when neither matches. The contact, the order and the lead's move to 'won'
+    are written in one transaction.
+    """
+    lead = await db.leads.find_one({"_id": ObjectId(lead_id)})
+    if not lead:
+        raise HTTPException(status_code=404, detail="Lead not found")
+    if lead.get("converted_order_id"):
+        raise HTTPException(status_code=400, detail="Lead has already been converted")
+    
+    contact = None
+    if convert_data.nif:
+        contact = await db.contacts.find_one({"nif": convert_data.nif}, {"name": 1, "is_customer": 1})
+    if not contact:
+        contact = await db.contacts.find_one(
+            {"email": lead["email"]}, {"name": 1, "is_customer": 1}, collation=EMAIL_COLLATION
+        )
+    
+    now = datetime.utcnow()
+    user_id = str(current_user["_id"])
+    new_contact = None
+    if not contact:
+        missing = [
+            field for field in ["nif", "billing_address_line1", "billing_postal_code", "billing_city"]
+            if not getattr(convert_data, field)
+        ]
+        if missing:
+            raise HTTPException(
+                status_code=400,
+                detail=f"No contact matches this lead; {', '.join(missing)} required to create one"
+            )
+        new_contact = {
+            "_id": ObjectId(),
+            "is_customer": True,
+            "is_supplier": False,
+            "type": convert_data.type,
+            "name": lead["name"],
+            "nif": convert_data.nif,
+            "email": lead["email"],
+            "phone": lead["phone"],
+            "billing_address_line1": convert_data.billing_address_line1,
+            "billing_postal_code": convert_data.billing_postal_code,
+            "billing_city": convert_data.billing_city,
+            "billing_country": convert_data.billing_country,
+            "shipping_same_as_billing": True,
+            "status": "active",
+            "notes": f"Converted from lead {lead['name']} ({lead['contact']})",
+            "created_at": now,
+            "updated_at": now
+        }
+        new_contact["search_keys"] = search_keys("contacts", new_contact)
+        contact = new_contact
+    customer_id = str(contact["_id"])
+    
+    try:
+        items, total, total_commission = await price_order_items([item.dict() for item in convert_data.items])
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    error = await check_credit(customer_id, total)
+    if error:
+        raise HTTPException(status_code=400, detail=error)
+    
+    order = {
+        "customer_id": customer_id,
+        "customer_name": contact["name"],
+        "items": items,
+        "status": "draft",
+        "store_id": convert_data.store_id,
+        "cost_center_id": convert_data.cost_center_id,
+        "order_number": await generate_order_number(),
+        "date": now,
+        "total": total,
+        "total_commission": total_commission,
+        "lead_id": lead_id,
+        "created_by": user_id,
+        "created_at": now,
+        "updated_at": now
+    }
+    
+    won = {
+        "stage": LeadStage.won.value,
+        "probability": 100,
+        "converted_contact_id": customer_id,
+        "updated_at": now
+    }
+    if lead["stage"] != LeadStage.won.value:
+        won["stage_entered_at"] = now
+    
+    async def convert(session):
+        if new_contact:
+            await db.contacts.insert_one(new_contact, session=session)
+        elif not contact.get("is_customer"):
+            await db.contacts.update_one(
+                {"_id": contact["_id"]},
+                {"$set": {"is_customer": True, "updated_at": now}, "$inc": VERSION_BUMP},
+                session=session
+            )
+        result = await db.orders.insert_one(order, session=session)
+        
+        # Guard against a concurrent conversion or edit of the lead
+        previous = await db.leads.find_one_and_update(
+            {"_id": lead["_id"], "updated_at": lead["updated_at"], "converted_order_id": None},
+            {"$set": {**won, "converted_order_id": str(result.inserted_id)}, "$inc": VERSION_BUMP},
+            session=session
+        )
+        if not previous:
+            raise ValueError("Lead changed while converting; nothing was created")
+        
+        await apply_forecast([previous], [{**previous, **won}], session=session)
+        if previous["stage"] != LeadStage.won.value:
+            await record_stage_events(
+                [stage_event(previous, LeadStage.won.value, user_id, now)],
+                session=session
+            )
+        return str(result.inserted_id)
+    
+    try:
+        order_id = await run_transaction(convert)
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    await customer_overview.invalidate(customer_id)
+    
+    return {
+        "message": "Lead converted successfully",
+        "contact_id": customer_id,
+        "contact_created": new_contact is not None,
+        "order_id": order_id,
+        "order_number": order["order_number"],
+        "total": total
+    }
+
 @router.delete("/{lead_id}")
 async def delete_lead(
     lead_id: str,
@@ -116,9 +544,10 @@ async def delete_lead(
     """
     Delete lead (Admin and Manager only)
     """
-    result = await db.leads.delete_one({"_id": ObjectId(lead_id)})
+    lead = await db.leads.find_one_and_delete({"_id": ObjectId(lead_id)})
     
-    if result.deleted_count == 0:
+    if not lead:
         raise HTTPException(status_code=404, detail="Lead not found")
+    await apply_forecast([lead], [])
     
     return {"message": "Lead deleted successfully"}
\ No newline at end of file
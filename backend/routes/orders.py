@@ -1,16 +1,38 @@
-from fastapi import APIRouter, HTTPException, status, Depends
-from typing import List
+from fastapi import APIRouter, HTTPException, status, Depends, Request, Response, Header
+from typing import List, Optional
 
 from datetime import datetime
 from bson import ObjectId
+from pymongo import ReturnDocument
 
 from models.order import OrderCreate, OrderUpdate, OrderResponse, OrderStatus
 from auth.dependencies import get_current_user, require_roles
+from services.inventory import issue_stock, stock_moved
+from services.pricing import price_order_items
+from services import ledger
+from services.outbox import event, record_events
+from services.credit import check_credit, reserve_order, adjust_exposure
+from services import customer_overview
+from services import reference_data
+from services import change_tokens
+from services.concurrency import VERSION_BUMP, etag, version_filter, not_modified, raise_conflict_or_missing
 
 router = APIRouter(prefix="/orders", tags=["Sales"])
 
 # Get database
-from database import db
+from database import db, run_transaction
+
+# Statuses in which an order holds no credit or stock yet
+UNAPPROVED_STATUSES = ["draft", "pending_approval"]
+
+# Status changes allowed through PUT, by current status. Approval and
+# invoicing move credit exposure and stock, so they only happen through
+# their own endpoints, and an approved order's status is never rewound.
+STATUS_TRANSITIONS = {
+    "draft": ["draft", "pending_approval", "cancelled"],
+    "pending_approval": ["draft", "pending_approval", "cancelled"],
+    "invoiced": ["invoiced", "completed"]
+}
 
 async def generate_order_number():
     """Generate next order number"""
@@ -21,50 +43,82 @@ async def generate_order_number():
         num = 1
     return f"SO-{num:03d}"
 
-async def create_stock_movement(product_id: str, product_name: str, quantity: int, reference: str, user_id: str):
+async def create_stock_movement(product_id: str, product_name: str, quantity: int, reference: str, user_id: str, costing: dict, session=None) -> dict:
     """Create stock movement record"""
     movement = {
         "product_id": product_id,
         "product_name": product_name,
         "type": "out",
         "quantity": quantity,
+        "unit_cost": costing["unit_cost"],
+        "total_cost": costing["total_cost"],
+        "fifo_cost": costing["fifo_cost"],
         "date": datetime.utcnow(),
         "reference": reference,
         "location": "Main Warehouse",
         "created_by": user_id,
         "created_at": datetime.utcnow()
     }
-    await db.stock_movements.insert_one(movement)
+    await db.stock_movements.insert_one(movement, session=session)
+    return movement
+
+async def issue_order_stock(order: dict, user_id: str, session=None) -> float:
+    """Deduct stock for each item, costing it at the weighted-average cost; returns the COGS"""
+    total_cost = 0
+    events = []
+    for item in order["items"]:
+        product = await db.products.find_one({"_id": ObjectId(item["product_id"])}, {"stock": 1}, session=session)
+        if not product:
+            raise HTTPException(status_code=400, detail=f"Product {item['product_name']} not found")
+        
+        costing = await issue_stock(item["product_id"], item["quantity"], session=session)
+        if costing is None:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Insufficient stock for {item['product_name']}. Available: {product.get('stock') or 0}, Required: {item['quantity']}"
+            )
+        total_cost += costing["total_cost"]
+        
+        # Create stock movement
+        movement = await create_stock_movement(
+            item["product_id"],
+            item["product_name"],
+            item["quantity"],
+            order["order_number"],
+            user_id,
+            costing,
+            session=session
+        )
+        events.append(stock_moved(movement))
+    await record_events(events, session=session)
+    return total_cost
+
+async def resolve_cost_center(order: dict, session=None):
+    """Cost center of an order, falling back to its store's revenue cost center"""
+    if order.get("cost_center_id") or not order.get("store_id"):
+        return order.get("cost_center_id")
+    store = await reference_data.get("stores", order["store_id"])
+    return store.get("revenue_cost_center_id") if store else None
 
-async def create_journal_entries(order_id: str, order_number: str, total: float, customer_name: str, user_id: str):
-    """Create journal entries for the order"""
+async def create_journal_entries(order: dict, total_cost: float, user_id: str, session=None):
+    """Create journal entries for the order, tagged with its cost center and store"""
+    tags = {
+        "cost_center_id": await resolve_cost_center(order, session=session),
+        "store_id": order.get("store_id")
+    }
+    reference = order["order_number"]
+    customer_name = order["customer_name"]
+    
     entries = [
-        {
-            "date": datetime.utcnow(),
-            "reference": order_number,
-            "description": f"Invoice for {customer_name}",
-            "account_id": "ar_account",
-            "account_name": "Accounts Receivable",
-            "debit": total,
-            "credit": 0,
-            "status": "posted",
-            "created_by": user_id,
-            "created_at": datetime.utcnow()
-        },
-        {
-            "date": datetime.utcnow(),
-            "reference": order_number,
-            "description": f"Revenue from {customer_name}",
-            "account_id": "revenue_account",
-            "account_name": "Revenue",
-            "debit": 0,
-            "credit": total,
-            "status": "posted",
-            "created_by": user_id,
-            "created_at": datetime.utcnow()
-        }
+        await ledger.journal_line(ledger.ACCOUNTS_RECEIVABLE, f"Invoice for {customer_name}", reference, order["total"], 0, user_id, **tags),
+        await ledger.journal_line(ledger.REVENUE, f"Revenue from {customer_name}", reference, 0, order["total"], user_id, **tags)
     ]
-    await db.journal_entries.insert_many(entries)
+    if total_cost:
+        entries += [
+            await ledger.journal_line(ledger.COST_OF_GOODS_SOLD, f"Cost of goods sold to {customer_name}", reference, total_cost, 0, user_id, **tags),
+            await ledger.journal_line(ledger.INVENTORY, f"Inventory issued to {customer_name}", reference, 0, total_cost, user_id, **tags)
+        ]
+    await ledger.post_entries(entries, session=session)
 
 @router.get("", response_model=List[OrderResponse])
 async def get_orders(current_user: dict = Depends(get_current_user)):
@@ -75,6 +129,7 @@ async def get_orders(current_user: dict = Depends(get_current_user)):
     return [
         {
             "id": str(order["_id"]),
+            "version": order.get("version", 0),
             "order_number": order["order_number"],
             "customer_id": order["customer_id"],
             "customer_name": order["customer_name"],
@@ -83,6 +138,7 @@ async def get_orders(current_user: dict = Depends(get_current_user)):
             "items": order["items"],
             "total": order["total"],
             "total_commission": order.get("total_commission", 0),
+            "total_cost": order.get("total_cost"),
             "approved_by": order.get("approved_by"),
             "created_by": order["created_by"],
             "store_id": order.get("store_id"),
@@ -94,7 +150,7 @@ async def get_orders(current_user: dict = Depends(get_current_user)):
     ]
 
 @router.get("/{order_id}", response_model=OrderResponse)
-async def get_order(order_id: str, current_user: dict = Depends(get_current_user)):
+async def get_order(order_id: str, request: Request, response: Response, current_user: dict = Depends(get_current_user)):
     """
     Get order by ID
     """
@@ -102,8 +158,14 @@ async def get_order(order_id: str, current_user: dict = Depends(get_current_user
     if not order:
         raise HTTPException(status_code=404, detail="Order not found")
     
+    cached = not_modified(request, order)
+    if cached:
+        return cached
+    response.headers["ETag"] = etag(order)
+    
     return {
         "id": str(order["_id"]),
+        "version": order.get("version", 0),
         "order_number": order["order_number"],
         "customer_id": order["customer_id"],
         "customer_name": order["customer_name"],
@@ -112,6 +174,7 @@ async def get_order(order_id: str, current_user: dict = Depends(get_current_user
         "items": order["items"],
         "total": order["total"],
         "total_commission": order.get("total_commission", 0),
+        "total_cost": order.get("total_cost"),
         "approved_by": order.get("approved_by"),
         "created_by": order["created_by"],
         "store_id": order.get("store_id"),
@@ -128,11 +191,19 @@ async def create_order(
     """
     Create a new order
     """
-    # Calculate total and total commission
-    total = sum(item.quantity * item.price for item in order_data.items)
-    total_commission = sum(item.commission_value for item in order_data.items if item.commission_value is not None)
-    
     order_dict = order_data.dict()
+    
+    # Price items from the catalog; totals are frozen on the order
+    try:
+        items, total, total_commission = await price_order_items(order_dict["items"])
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    error = await check_credit(order_dict["customer_id"], total)
+    if error:
+        raise HTTPException(status_code=400, detail=error)
+    
+    order_dict["items"] = items
     order_dict["order_number"] = await generate_order_number()
     order_dict["date"] = datetime.utcnow()
     order_dict["total"] = total
@@ -142,6 +213,7 @@ async def create_order(
     order_dict["updated_at"] = datetime.utcnow()
     
     result = await db.orders.insert_one(order_dict)
+    await customer_overview.invalidate(order_dict["customer_id"])
     
     return {
         "message": "Order created successfully",
@@ -154,6 +226,8 @@ async def create_order(
 async def update_order(
     order_id: str,
     order_data: OrderUpdate,
+    response: Response,
+    if_match: Optional[str] = Header(None),
     current_user: dict = Depends(get_current_user)
 ):
     """
@@ -163,19 +237,60 @@ async def update_order(
     if not update_data:
         raise HTTPException(status_code=400, detail="No fields to update")
     
-    # Recalculate total if items changed
+    # Items and customer carry the order's credit exposure once it is approved
+    allowed_statuses = None
+    if update_data.keys() & {"items", "customer_id", "customer_name"}:
+        allowed_statuses = UNAPPROVED_STATUSES
+    if "status" in update_data:
+        new_status = OrderStatus(update_data["status"]).value
+        from_statuses = [
+            current for current, targets in STATUS_TRANSITIONS.items()
+            if new_status in targets
+        ]
+        if not from_statuses:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Orders cannot be set to '{new_status}' directly"
+            )
+        allowed_statuses = [s for s in from_statuses if allowed_statuses is None or s in allowed_statuses]
+    
+    if allowed_statuses is not None:
+        order = await db.orders.find_one({"_id": ObjectId(order_id)}, {"status": 1})
+        if not order:
+            raise HTTPException(status_code=404, detail="Order not found")
+        if order["status"] not in allowed_statuses:
+            raise HTTPException(
+                status_code=400,
+                detail=f"This change is not allowed on an order with status '{order['status']}'"
+            )
+    
+    # Reprice items and refreeze totals if items changed
     if "items" in update_data:
-        update_data["total"] = sum(item["quantity"] * item["price"] for item in update_data["items"])
+        try:
+            items, total, total_commission = await price_order_items(update_data["items"])
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        update_data["items"] = items
+        update_data["total"] = total
+        update_data["total_commission"] = total_commission
     
     update_data["updated_at"] = datetime.utcnow()
     
-    result = await db.orders.update_one(
-        {"_id": ObjectId(order_id)},
-        {"$set": update_data}
+    query = {"_id": ObjectId(order_id), **version_filter(if_match)}
+    if allowed_statuses is not None:
+        # Re-checked atomically: the order may have been approved meanwhile
+        query["status"] = {"$in": allowed_statuses}
+    
+    previous = await db.orders.find_one_and_update(
+        query,
+        {"$set": update_data, "$inc": VERSION_BUMP},
+        projection={"customer_id": 1, "version": 1}
     )
     
-    if result.matched_count == 0:
-        raise HTTPException(status_code=404, detail="Order not found")
+    if not previous:
+        await raise_conflict_or_missing("orders", {"_id": ObjectId(order_id)}, "Order")
+    response.headers["ETag"] = etag({"version": (previous.get("version") or 0) + 1})
+    await customer_overview.invalidate(previous["customer_id"], update_data.get("customer_id"))
     
     return {"message": "Order updated successfully"}
 
@@ -186,11 +301,12 @@ async def approve_order(
 ):
     """
     Approve order (Admin and Manager only)
-    This triggers:
-    1. Status change to 'approved'
-    2. Stock deduction
-    3. Commission calculation
-    4. Journal entries creation
+    In one transaction this:
+    1. Reserves the order against the customer's credit limit
+    2. Deducts stock and costs the goods sold
+    3. Creates the journal entries
+    4. Changes the status to 'approved' and records order.approved,
+       whose subscribers update the commission buckets and sales rollups
     """
     order = await db.orders.find_one({"_id": ObjectId(order_id)})
     if not order:
@@ -202,68 +318,42 @@ async def approve_order(
             detail="Only orders with 'pending_approval' status can be approved"
         )
     
-    # Calcular comissão total do pedido
-    total_commission = 0
-    for item in order["items"]:
-        # Se o item já tem o valor de comissão calculado, usar
-        if item.get("commission_value") is not None:
-            total_commission += item["commission_value"]
-        # Senão, calcular com base na percentagem
-        elif item.get("commission_percent") is not None:
-            item_commission = item["quantity"] * item["price"] * (item["commission_percent"] / 100)
-            total_commission += item_commission
+    # Commission was computed and frozen when the order was priced
+    total_commission = order.get("total_commission", 0)
+    user_id = str(current_user["_id"])
     
-    # Update stock for each item
-    for item in order["items"]:
-        product = await db.products.find_one({"_id": ObjectId(item["product_id"])})
-        if not product:
-            raise HTTPException(status_code=400, detail=f"Product {item['product_name']} not found")
+    async def approve(session):
+        if not await reserve_order(order["customer_id"], order["total"], session=session):
+            raise HTTPException(status_code=400, detail=f"Credit limit exceeded for {order['customer_name']}")
         
-        if product["stock"] < item["quantity"]:
-            raise HTTPException(
-                status_code=400,
-                detail=f"Insufficient stock for {item['product_name']}. Available: {product['stock']}, Required: {item['quantity']}"
-            )
+        total_cost = round(await issue_order_stock(order, user_id, session=session), 2)
+        await create_journal_entries(order, total_cost, user_id, session=session)
         
-        # Deduct stock
-        await db.products.update_one(
-            {"_id": ObjectId(item["product_id"])},
+        # Update order status and save cost
+        approved = await db.orders.find_one_and_update(
+            {"_id": ObjectId(order_id), "status": "pending_approval"},
             {
-                "$inc": {"stock": -item["quantity"]},
-                "$set": {"updated_at": datetime.utcnow()}
-            }
-        )
-        
-        # Create stock movement
-        await create_stock_movement(
-            item["product_id"],
-            item["product_name"],
-            item["quantity"],
-            order["order_number"],
-            str(current_user["_id"])
+                "$set": {
+                    "status": "approved",
+                    "approved_by": user_id,
+                    "total_cost": total_cost,
+                    "updated_at": datetime.utcnow()
+                },
+                "$inc": VERSION_BUMP
+            },
+            return_document=ReturnDocument.AFTER,
+            session=session
         )
+        if not approved:
+            raise HTTPException(status_code=409, detail="Order was changed while approving; nothing was recorded")
+        await record_events([event("order.approved", {"order": approved})], session=session)
     
-    # Create journal entries
-    await create_journal_entries(
-        str(order["_id"]),
-        order["order_number"],
-        order["total"],
-        order["customer_name"],
-        str(current_user["_id"])
-    )
-    
-    # Update order status and save commission
-    await db.orders.update_one(
-        {"_id": ObjectId(order_id)},
-        {
-            "$set": {
-                "status": "approved",
-                "approved_by": str(current_user["_id"]),
-                "total_commission": total_commission,
-                "updated_at": datetime.utcnow()
-            }
-        }
-    )
+    await run_transaction(approve)
+    # Bumped after the commit: inside the transaction every approval would
+    # write the same token document and conflict with every other one
+    await change_tokens.bump("products")
+    await ledger.invalidate_pnl()
+    await customer_overview.invalidate(order["customer_id"])
     
     return {
         "message": "Order approved successfully",
@@ -294,9 +384,11 @@ async def reject_order(
             "$set": {
                 "status": "cancelled",
                 "updated_at": datetime.utcnow()
-            }
+            },
+            "$inc": VERSION_BUMP
         }
     )
+    await customer_overview.invalidate(order["customer_id"])
     
     return {"message": "Order rejected successfully"}
 
@@ -308,9 +400,13 @@ async def delete_order(
     """
     Delete order (Admin only)
     """
-    result = await db.orders.delete_one({"_id": ObjectId(order_id)})
+    order = await db.orders.find_one_and_delete({"_id": ObjectId(order_id)})
     
-    if result.deleted_count == 0:
+    if not order:
         raise HTTPException(status_code=404, detail="Order not found")
     
+    if order["status"] == "approved":
+        await adjust_exposure({order["customer_id"]: (0, -order["total"])})
+    await customer_overview.invalidate(order["customer_id"])
+    
     return {"message": "Order deleted successfully"}
@@ -1,11 +1,17 @@
-from fastapi import APIRouter, HTTPException, status, Depends
-from typing import List
+from fastapi import APIRouter, HTTPException, status, Depends, UploadFile, File, Query, Request, Response, Header
+from typing import List, Optional
 
 from datetime import datetime
 from bson import ObjectId
+from pymongo import ReturnDocument
 
 from models.product import ProductCreate, ProductUpdate, ProductResponse
 from auth.dependencies import get_current_user, require_roles
+from services import pricing
+from services.search import search_keys, refresh_search_keys
+from services.concurrency import VERSION_BUMP, etag, version_filter, not_modified, raise_conflict_or_missing
+from services import change_tokens
+from services.product_import import assign_variant_ids, enqueue_product_import
 
 router = APIRouter(prefix="/products", tags=["Inventory"])
 
@@ -13,14 +19,19 @@ router = APIRouter(prefix="/products", tags=["Inventory"])
 from database import db
 
 @router.get("", response_model=List[ProductResponse])
-async def get_products(current_user: dict = Depends(get_current_user)):
+async def get_products(request: Request, response: Response, current_user: dict = Depends(get_current_user)):
     """
     Get all products
     """
+    cached = await change_tokens.conditional(request, response, "products")
+    if cached:
+        return cached
+    
     products = await db.products.find().to_list(1000)
     return [
         {
             "id": str(product["_id"]),
+            "version": product.get("version", 0),
             "name": product["name"],
             "sku": product["sku"],
             "category": product["category"],
@@ -29,6 +40,7 @@ async def get_products(current_user: dict = Depends(get_current_user)):
             "description": product.get("description"),
             "price": product.get("price"),
             "cost": product.get("cost"),
+            "avg_cost": product.get("avg_cost"),
             "stock": product.get("stock"),
             "reorder_level": product.get("reorder_level"),
             "supplier": product.get("supplier"),
@@ -41,8 +53,34 @@ async def get_products(current_user: dict = Depends(get_current_user)):
         for product in products
     ]
 
+@router.get("/pricing")
+async def get_pricing(
+    variant_ids: str = Query(..., description="Comma-separated variant IDs"),
+    tier: str = Query("normal"),
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Resolve price and commission for several variants in one request
+    """
+    requested = [v.strip() for v in variant_ids.split(",") if v.strip()]
+    resolved = await pricing.resolve_prices(requested, tier)
+    
+    return {
+        "tier": tier,
+        "prices": [
+            {
+                "variant_id": variant_id,
+                "product_id": entry["product_id"],
+                "price": entry["price"],
+                "commission_percent": entry["commission_percent"]
+            }
+            for variant_id, entry in resolved.items()
+        ],
+        "missing": [v for v in requested if v not in resolved]
+    }
+
 @router.get("/{product_id}", response_model=ProductResponse)
-async def get_product(product_id: str, current_user: dict = Depends(get_current_user)):
+async def get_product(product_id: str, request: Request, response: Response, current_user: dict = Depends(get_current_user)):
     """
     Get product by ID
     """
@@ -50,8 +88,14 @@ async def get_product(product_id: str, current_user: dict = Depends(get_current_
     if not product:
         raise HTTPException(status_code=404, detail="Product not found")
     
+    cached = not_modified(request, product)
+    if cached:
+        return cached
+    response.headers["ETag"] = etag(product)
+    
     return {
         "id": str(product["_id"]),
+        "version": product.get("version", 0),
         "name": product["name"],
         "sku": product["sku"],
         "category": product["category"],
@@ -60,6 +104,7 @@ async def get_product(product_id: str, current_user: dict = Depends(get_current_
         "description": product.get("description"),
         "price": product.get("price"),
         "cost": product.get("cost"),
+        "avg_cost": product.get("avg_cost"),
         "stock": product.get("stock"),
         "reorder_level": product.get("reorder_level"),
         "supplier": product.get("supplier"),
@@ -87,27 +132,52 @@ async def create_product(
         )
     
     product_dict = product_data.dict()
+    assign_variant_ids(product_dict)
+    product_dict["search_keys"] = search_keys("products", product_dict)
     
-    # Gerar IDs para variantes se não tiverem
-    if product_dict.get("variants"):
-        for i, variant in enumerate(product_dict["variants"]):
-            if not variant.get("variant_id"):
-                variant["variant_id"] = f"VAR-{i+1:03d}-{datetime.utcnow().timestamp()}"
-    
+    # Custo médio ponderado começa no custo de compra indicado
+    product_dict["avg_cost"] = product_dict.get("cost")
     product_dict["created_at"] = datetime.utcnow()
     product_dict["updated_at"] = datetime.utcnow()
     
     result = await db.products.insert_one(product_dict)
+    await pricing.invalidate()
+    await change_tokens.bump("products")
     
     return {
         "message": "Product created successfully",
         "product_id": str(result.inserted_id)
     }
 
+@router.post("/import", status_code=status.HTTP_202_ACCEPTED)
+async def import_products(
+    file: UploadFile = File(...),
+    file_format: Optional[str] = Query(None, alias="format", pattern="^(csv|ndjson)$"),
+    current_user: dict = Depends(require_roles(["admin", "manager"]))
+):
+    """
+    Bulk import products from a CSV or NDJSON file (Admin and Manager only)
+    The file is imported by a background job; poll GET /jobs/{job_id} for
+    progress. Rows are upserted by SKU and invalid rows are reported
+    individually. Stock columns are ignored; use stock receipts instead.
+    """
+    if file_format is None:
+        filename = (file.filename or "").lower()
+        file_format = "ndjson" if filename.endswith((".ndjson", ".jsonl", ".json")) else "csv"
+    
+    job_id = await enqueue_product_import(file.file, file.filename, file_format, str(current_user["_id"]))
+    
+    return {
+        "message": "Product import queued",
+        "job_id": str(job_id)
+    }
+
 @router.put("/{product_id}")
 async def update_product(
     product_id: str,
     product_data: ProductUpdate,
+    response: Response,
+    if_match: Optional[str] = Header(None),
     current_user: dict = Depends(require_roles(["admin", "manager"]))
 ):
     """
@@ -119,13 +189,20 @@ async def update_product(
     
     update_data["updated_at"] = datetime.utcnow()
     
-    result = await db.products.update_one(
-        {"_id": ObjectId(product_id)},
-        {"$set": update_data}
+    updated = await db.products.find_one_and_update(
+        {"_id": ObjectId(product_id), **version_filter(if_match)},
+        {"$set": update_data, "$inc": VERSION_BUMP},
+        projection={"version": 1},
+        return_document=ReturnDocument.AFTER
     )
     
-    if result.matched_count == 0:
-        raise HTTPException(status_code=404, detail="Product not found")
+    if not updated:
+        await raise_conflict_or_missing("products", {"_id": ObjectId(product_id)}, "Product")
+    response.headers["ETag"] = etag(updated)
+    await pricing.invalidate()
+    await change_tokens.bump("products")
+    if "name" in update_data or "sku" in update_data:
+        await refresh_search_keys("products", ObjectId(product_id))
     
     return {"message": "Product updated successfully"}
 
@@ -141,5 +218,7 @@ async def delete_product(
     
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Product not found")
+    await pricing.invalidate()
+    await change_tokens.bump("products")
     
     return {"message": "Product deleted successfully"}
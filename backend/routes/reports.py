@@ -0,0 +1,146 @@
+from fastapi import APIRouter, Depends, Query, status
+from typing import Optional
+from datetime import datetime
+from bson import ObjectId
+
+from auth.dependencies import require_roles
+from services.sales_rollups import ROLLUP_COLLECTIONS
+from services.jobs import enqueue
+
+router = APIRouter(prefix="/reports", tags=["Reports"])
+
+# Get database
+from database import db
+
+async def get_names(collection, ids, field: str = "name") -> dict:
+    """Map document IDs (ObjectId or seeded string IDs) to a display field"""
+    ids = [i for i in ids if i]
+    lookup = list(ids) + [ObjectId(i) for i in ids if ObjectId.is_valid(i)]
+    docs = await collection.find({"_id": {"$in": lookup}}, {field: 1}).to_list(None)
+    return {str(doc["_id"]): doc.get(field) for doc in docs}
+
+@router.get("/commissions")
+async def get_commission_report(
+    group_by: str = Query("user", pattern="^(user|store)$"),
+    period: str = Query("month", pattern="^(month|year)$"),
+    start: Optional[str] = Query(None, pattern=r"^\d{4}-\d{2}$", description="First month (YYYY-MM)"),
+    end: Optional[str] = Query(None, pattern=r"^\d{4}-\d{2}$", description="Last month (YYYY-MM)"),
+    current_user: dict = Depends(require_roles(["admin", "manager"]))
+):
+    """
+    Commission totals per salesperson or store and period (Admin and Manager only)
+    Reads the monthly buckets maintained at order approval.
+    """
+    query = {}
+    if start or end:
+        query["period"] = {}
+        if start:
+            query["period"]["$gte"] = start
+        if end:
+            query["period"]["$lte"] = end
+    
+    key_field = "$user_id" if group_by == "user" else "$store_id"
+    period_field = "$period" if period == "month" else {"$substrBytes": ["$period", 0, 4]}
+    
+    rows = await db.commission_buckets.aggregate([
+        {"$match": query},
+        {
+            "$group": {
+                "_id": {"key": key_field, "period": period_field},
+                "total_commission": {"$sum": "$total_commission"},
+                "revenue": {"$sum": "$revenue"},
+                "order_count": {"$sum": "$order_count"}
+            }
+        },
+        {"$sort": {"_id.period": 1, "total_commission": -1}}
+    ]).to_list(None)
+    
+    keys = {row["_id"]["key"] for row in rows}
+    if group_by == "user":
+        names = await get_names(db.users, keys)
+    else:
+        names = await get_names(db.stores, keys)
+    
+    return [
+        {
+            "period": row["_id"]["period"],
+            f"{group_by}_id": row["_id"]["key"],
+            f"{group_by}_name": names.get(row["_id"]["key"]),
+            "total_commission": round(row["total_commission"], 2),
+            "revenue": round(row["revenue"], 2),
+            "order_count": row["order_count"]
+        }
+        for row in rows
+    ]
+
+@router.post("/commissions/rebuild", status_code=status.HTTP_202_ACCEPTED)
+async def rebuild_commission_report(current_user: dict = Depends(require_roles(["admin"]))):
+    """
+    Queue a rebuild of the monthly commission buckets from orders (Admin only)
+    """
+    job_id = await enqueue("commissions.rebuild", {}, str(current_user["_id"]))
+    return {"message": "Commission rebuild queued", "job_id": str(job_id)}
+
+
+@router.get("/sales")
+async def get_sales_report(
+    granularity: str = Query("day", pattern="^(hour|day|week|month|year)$"),
+    group_by: str = Query("total", pattern="^(total|store|cost_center|product|customer)$"),
+    start: Optional[datetime] = Query(None),
+    end: Optional[datetime] = Query(None),
+    current_user: dict = Depends(require_roles(["admin", "manager"]))
+):
+    """
+    Revenue per time bucket, optionally split by store, cost center, product or customer
+    Reads the hourly rollups for hourly charts and the daily rollups otherwise.
+    """
+    collection = db[ROLLUP_COLLECTIONS["hour" if granularity == "hour" else "day"]]
+    
+    query = {"dimension": group_by}
+    if start or end:
+        query["bucket"] = {}
+        if start:
+            query["bucket"]["$gte"] = start
+        if end:
+            query["bucket"]["$lt"] = end
+    
+    rows = await collection.aggregate([
+        {"$match": query},
+        {
+            "$group": {
+                "_id": {"bucket": {"$dateTrunc": {"date": "$bucket", "unit": granularity}}, "key": "$key"},
+                "name": {"$last": "$name"},
+                "revenue": {"$sum": "$revenue"},
+                "quantity": {"$sum": "$quantity"},
+                "order_count": {"$sum": "$order_count"}
+            }
+        },
+        {"$sort": {"_id.bucket": 1, "revenue": -1}}
+    ]).to_list(None)
+    
+    names = {}
+    keys = {row["_id"]["key"] for row in rows}
+    if group_by == "store":
+        names = await get_names(db.stores, keys)
+    elif group_by == "cost_center":
+        names = await get_names(db.cost_centers, keys)
+    
+    return [
+        {
+            "bucket": row["_id"]["bucket"],
+            "key": row["_id"]["key"],
+            "name": names.get(row["_id"]["key"], row.get("name")),
+            "revenue": round(row["revenue"], 2),
+            "quantity": row["quantity"],
+            "order_count": row["order_count"]
+        }
+        for row in rows
+    ]
+
+@router.post("/sales/rebuild", status_code=status.HTTP_202_ACCEPTED)
+async def rebuild_sales_report(current_user: dict = Depends(require_roles(["admin"]))):
+    """
+    Queue a rebuild of the hourly and daily sales rollups from orders (Admin only)
+    """
+    job_id = await enqueue("sales_rollups.rebuild", {}, str(current_user["_id"]))
+    return {"message": "Sales rollup rebuild queued", "job_id": str(job_id)}
@@ -0,0 +1,35 @@
+from fastapi import APIRouter, Depends, Query
+
+from auth.dependencies import get_current_user
+from services.search import search
+
+router = APIRouter(prefix="/search", tags=["Search"])
+
+@router.get("")
+async def search_all(
+    q: str = Query(..., min_length=1, max_length=100),
+    limit: int = Query(10, ge=1, le=50),
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Typeahead search across contacts, products and leads
+    Prefix matches on name, trade name, NIF, email, SKU and lead company
+    rank first, then whole-word text matches.
+    """
+    results = []
+    for match in await search(q, limit):
+        doc = match["document"]
+        if match["type"] == "contacts":
+            title, subtitle = doc.get("name"), doc.get("nif")
+        elif match["type"] == "products":
+            title, subtitle = doc.get("name"), doc.get("sku")
+        else:
+            title, subtitle = doc.get("name"), doc.get("contact")
+        results.append({
+            "type": match["type"][:-1],
+            "id": str(doc["_id"]),
+            "title": title,
+            "subtitle": subtitle,
+            "score": round(match["score"], 3)
+        })
+    return results
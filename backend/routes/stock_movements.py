@@ -6,11 +6,14 @@ from bson import ObjectId
 
 from models.stock_movement import StockMovementCreate, StockMovementResponse
 from auth.dependencies import get_current_user, require_roles
+from services.inventory import receive_stock, issue_stock, stock_moved
+from services.outbox import record_events
+from services import change_tokens
 
 router = APIRouter(prefix="/stock-movements", tags=["Inventory"])
 
 # Get database
-from database import db
+from database import db, run_transaction
 
 @router.get("", response_model=List[StockMovementResponse])
 async def get_stock_movements(current_user: dict = Depends(get_current_user)):
@@ -28,6 +31,9 @@ async def get_stock_movements(current_user: dict = Depends(get_current_user)):
             "date": movement["date"],
             "reference": movement["reference"],
             "location": movement["location"],
+            "unit_cost": movement.get("unit_cost"),
+            "total_cost": movement.get("total_cost"),
+            "remaining_quantity": movement.get("remaining_quantity"),
             "created_by": movement["created_by"],
             "created_at": movement["created_at"]
         }
@@ -47,32 +53,38 @@ async def create_stock_movement(
     if not product:
         raise HTTPException(status_code=404, detail="Product not found")
     
-    # Update product stock
-    stock_change = movement_data.quantity if movement_data.type == "in" else -movement_data.quantity
-    new_stock = product["stock"] + stock_change
+    # Stock, cost layers, the movement and its event are committed together
+    async def record(session):
+        movement = movement_data.dict()
+        if movement_data.type == "in":
+            unit_cost = await receive_stock(product, movement_data.quantity, movement_data.unit_cost, session=session)
+            movement["remaining_quantity"] = movement_data.quantity
+            movement["total_cost"] = round(movement_data.quantity * unit_cost, 2)
+        else:
+            issued = await issue_stock(movement_data.product_id, movement_data.quantity, session=session)
+            if issued is None:
+                raise HTTPException(
+                    status_code=400,
+                    detail="Insufficient stock for this operation"
+                )
+            unit_cost = issued["unit_cost"]
+            movement["total_cost"] = issued["total_cost"]
+            movement["fifo_cost"] = issued["fifo_cost"]
+        movement["unit_cost"] = unit_cost
+        
+        # Create movement record
+        movement["date"] = datetime.utcnow()
+        movement["created_by"] = str(current_user["_id"])
+        movement["created_at"] = datetime.utcnow()
+        
+        result = await db.stock_movements.insert_one(movement, session=session)
+        await record_events([stock_moved(movement)], session=session)
+        return result.inserted_id
     
-    if new_stock < 0:
-        raise HTTPException(
-            status_code=400,
-            detail="Insufficient stock for this operation"
-        )
-    
-    await db.products.update_one(
-        {"_id": ObjectId(movement_data.product_id)},
-        {
-            "$set": {"stock": new_stock, "updated_at": datetime.utcnow()}
-        }
-    )
-    
-    # Create movement record
-    movement_dict = movement_data.dict()
-    movement_dict["date"] = datetime.utcnow()
-    movement_dict["created_by"] = str(current_user["_id"])
-    movement_dict["created_at"] = datetime.utcnow()
-    
-    result = await db.stock_movements.insert_one(movement_dict)
+    movement_id = await run_transaction(record)
+    await change_tokens.bump("products")
     
     return {
         "message": "Stock movement recorded successfully",
-        "movement_id": str(result.inserted_id)
+        "movement_id": str(movement_id)
     }
\ No newline at end of file
@@ -1,24 +1,33 @@
-from fastapi import APIRouter, HTTPException, status, Depends
-from typing import List
+from fastapi import APIRouter, HTTPException, status, Depends, Request, Response, Header
+from typing import List, Optional
 from datetime import datetime
 from bson import ObjectId
+from pymongo import ReturnDocument
 
 from models.store import StoreCreate, StoreUpdate, StoreResponse
 from auth.dependencies import get_current_user, require_roles
+from services.concurrency import VERSION_BUMP, etag, version_filter, not_modified, raise_conflict_or_missing
+from services import change_tokens
+from services import reference_data
 
 router = APIRouter(prefix="/stores", tags=["Stores"])
 
 from database import db
 
 @router.get("", response_model=List[StoreResponse])
-async def get_stores(current_user: dict = Depends(get_current_user)):
+async def get_stores(request: Request, response: Response, current_user: dict = Depends(get_current_user)):
     """
     Get all stores
     """
-    stores = await db.stores.find().to_list(1000)
+    cached = await change_tokens.conditional(request, response, "stores")
+    if cached:
+        return cached
+    
+    stores = await reference_data.get_all("stores")
     return [
         {
             "id": str(store["_id"]),
+            "version": store.get("version", 0),
             "code": store["code"],
             "name": store["name"],
             "address_line1": store["address_line1"],
@@ -34,16 +43,22 @@ async def get_stores(current_user: dict = Depends(get_current_user)):
     ]
 
 @router.get("/{store_id}", response_model=StoreResponse)
-async def get_store(store_id: str, current_user: dict = Depends(get_current_user)):
+async def get_store(store_id: str, request: Request, response: Response, current_user: dict = Depends(get_current_user)):
     """
     Get store by ID
     """
-    store = await db.stores.find_one({"_id": ObjectId(store_id)})
+    store = await reference_data.get("stores", store_id)
     if not store:
         raise HTTPException(status_code=404, detail="Store not found")
     
+    cached = not_modified(request, store)
+    if cached:
+        return cached
+    response.headers["ETag"] = etag(store)
+    
     return {
         "id": str(store["_id"]),
+        "version": store.get("version", 0),
         "code": store["code"],
         "name": store["name"],
         "address_line1": store["address_line1"],
@@ -65,7 +80,7 @@ async def create_store(
     Create a new store
     """
     # Check if code already exists
-    existing_store = await db.stores.find_one({"code": store_data.code})
+    existing_store = await reference_data.find_by("stores", "code", store_data.code)
     if existing_store:
         raise HTTPException(
             status_code=400,
@@ -77,6 +92,7 @@ async def create_store(
     store_dict["updated_at"] = datetime.utcnow()
     
     result = await db.stores.insert_one(store_dict)
+    await change_tokens.bump("stores")
     
     return {
         "message": "Store created successfully",
@@ -87,6 +103,8 @@ async def create_store(
 async def update_store(
     store_id: str,
     store_data: StoreUpdate,
+    response: Response,
+    if_match: Optional[str] = Header(None),
     current_user: dict = Depends(require_roles(["admin", "manager"]))
 ):
     """
@@ -98,13 +116,17 @@ async def update_store(
     
     update_data["updated_at"] = datetime.utcnow()
     
-    result = await db.stores.update_one(
-        {"_id": ObjectId(store_id)},
-        {"$set": update_data}
+    updated = await db.stores.find_one_and_update(
+        {"_id": ObjectId(store_id), **version_filter(if_match)},
+        {"$set": update_data, "$inc": VERSION_BUMP},
+        projection={"version": 1},
+        return_document=ReturnDocument.AFTER
     )
     
-    if result.matched_count == 0:
-        raise HTTPException(status_code=404, detail="Store not found")
+    if not updated:
+        await raise_conflict_or_missing("stores", {"_id": ObjectId(store_id)}, "Store")
+    await change_tokens.bump("stores")
+    response.headers["ETag"] = etag(updated)
     
     return {"message": "Store updated successfully"}
 
@@ -118,10 +140,11 @@ async def delete_store(
     """
     result = await db.stores.update_one(
         {"_id": ObjectId(store_id)},
-        {"$set": {"status": "inactive", "updated_at": datetime.utcnow()}}
+        {"$set": {"status": "inactive", "updated_at": datetime.utcnow()}, "$inc": VERSION_BUMP}
     )
     
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Store not found")
+    await change_tokens.bump("stores")
     
     return {"message": "Store marked as inactive"}
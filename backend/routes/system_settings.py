@@ -1,34 +1,26 @@
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, Request, Response
 from datetime import datetime
 
 from models.system_settings import SystemSettingsUpdate, SystemSettingsResponse
 from auth.dependencies import get_current_user, require_roles
+from services import change_tokens
+from services import reference_data
 
 router = APIRouter(prefix="/settings", tags=["System Settings"])
 
 from database import db
 
 @router.get("", response_model=SystemSettingsResponse)
-async def get_settings(current_user: dict = Depends(get_current_user)):
+async def get_settings(request: Request, response: Response, current_user: dict = Depends(get_current_user)):
     """
-    Get system settings (creates default if not exists)
+    Get system settings
+    Defaults are created at startup, so reads never write.
     """
-    settings = await db.system_settings.find_one({})
+    cached = await change_tokens.conditional(request, response, "system_settings")
+    if cached:
+        return cached
     
-    if not settings:
-        # Create default settings
-        default_settings = {
-            "company_name": "Empresa",
-            "company_email": "geral@empresa.pt",
-            "company_phone": "",
-            "company_website": "",
-            "company_address": "",
-            "base_currency": "EUR",
-            "timezone": "Europe/Lisbon",
-            "updated_at": datetime.utcnow()
-        }
-        result = await db.system_settings.insert_one(default_settings)
-        settings = await db.system_settings.find_one({"_id": result.inserted_id})
+    settings = await reference_data.get_settings()
     
     return {
         "id": str(settings["_id"]),
@@ -66,16 +58,7 @@ async def update_settings(
         )
     else:
         # Create new with provided data
-        new_settings = {
-            "company_name": "Empresa",
-            "company_email": "geral@empresa.pt",
-            "company_phone": "",
-            "company_website": "",
-            "company_address": "",
-            "base_currency": "EUR",
-            "timezone": "Europe/Lisbon",
-            **update_data
-        }
-        await db.system_settings.insert_one(new_settings)
+        await db.system_settings.insert_one({**reference_data.DEFAULT_SETTINGS, **update_data})
+    await change_tokens.bump("system_settings")
     
     return {"message": "Settings updated successfully"}
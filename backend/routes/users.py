@@ -1,11 +1,13 @@
-from fastapi import APIRouter, HTTPException, status, Depends
-from typing import List
+from fastapi import APIRouter, HTTPException, status, Depends, Request, Response, Header
+from typing import List, Optional
 from bson import ObjectId
+from pymongo import ReturnDocument
 from datetime import datetime
 
 from models.user import UserCreate, UserUpdate, UserResponse
 from auth.password import hash_password
 from auth.dependencies import get_current_user, require_roles
+from services.concurrency import VERSION_BUMP, etag, version_filter, not_modified, raise_conflict_or_missing
 
 router = APIRouter(prefix="/users", tags=["Users"])
 
@@ -19,6 +21,7 @@ async def get_current_user_info(current_user: dict = Depends(get_current_user)):
     """
     return {
         "id": str(current_user["_id"]),
+        "version": current_user.get("version", 0),
         "name": current_user["name"],
         "email": current_user["email"],
         "role": current_user["role"],
@@ -40,6 +43,7 @@ async def get_users(current_user: dict = Depends(require_roles(["admin", "manage
     return [
         {
             "id": str(user["_id"]),
+            "version": user.get("version", 0),
             "name": user["name"],
             "email": user["email"],
             "role": user["role"],
@@ -55,7 +59,7 @@ async def get_users(current_user: dict = Depends(require_roles(["admin", "manage
     ]
 
 @router.get("/{user_id}", response_model=UserResponse)
-async def get_user(user_id: str, current_user: dict = Depends(get_current_user)):
+async def get_user(user_id: str, request: Request, response: Response, current_user: dict = Depends(get_current_user)):
     """
     Get user by ID
     """
@@ -63,8 +67,14 @@ async def get_user(user_id: str, current_user: dict = Depends(get_current_user))
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
+    cached = not_modified(request, user)
+    if cached:
+        return cached
+    response.headers["ETag"] = etag(user)
+    
     return {
         "id": str(user["_id"]),
+        "version": user.get("version", 0),
         "name": user["name"],
         "email": user["email"],
         "role": user["role"],
@@ -110,6 +120,8 @@ async def create_user(
 async def update_user(
     user_id: str,
     user_data: UserUpdate,
+    response: Response,
+    if_match: Optional[str] = Header(None),
     current_user: dict = Depends(get_current_user)
 ):
     """
@@ -130,13 +142,16 @@ async def update_user(
     update_data["updated_at"] = datetime.utcnow()
     
     from bson import ObjectId
-    result = await db.users.update_one(
-        {"_id": ObjectId(user_id)},
-        {"$set": update_data}
+    updated = await db.users.find_one_and_update(
+        {"_id": ObjectId(user_id), **version_filter(if_match)},
+        {"$set": update_data, "$inc": VERSION_BUMP},
+        projection={"version": 1},
+        return_document=ReturnDocument.AFTER
     )
     
-    if result.matched_count == 0:
-        raise HTTPException(status_code=404, detail="User not found")
+    if not updated:
+        await raise_conflict_or_missing("users", {"_id": ObjectId(user_id)}, "User")
+    response.headers["ETag"] = etag(updated)
     
     return {"message": "User updated successfully"}
 
@@ -151,7 +166,7 @@ async def delete_user(
     from bson import ObjectId
     result = await db.users.update_one(
         {"_id": ObjectId(user_id)},
-        {"$set": {"is_active": False, "updated_at": datetime.utcnow()}}
+        {"$set": {"is_active": False, "updated_at": datetime.utcnow()}, "$inc": VERSION_BUMP}
     )
     
     if result.matched_count == 0:
@@ -1,24 +1,33 @@
-from fastapi import APIRouter, HTTPException, status, Depends
-from typing import List
+from fastapi import APIRouter, HTTPException, status, Depends, Request, Response, Header
+from typing import List, Optional
 from datetime import datetime
 from bson import ObjectId
+from pymongo import ReturnDocument
 
 from models.warehouse import WarehouseCreate, WarehouseUpdate, WarehouseResponse
 from auth.dependencies import get_current_user, require_roles
+from services.concurrency import VERSION_BUMP, etag, version_filter, not_modified, raise_conflict_or_missing
+from services import change_tokens
+from services import reference_data
 
 router = APIRouter(prefix="/warehouses", tags=["Warehouses"])
 
 from database import db
 
 @router.get("", response_model=List[WarehouseResponse])
-async def get_warehouses(current_user: dict = Depends(get_current_user)):
+async def get_warehouses(request: Request, response: Response, current_user: dict = Depends(get_current_user)):
     """
     Get all warehouses
     """
-    warehouses = await db.warehouses.find().to_list(1000)
+    cached = await change_tokens.conditional(request, response, "warehouses")
+    if cached:
+        return cached
+    
+    warehouses = await reference_data.get_all("warehouses")
     return [
         {
             "id": str(wh["_id"]),
+            "version": wh.get("version", 0),
             "code": wh["code"],
             "name": wh["name"],
             "store_id": wh.get("store_id"),
@@ -30,16 +39,22 @@ async def get_warehouses(current_user: dict = Depends(get_current_user)):
     ]
 
 @router.get("/{warehouse_id}", response_model=WarehouseResponse)
-async def get_warehouse(warehouse_id: str, current_user: dict = Depends(get_current_user)):
+async def get_warehouse(warehouse_id: str, request: Request, response: Response, current_user: dict = Depends(get_current_user)):
     """
     Get warehouse by ID
     """
-    warehouse = await db.warehouses.find_one({"_id": ObjectId(warehouse_id)})
+    warehouse = await reference_data.get("warehouses", warehouse_id)
     if not warehouse:
         raise HTTPException(status_code=404, detail="Warehouse not found")
     
+    cached = not_modified(request, warehouse)
+    if cached:
+        return cached
+    response.headers["ETag"] = etag(warehouse)
+    
     return {
         "id": str(warehouse["_id"]),
+        "version": warehouse.get("version", 0),
         "code": warehouse["code"],
         "name": warehouse["name"],
         "store_id": warehouse.get("store_id"),
@@ -57,7 +72,7 @@ async def create_warehouse(
     Create a new warehouse
     """
     # Check if code already exists
-    existing_wh = await db.warehouses.find_one({"code": warehouse_data.code})
+    existing_wh = await reference_data.find_by("warehouses", "code", warehouse_data.code)
     if existing_wh:
         raise HTTPException(
             status_code=400,
@@ -69,6 +84,7 @@ async def create_warehouse(
     warehouse_dict["updated_at"] = datetime.utcnow()
     
     result = await db.warehouses.insert_one(warehouse_dict)
+    await change_tokens.bump("warehouses")
     
     return {
         "message": "Warehouse created successfully",
@@ -79,6 +95,8 @@ async def create_warehouse(
 async def update_warehouse(
     warehouse_id: str,
     warehouse_data: WarehouseUpdate,
+    response: Response,
+    if_match: Optional[str] = Header(None),
     current_user: dict = Depends(require_roles(["admin", "manager"]))
 ):
     """
@@ -90,13 +108,17 @@ async def update_warehouse(
     
     update_data["updated_at"] = datetime.utcnow()
     
-    result = await db.warehouses.update_one(
-        {"_id": ObjectId(warehouse_id)},
-        {"$set": update_data}
+    updated = await db.warehouses.find_one_and_update(
+        {"_id": ObjectId(warehouse_id), **version_filter(if_match)},
+        {"$set": update_data, "$inc": VERSION_BUMP},
+        projection={"version": 1},
+        return_document=ReturnDocument.AFTER
     )
     
-    if result.matched_count == 0:
-        raise HTTPException(status_code=404, detail="Warehouse not found")
+    if not updated:
+        await raise_conflict_or_missing("warehouses", {"_id": ObjectId(warehouse_id)}, "Warehouse")
+    await change_tokens.bump("warehouses")
+    response.headers["ETag"] = etag(updated)
     
     return {"message": "Warehouse updated successfully"}
 
@@ -110,10 +132,11 @@ async def delete_warehouse(
     """
     result = await db.warehouses.update_one(
         {"_id": ObjectId(warehouse_id)},
-        {"$set": {"status": "inactive", "updated_at": datetime.utcnow()}}
+        {"$set": {"status": "inactive", "updated_at": datetime.utcnow()}, "$inc": VERSION_BUMP}
     )
     
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Warehouse not found")
+    await change_tokens.bump("warehouses")
     
     return {"message": "Warehouse marked as inactive"}
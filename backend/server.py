@@ -3,11 +3,20 @@ from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
 import os
+import asyncio
 import logging
 from pathlib import Path
 
 # Import routes
-from routes import auth, users, leads, products, orders, invoices, stock_movements, accounts, dashboard, contacts, stores, cost_centers, system_settings, warehouses
+from database import ensure_replica_set, ensure_indexes
+from services.receivables import overdue_sweeper
+from services.lead_funnel import funnel_rebuilder
+from services.search import backfill_search_keys
+from services.lead_import import schedule_dedup_backfill
+from services.jobs import run_workers
+from services import reference_data
+import services.job_handlers  # noqa: F401 - registers job types
+from routes import auth, users, leads, products, orders, invoices, stock_movements, accounts, dashboard, contacts, stores, cost_centers, system_settings, warehouses, reports, search, jobs
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -43,6 +52,9 @@ api_router.include_router(stores.router)
 api_router.include_router(cost_centers.router)
 api_router.include_router(system_settings.router)
 api_router.include_router(warehouses.router)
+api_router.include_router(reports.router)
+api_router.include_router(search.router)
+api_router.include_router(jobs.router)
 
 # Include the router in the main app
 app.include_router(api_router)
@@ -63,6 +75,29 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+background_tasks = []
+
+@app.on_event("startup")
+async def create_indexes():
+    await ensure_replica_set()
+    await ensure_indexes()
+    await backfill_search_keys()
+    await schedule_dedup_backfill()
+    await reference_data.ensure_settings()
+    await reference_data.load_all()
+
+@app.on_event("startup")
+async def start_background_tasks():
+    background_tasks.append(asyncio.create_task(overdue_sweeper()))
+    background_tasks.append(asyncio.create_task(funnel_rebuilder()))
+    background_tasks.append(asyncio.create_task(reference_data.watch_changes()))
+    # In-process job workers; set IN_PROCESS_JOB_WORKERS=0 when running `python -m backend.worker`
+    in_process_workers = int(os.environ.get("IN_PROCESS_JOB_WORKERS", "1"))
+    if in_process_workers:
+        background_tasks.append(asyncio.create_task(run_workers(in_process_workers)))
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    for task in background_tasks:
+        task.cancel()
     client.close()
\ No newline at end of file
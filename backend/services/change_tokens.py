@@ -0,0 +1,75 @@
+"""
+Per-collection change tokens
+
+Every write to a token-tracked collection replaces the collection's token
+in change_tokens with a fresh unique value. List endpoints use the token as
+a weak ETag, so a client that already has the current list gets 304 Not
+Modified without the collection being read. Tokens are kept in memory and
+re-read from MongoDB at most every TOKEN_TTL_SECONDS, so other processes'
+writes are seen within that window and this process's own writes at once.
+"""
+import time
+from typing import Dict, Optional
+from bson import ObjectId
+from fastapi import Request, Response
+
+from database import db
+
+# "prices", "customers" and "ledger" are not collections: they cover product
+# writes that can change prices (not stock movements) for the price index,
+# bulk writes to orders, invoices or contacts that drop every cached customer
+# overview, and committed journal postings for the cached P&L
+TRACKED = ["products", "stores", "warehouses", "cost_centers", "system_settings", "accounts", "prices", "customers", "ledger"]
+
+TOKEN_TTL_SECONDS = 1.0
+
+_tokens: Dict[str, str] = {}
+_loaded_at = 0.0
+
+
+async def bump(collection: str):
+    """
+    Record a write to a tracked collection
+    Call it after the write commits, never inside a transaction: every write
+    to the collection updates the same token document, so concurrent
+    transactions would conflict on it.
+    """
+    # Unique tokens rather than a counter, so a token is never reissued
+    # for different data
+    token = str(ObjectId())
+    await db.change_tokens.update_one(
+        {"_id": collection},
+        {"$set": {"token": token}},
+        upsert=True
+    )
+    _tokens[collection] = token
+
+
+async def current(collection: str) -> str:
+    """Current token of a tracked collection"""
+    global _loaded_at
+    if time.monotonic() - _loaded_at > TOKEN_TTL_SECONDS:
+        _tokens.update({doc["_id"]: doc["token"] async for doc in db.change_tokens.find({"_id": {"$in": TRACKED}})})
+        _loaded_at = time.monotonic()
+    if collection not in _tokens:
+        await bump(collection)
+    return _tokens[collection]
+
+
+def etag(collection: str, token: str) -> str:
+    return f'W/"{collection}-{token}"'
+
+
+async def conditional(request: Request, response: Response, collection: str) -> Optional[Response]:
+    """
+    304 response if the client's If-None-Match has the collection's current token;
+    otherwise sets the ETag on `response` and returns None
+    """
+    tag = etag(collection, await current(collection))
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and any(
+        candidate.strip() in ("*", tag, tag[2:]) for candidate in if_none_match.split(",")
+    ):
+        return Response(status_code=304, headers={"ETag": tag})
+    response.headers["ETag"] = tag
+    return None
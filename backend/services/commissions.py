@@ -0,0 +1,83 @@
+"""
+Monthly commission buckets
+
+Approved orders are added to one small document per (period, salesperson,
+store) so commission reports never have to scan orders. Buckets are
+updated by an outbox subscriber to order.approved, at most once per order.
+"""
+from datetime import datetime
+
+from database import db
+from services.outbox import subscribe, apply_once
+
+# Order statuses that count as sold
+SOLD_STATUSES = ["approved", "invoiced", "completed"]
+
+
+def period_key(date: datetime) -> str:
+    """Month bucket key, e.g. '2026-10'"""
+    return f"{date.year:04d}-{date.month:02d}"
+
+
+async def record_order_commission(order: dict):
+    """Add an approved order to its monthly commission bucket, unless it already was"""
+    await apply_once(
+        "commission_buckets",
+        [(
+            {
+                "period": period_key(order["date"]),
+                "user_id": order["created_by"],
+                "store_id": order.get("store_id")
+            },
+            {
+                "$inc": {
+                    "total_commission": order.get("total_commission") or 0,
+                    "revenue": order.get("total") or 0,
+                    "order_count": 1
+                },
+                "$set": {"updated_at": datetime.utcnow()}
+            }
+        )],
+        str(order["_id"])
+    )
+
+
+@subscribe("order.approved", "commission_buckets")
+async def on_order_approved(event: dict):
+    await record_order_commission(event["payload"]["order"])
+
+
+async def rebuild_commission_buckets() -> int:
+    """Recompute every bucket from the orders collection"""
+    pipeline = [
+        {"$match": {"status": {"$in": SOLD_STATUSES}}},
+        {
+            "$group": {
+                "_id": {
+                    "period": {"$dateToString": {"format": "%Y-%m", "date": "$date"}},
+                    "user_id": "$created_by",
+                    "store_id": "$store_id"
+                },
+                "total_commission": {"$sum": {"$ifNull": ["$total_commission", 0]}},
+                "revenue": {"$sum": {"$ifNull": ["$total", 0]}},
+                "order_count": {"$sum": 1},
+                "applied": {"$addToSet": {"$toString": "$_id"}}
+            }
+        },
+        {
+            "$project": {
+                "_id": 0,
+                "period": "$_id.period",
+                "user_id": "$_id.user_id",
+                "store_id": {"$ifNull": ["$_id.store_id", None]},
+                "total_commission": 1,
+                "revenue": 1,
+                "order_count": 1,
+                "applied": 1,
+                "updated_at": "$$NOW"
+            }
+        },
+        {"$out": "commission_buckets"}
+    ]
+    await db.orders.aggregate(pipeline).to_list(None)
+    return await db.commission_buckets.count_documents({})
@@ -0,0 +1,83 @@
+"""
+Optimistic concurrency
+
+Versioned documents carry a `version` counter that every write increments;
+documents written before versioning count as version 0. GET responses
+expose the version as a strong ETag ("3"): a version identifies one state
+of the document, and If-Match requires strong comparison. Clients revalidate
+with If-None-Match (304 Not Modified) and send the tag back in If-Match to
+update only if nobody else changed the document meanwhile (409 Conflict
+otherwise). Weak tags (W/"3") issued by earlier releases are still accepted.
+"""
+from typing import Optional
+from fastapi import HTTPException, Request, Response
+
+from database import db
+
+# Merge into the $inc of every write to a versioned document
+VERSION_BUMP = {"version": 1}
+
+
+def etag(document: dict) -> str:
+    return f'"{document.get("version") or 0}"'
+
+
+def _version(value: str) -> Optional[int]:
+    """Version in an entity tag, weak or strong, or None if it is not a version tag"""
+    tag = value.strip()
+    if tag.startswith("W/"):
+        tag = tag[2:]
+    try:
+        return int(tag.strip('"'))
+    except ValueError:
+        return None
+
+
+def parse_etag(value: str) -> int:
+    """Version in an If-Match entity tag; 400 if it is not one of ours"""
+    version = _version(value)
+    if version is None:
+        raise HTTPException(status_code=400, detail=f"Invalid entity tag {value}")
+    return version
+
+
+def version_filter(if_match: Optional[str]) -> dict:
+    """Query condition making an update apply only to the version in If-Match"""
+    if not if_match or if_match.strip() == "*":
+        return {}
+    version = parse_etag(if_match)
+    if version == 0:
+        return {"version": {"$in": [0, None]}}
+    return {"version": version}
+
+
+def not_modified(request: Request, document: dict) -> Optional[Response]:
+    """304 response if the client's If-None-Match already has this version"""
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return None
+    current = document.get("version") or 0
+    tags = [tag for tag in if_none_match.split(",") if tag.strip()]
+    # Tags that are not versions (list tags, tags added by proxies) never match
+    if any(tag.strip() == "*" or _version(tag) == current for tag in tags):
+        return Response(status_code=304, headers={"ETag": etag(document)})
+    return None
+
+
+def check_version(document: dict, if_match: Optional[str], name: str):
+    """409 unless If-Match names the document's current version (for read-then-write updates)"""
+    if if_match and if_match.strip() != "*" and parse_etag(if_match) != (document.get("version") or 0):
+        raise HTTPException(
+            status_code=409,
+            detail=f"{name} was modified by another request; reload it and try again"
+        )
+
+
+async def raise_conflict_or_missing(collection: str, query: dict, name: str):
+    """After a conditional update matched nothing: 409 if the document exists, else 404"""
+    if await db[collection].count_documents(query, limit=1):
+        raise HTTPException(
+            status_code=409,
+            detail=f"{name} was modified by another request; reload it and try again"
+        )
+    raise HTTPException(status_code=404, detail=f"{name} not found")
@@ -0,0 +1,101 @@
+"""
+Customer credit exposure
+
+Each customer contact carries two counters maintained by the order and
+invoice routes: the open balance of its invoices and the total of approved
+orders not yet invoiced. Enforcing `credit_limit` is then one point read
+(or one conditional update) on the contact.
+"""
+from typing import Dict, Optional, Tuple
+from bson import ObjectId
+from pymongo import UpdateOne
+
+from database import db
+from services.concurrency import VERSION_BUMP
+
+OPEN_INVOICES = "exposure_open_invoices"
+UNINVOICED_ORDERS = "exposure_uninvoiced_orders"
+
+_exposure = {"$add": [{"$ifNull": [f"${OPEN_INVOICES}", 0]}, {"$ifNull": [f"${UNINVOICED_ORDERS}", 0]}]}
+
+
+def exposure(contact: dict) -> float:
+    return (contact.get(OPEN_INVOICES) or 0) + (contact.get(UNINVOICED_ORDERS) or 0)
+
+
+async def check_credit(customer_id: str, amount: float) -> Optional[str]:
+    """Why `amount` of new business would exceed the customer's credit limit, or None"""
+    if not ObjectId.is_valid(customer_id):
+        return None
+    contact = await db.contacts.find_one(
+        {"_id": ObjectId(customer_id)},
+        {"name": 1, "credit_limit": 1, OPEN_INVOICES: 1, UNINVOICED_ORDERS: 1}
+    )
+    if not contact or contact.get("credit_limit") is None:
+        return None
+    if exposure(contact) + amount > contact["credit_limit"]:
+        return (
+            f"Credit limit exceeded for {contact['name']}: "
+            f"limit {contact['credit_limit']:.2f}, exposure {exposure(contact):.2f}, order {amount:.2f}"
+        )
+    return None
+
+
+async def reserve_order(customer_id: str, amount: float, session=None) -> bool:
+    """
+    Add an approved order to the customer's exposure if it fits the credit limit.
+    Returns False, changing nothing, when it would exceed the limit.
+    """
+    if not ObjectId.is_valid(customer_id):
+        return True
+    result = await db.contacts.update_one(
+        {
+            "_id": ObjectId(customer_id),
+            "$or": [
+                {"credit_limit": None},
+                {"$expr": {"$lte": [{"$add": [_exposure, amount]}, "$credit_limit"]}}
+            ]
+        },
+        {"$inc": {UNINVOICED_ORDERS: amount, **VERSION_BUMP}},
+        session=session
+    )
+    if result.matched_count:
+        return True
+    # Customers without a contact record have no limit to enforce
+    return not await db.contacts.count_documents({"_id": ObjectId(customer_id)}, limit=1, session=session)
+
+
+async def adjust_exposure(deltas: Dict[str, Tuple[float, float]], session=None):
+    """Apply {customer_id: (open invoices delta, uninvoiced orders delta)} in one bulk write"""
+    operations = [
+        UpdateOne(
+            {"_id": ObjectId(customer_id)},
+            {"$inc": {OPEN_INVOICES: open_delta, UNINVOICED_ORDERS: uninvoiced_delta, **VERSION_BUMP}}
+        )
+        for customer_id, (open_delta, uninvoiced_delta) in deltas.items()
+        if ObjectId.is_valid(customer_id) and (open_delta or uninvoiced_delta)
+    ]
+    if operations:
+        await db.contacts.bulk_write(operations, ordered=False, session=session)
+
+
+async def rebuild_exposure() -> int:
+    """Recompute every customer's exposure from invoices and orders"""
+    open_invoices = await db.invoices.aggregate([
+        {"$match": {"status": {"$ne": "paid"}, "balance": {"$gt": 0}}},
+        {"$group": {"_id": "$customer_id", "amount": {"$sum": "$balance"}}}
+    ]).to_list(None)
+    uninvoiced = await db.orders.aggregate([
+        {"$match": {"status": "approved"}},
+        {"$group": {"_id": "$customer_id", "amount": {"$sum": "$total"}}}
+    ]).to_list(None)
+
+    totals: Dict[str, list] = {}
+    for row in open_invoices:
+        totals.setdefault(row["_id"], [0, 0])[0] = row["amount"]
+    for row in uninvoiced:
+        totals.setdefault(row["_id"], [0, 0])[1] = row["amount"]
+
+    await db.contacts.update_many({}, {"$set": {OPEN_INVOICES: 0, UNINVOICED_ORDERS: 0}, "$inc": VERSION_BUMP})
+    await adjust_exposure({customer_id: tuple(amounts) for customer_id, amounts in totals.items() if customer_id})
+    return len(totals)
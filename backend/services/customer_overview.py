@@ -0,0 +1,180 @@
+"""
+Customer 360 overview
+
+Orders, invoices, open balance and lifetime value of a customer, fetched
+concurrently and cached per customer. A write touching a customer replaces
+that customer's token in customer_tokens, which every read compares with
+the one its entry was built under, so only that customer's entries are
+dropped, in every process. Bulk writes (the overdue sweep, exposure
+rebuilds) bump the shared "customers" change token instead, dropping every
+entry. Entries also expire after OVERVIEW_TTL_SECONDS as a backstop.
+"""
+import asyncio
+import time
+from typing import Dict, Optional
+from bson import ObjectId
+from pymongo import UpdateOne
+
+from database import db
+from services.commissions import SOLD_STATUSES
+from services import change_tokens
+
+RECENT_LIMIT = 10
+OVERVIEW_TTL_SECONDS = 60
+TOKEN = "customers"
+
+# customer_id -> {"epoch", "token", "loaded_at", "overview"}
+_cache: Dict[str, dict] = {}
+
+
+async def invalidate(*customer_ids):
+    """Drop cached overviews of these customers, here and in other processes"""
+    customer_ids = {customer_id for customer_id in customer_ids if customer_id}
+    if not customer_ids:
+        return
+    for customer_id in customer_ids:
+        _cache.pop(customer_id, None)
+    await db.customer_tokens.bulk_write(
+        [
+            UpdateOne({"_id": customer_id}, {"$set": {"token": str(ObjectId())}}, upsert=True)
+            for customer_id in customer_ids
+        ],
+        ordered=False
+    )
+
+
+async def invalidate_all():
+    """Drop every cached overview, here and in other processes, after a bulk write"""
+    _cache.clear()
+    await change_tokens.bump(TOKEN)
+
+
+async def _customer_token(customer_id: str) -> Optional[str]:
+    document = await db.customer_tokens.find_one({"_id": customer_id})
+    return document["token"] if document else None
+
+
+async def _recent_orders(customer_id: str):
+    orders = await db.orders.find(
+        {"customer_id": customer_id},
+        {"order_number": 1, "date": 1, "status": 1, "total": 1}
+    ).sort("date", -1).limit(RECENT_LIMIT).to_list(RECENT_LIMIT)
+    return [
+        {
+            "id": str(order["_id"]),
+            "order_number": order["order_number"],
+            "date": order["date"],
+            "status": order["status"],
+            "total": order["total"]
+        }
+        for order in orders
+    ]
+
+
+async def _recent_invoices(customer_id: str):
+    invoices = await db.invoices.find(
+        {"customer_id": customer_id},
+        {"invoice_number": 1, "date": 1, "due_date": 1, "status": 1, "total": 1, "balance": 1}
+    ).sort("date", -1).limit(RECENT_LIMIT).to_list(RECENT_LIMIT)
+    return [
+        {
+            "id": str(invoice["_id"]),
+            "invoice_number": invoice["invoice_number"],
+            "date": invoice["date"],
+            "due_date": invoice["due_date"],
+            "status": invoice["status"],
+            "total": invoice["total"],
+            "balance": invoice["balance"]
+        }
+        for invoice in invoices
+    ]
+
+
+async def _open_balance(customer_id: str):
+    rows = await db.invoices.aggregate([
+        {"$match": {"customer_id": customer_id, "status": {"$ne": "paid"}, "balance": {"$gt": 0}}},
+        {
+            "$group": {
+                "_id": None,
+                "balance": {"$sum": "$balance"},
+                "count": {"$sum": 1},
+                "overdue": {"$sum": {"$cond": [{"$eq": ["$status", "overdue"]}, "$balance", 0]}}
+            }
+        }
+    ]).to_list(1)
+    row = rows[0] if rows else {"balance": 0, "count": 0, "overdue": 0}
+    return {
+        "balance": round(row["balance"], 2),
+        "overdue": round(row["overdue"], 2),
+        "open_invoices": row["count"]
+    }
+
+
+async def _lifetime_value(customer_id: str):
+    rows = await db.orders.aggregate([
+        {"$match": {"customer_id": customer_id, "status": {"$in": SOLD_STATUSES}}},
+        {
+            "$group": {
+                "_id": None,
+                "revenue": {"$sum": "$total"},
+                "orders": {"$sum": 1},
+                "first_order": {"$min": "$date"},
+                "last_order": {"$max": "$date"}
+            }
+        }
+    ]).to_list(1)
+    if not rows:
+        return {"revenue": 0, "orders": 0, "avg_order_value": 0, "first_order": None, "last_order": None}
+    row = rows[0]
+    return {
+        "revenue": round(row["revenue"], 2),
+        "orders": row["orders"],
+        "avg_order_value": round(row["revenue"] / row["orders"], 2),
+        "first_order": row["first_order"],
+        "last_order": row["last_order"]
+    }
+
+
+async def customer_overview(customer_id: str) -> Optional[dict]:
+    """Overview payload of a contact, served from cache when possible; None if not found"""
+    # Tokens are read before the data, so a write during the load leaves
+    # the entry under a stale token
+    epoch = await change_tokens.current(TOKEN)
+    token = await _customer_token(customer_id)
+    cached = _cache.get(customer_id)
+    if (
+        cached is not None
+        and cached["epoch"] == epoch
+        and cached["token"] == token
+        and time.monotonic() - cached["loaded_at"] < OVERVIEW_TTL_SECONDS
+    ):
+        return cached["overview"]
+
+    contact, orders, invoices, open_balance, lifetime = await asyncio.gather(
+        db.contacts.find_one({"_id": ObjectId(customer_id)}),
+        _recent_orders(customer_id),
+        _recent_invoices(customer_id),
+        _open_balance(customer_id),
+        _lifetime_value(customer_id)
+    )
+    if not contact:
+        return None
+
+    overview = {
+        "contact": {
+            "id": customer_id,
+            "name": contact["name"],
+            "trade_name": contact.get("trade_name"),
+            "nif": contact["nif"],
+            "email": contact["email"],
+            "phone": contact.get("phone"),
+            "credit_limit": contact.get("credit_limit"),
+            "status": contact["status"]
+        },
+        "open_balance": open_balance,
+        "lifetime_value": lifetime,
+        "recent_orders": orders,
+        "recent_invoices": invoices
+    }
+    _cache[customer_id] = {"epoch": epoch, "token": token, "loaded_at": time.monotonic(), "overview": overview}
+    return overview
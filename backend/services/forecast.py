@@ -0,0 +1,74 @@
+"""
+Weighted revenue forecast
+
+Every open or won lead contributes its expected revenue, weighted by
+probability, to one bucket per (salesperson, month). Buckets are adjusted
+incrementally as leads are created, updated and deleted, so the forecast
+never scans the leads collection. The month is the lead's expected close
+date, or its creation date when none is set.
+"""
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+from pymongo import UpdateOne
+
+from database import db
+from services.commissions import period_key
+
+# Lead fields that change a lead's forecast contribution
+FORECAST_FIELDS = {"stage", "probability", "expected_revenue", "assigned_to", "expected_close_date"}
+
+
+def contribution(lead: dict) -> Optional[Tuple[Tuple[str, str], dict]]:
+    """Bucket key and amounts a lead adds to the forecast; lost leads add nothing"""
+    stage = lead.get("stage")
+    if stage == "lost":
+        return None
+    won = stage == "won"
+    probability = 100 if won else lead.get("probability", 0)
+    revenue = lead.get("expected_revenue") or 0
+    key = (lead["assigned_to"], period_key(lead.get("expected_close_date") or lead["created_at"]))
+    return key, {
+        "lead_count": 1,
+        "pipeline": revenue,
+        "weighted": revenue * probability / 100,
+        "won": revenue if won else 0
+    }
+
+
+async def apply_forecast(removed: List[dict], added: List[dict], session=None):
+    """Move the contributions of `removed` lead states out of, and `added` ones into, the buckets"""
+    deltas: Dict[Tuple[str, str], dict] = {}
+    for leads, sign in ((removed, -1), (added, 1)):
+        for lead in leads:
+            entry = contribution(lead)
+            if entry is None:
+                continue
+            key, amounts = entry
+            bucket = deltas.setdefault(key, {name: 0 for name in amounts})
+            for name, amount in amounts.items():
+                bucket[name] += sign * amount
+
+    operations = [
+        UpdateOne(
+            {"user_id": user_id, "period": period},
+            {"$inc": amounts, "$set": {"updated_at": datetime.utcnow()}},
+            upsert=True
+        )
+        for (user_id, period), amounts in deltas.items()
+        if any(amounts.values())
+    ]
+    if operations:
+        await db.lead_forecasts.bulk_write(operations, ordered=False, session=session)
+
+
+async def rebuild_forecast() -> int:
+    """Recompute every bucket from the leads collection"""
+    await db.lead_forecasts.delete_many({})
+    batch = []
+    async for lead in db.leads.find({"stage": {"$ne": "lost"}}):
+        batch.append(lead)
+        if len(batch) >= 1000:
+            await apply_forecast([], batch)
+            batch = []
+    await apply_forecast([], batch)
+    return await db.lead_forecasts.count_documents({})
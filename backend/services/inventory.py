@@ -0,0 +1,138 @@
+"""
+Inventory costing
+
+Inbound stock movements open a FIFO cost layer (``unit_cost`` and
+``remaining_quantity`` on the movement) and fold their cost into the
+product's weighted-average cost (``avg_cost``). Outbound movements consume
+the oldest layers and are costed at the current average, so COGS only needs
+the product document.
+"""
+from datetime import datetime
+from typing import Optional
+from bson import ObjectId
+
+from database import db
+from services.outbox import event
+from services.concurrency import VERSION_BUMP
+
+
+def current_unit_cost(product: dict) -> float:
+    """Weighted-average cost of a product, falling back to the static cost"""
+    avg_cost = product.get("avg_cost")
+    if avg_cost is None:
+        avg_cost = product.get("cost")
+    return avg_cost or 0
+
+
+async def receive_stock(product: dict, quantity: int, unit_cost: Optional[float], session=None) -> float:
+    """
+    Add stock to a product and update its weighted-average cost.
+    Returns the unit cost recorded for the new layer.
+    """
+    if unit_cost is None:
+        unit_cost = current_unit_cost(product)
+
+    stock = {"$ifNull": ["$stock", 0]}
+    avg_cost = {"$ifNull": ["$avg_cost", {"$ifNull": ["$cost", 0]}]}
+    new_stock = {"$add": [stock, quantity]}
+
+    # Single pipeline update so concurrent receipts cannot lose each other's cost
+    await db.products.update_one(
+        {"_id": product["_id"]},
+        [
+            {
+                "$set": {
+                    "avg_cost": {
+                        "$cond": [
+                            {"$gt": [stock, 0]},
+                            {
+                                "$divide": [
+                                    {"$add": [{"$multiply": [stock, avg_cost]}, quantity * unit_cost]},
+                                    new_stock
+                                ]
+                            },
+                            unit_cost
+                        ]
+                    },
+                    "stock": new_stock,
+                    "version": {"$add": [{"$ifNull": ["$version", 0]}, 1]},
+                    "updated_at": datetime.utcnow()
+                }
+            }
+        ],
+        session=session
+    )
+    return unit_cost
+
+
+async def issue_stock(product_id: str, quantity: int, session=None) -> Optional[dict]:
+    """
+    Remove stock from a product and consume its FIFO layers.
+    Returns the costing of the issue, or None if there is not enough stock.
+    """
+    product = await db.products.find_one_and_update(
+        {"_id": ObjectId(product_id), "stock": {"$gte": quantity}},
+        {
+            "$inc": {"stock": -quantity, **VERSION_BUMP},
+            "$set": {"updated_at": datetime.utcnow()}
+        },
+        projection={"avg_cost": 1, "cost": 1},
+        session=session
+    )
+    if not product:
+        return None
+
+    unit_cost = current_unit_cost(product)
+    fifo_cost = await consume_layers(product_id, quantity, unit_cost, session=session)
+
+    return {
+        "unit_cost": unit_cost,
+        "total_cost": round(quantity * unit_cost, 2),
+        "fifo_cost": round(fifo_cost, 2)
+    }
+
+
+async def consume_layers(product_id: str, quantity: int, fallback_unit_cost: float, session=None) -> float:
+    """
+    Consume open cost layers oldest first and return their cost.
+    Stock received before layers existed is costed at the fallback unit cost.
+    """
+    remaining = quantity
+    cost = 0.0
+
+    layers = db.stock_movements.find(
+        {"product_id": product_id, "type": "in", "remaining_quantity": {"$gt": 0}},
+        {"remaining_quantity": 1, "unit_cost": 1},
+        session=session
+    ).sort("date", 1)
+
+    async for layer in layers:
+        if remaining <= 0:
+            break
+        take = min(layer["remaining_quantity"], remaining)
+        result = await db.stock_movements.update_one(
+            {"_id": layer["_id"], "remaining_quantity": {"$gte": take}},
+            {"$inc": {"remaining_quantity": -take}},
+            session=session
+        )
+        if result.modified_count:
+            remaining -= take
+            cost += take * (layer.get("unit_cost") or 0)
+
+    if remaining > 0:
+        cost += remaining * fallback_unit_cost
+
+    return cost
+
+
+def stock_moved(movement: dict) -> dict:
+    """Outbox event for a recorded stock movement"""
+    return event("stock.moved", {
+        "movement_id": str(movement["_id"]),
+        "product_id": movement["product_id"],
+        "type": movement["type"],
+        "quantity": movement["quantity"],
+        "unit_cost": movement.get("unit_cost"),
+        "total_cost": movement.get("total_cost"),
+        "reference": movement.get("reference")
+    })
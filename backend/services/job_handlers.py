@@ -0,0 +1,45 @@
+"""
+Job types run by the background workers
+
+Importing this module registers every handler, so both the API process and
+`python -m backend.worker` know the same job types.
+"""
+from services.jobs import register
+from services import lead_import  # noqa: F401 - registers leads.import
+from services import product_import  # noqa: F401 - registers products.import
+from services.commissions import rebuild_commission_buckets
+from services.sales_rollups import rebuild_sales_rollups
+from services.credit import rebuild_exposure
+from services.forecast import rebuild_forecast
+from services import customer_overview
+from services.lead_funnel import backfill_stage_events, rebuild_dirty_cohorts
+
+
+@register("commissions.rebuild")
+async def rebuild_commissions_job(job: dict, progress) -> dict:
+    return {"buckets": await rebuild_commission_buckets()}
+
+
+@register("sales_rollups.rebuild")
+async def rebuild_sales_rollups_job(job: dict, progress) -> dict:
+    return await rebuild_sales_rollups()
+
+
+@register("exposure.rebuild")
+async def rebuild_exposure_job(job: dict, progress) -> dict:
+    customers = await rebuild_exposure()
+    await customer_overview.invalidate_all()
+    return {"customers": customers}
+
+
+@register("forecast.rebuild")
+async def rebuild_forecast_job(job: dict, progress) -> dict:
+    return {"buckets": await rebuild_forecast()}
+
+
+@register("funnel.rebuild")
+async def rebuild_funnel_job(job: dict, progress) -> dict:
+    seeded = await backfill_stage_events()
+    await progress(seeded_leads=seeded)
+    cohorts = await rebuild_dirty_cohorts()
+    return {"seeded_leads": seeded, "cohorts": cohorts}
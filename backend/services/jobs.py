@@ -0,0 +1,163 @@
+"""
+Background job queue
+
+Jobs are documents in the jobs collection. Workers claim the oldest due job
+with a single find_one_and_update that sets a lease; a worker that dies
+leaves its lease to expire and the job is claimed again; while a handler
+runs, a heartbeat keeps renewing the lease. Failed jobs are
+retried with exponential backoff up to `max_attempts`. Handlers are
+registered per job type and report progress through the job document.
+"""
+import asyncio
+import logging
+import os
+import socket
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, Optional
+from bson import ObjectId
+from pymongo import ReturnDocument
+
+from database import db
+from services.outbox import run_dispatcher
+
+logger = logging.getLogger(__name__)
+
+LEASE_SECONDS = 60
+HEARTBEAT_SECONDS = LEASE_SECONDS / 3
+POLL_SECONDS = 2
+RETRY_BASE_SECONDS = 30
+
+# job type -> async handler(job, progress) returning the job result
+Handler = Callable[[dict, Callable[..., Awaitable[None]]], Awaitable[Optional[dict]]]
+handlers: Dict[str, Handler] = {}
+
+
+def register(job_type: str):
+    """Decorator registering the handler of a job type"""
+    def decorator(handler: Handler) -> Handler:
+        handlers[job_type] = handler
+        return handler
+    return decorator
+
+
+async def enqueue(job_type: str, payload: dict, user_id: str, max_attempts: int = 3) -> ObjectId:
+    """Queue a job and return its ID"""
+    now = datetime.utcnow()
+    result = await db.jobs.insert_one({
+        "type": job_type,
+        "payload": payload,
+        "status": "queued",
+        "attempts": 0,
+        "max_attempts": max_attempts,
+        "run_at": now,
+        "lease_until": None,
+        "worker_id": None,
+        "progress": {},
+        "result": None,
+        "error": None,
+        "created_by": user_id,
+        "created_at": now,
+        "updated_at": now
+    })
+    return result.inserted_id
+
+
+async def claim(worker_id: str) -> Optional[dict]:
+    """Lease the oldest due job, including running jobs whose lease expired"""
+    now = datetime.utcnow()
+    return await db.jobs.find_one_and_update(
+        {
+            "type": {"$in": list(handlers)},
+            "$or": [
+                {"status": "queued", "run_at": {"$lte": now}},
+                {"status": "running", "lease_until": {"$lt": now}}
+            ]
+        },
+        {
+            "$set": {
+                "status": "running",
+                "worker_id": worker_id,
+                "lease_until": now + timedelta(seconds=LEASE_SECONDS),
+                "started_at": now,
+                "updated_at": now
+            },
+            "$inc": {"attempts": 1}
+        },
+        sort=[("run_at", 1)],
+        return_document=ReturnDocument.AFTER
+    )
+
+
+async def _heartbeat(owned: dict):
+    """Renew the lease of a running job until cancelled"""
+    while True:
+        await asyncio.sleep(HEARTBEAT_SECONDS)
+        now = datetime.utcnow()
+        try:
+            await db.jobs.update_one(
+                {**owned, "status": "running"},
+                {"$set": {"lease_until": now + timedelta(seconds=LEASE_SECONDS), "updated_at": now}}
+            )
+        except Exception:
+            logger.exception("Could not renew the lease of job %s", owned["_id"])
+
+
+async def run_job(job: dict, worker_id: str):
+    """Run a claimed job and record its outcome"""
+    owned = {"_id": job["_id"], "worker_id": worker_id}
+
+    async def progress(**fields):
+        now = datetime.utcnow()
+        await db.jobs.update_one(owned, {"$set": {
+            **{f"progress.{name}": value for name, value in fields.items()},
+            "updated_at": now
+        }})
+
+    # Handlers need not report progress to keep their lease
+    heartbeat = asyncio.create_task(_heartbeat(owned))
+    try:
+        result = await handlers[job["type"]](job, progress)
+    except Exception as e:
+        logger.exception("Job %s (%s) failed on attempt %s", job["_id"], job["type"], job["attempts"])
+        now = datetime.utcnow()
+        if job["attempts"] < job["max_attempts"]:
+            update = {
+                "status": "queued",
+                "run_at": now + timedelta(seconds=RETRY_BASE_SECONDS * 2 ** (job["attempts"] - 1))
+            }
+        else:
+            update = {"status": "failed", "finished_at": now}
+        await db.jobs.update_one(owned, {"$set": {
+            **update, "error": str(e), "lease_until": None, "updated_at": now
+        }})
+        return
+    finally:
+        heartbeat.cancel()
+
+    now = datetime.utcnow()
+    await db.jobs.update_one(owned, {"$set": {
+        "status": "completed",
+        "result": result,
+        "error": None,
+        "lease_until": None,
+        "finished_at": now,
+        "updated_at": now
+    }})
+
+
+async def _worker_loop(worker_id: str):
+    while True:
+        job = await claim(worker_id)
+        if job is None:
+            await asyncio.sleep(POLL_SECONDS)
+            continue
+        await run_job(job, worker_id)
+
+
+async def run_workers(concurrency: int, name: Optional[str] = None):
+    """Run `concurrency` job workers and the outbox dispatcher until cancelled"""
+    name = name or f"{socket.gethostname()}:{os.getpid()}"
+    await asyncio.gather(
+        run_dispatcher(f"{name}:outbox"),
+        *(_worker_loop(f"{name}:{n}") for n in range(concurrency))
+    )
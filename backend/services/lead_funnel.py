@@ -0,0 +1,213 @@
+"""
+Lead stage history and conversion funnel
+
+Every stage a lead enters is appended to lead_stage_events together with the
+time spent in the previous stage. Events are grouped into monthly cohorts by
+the lead's creation date; each cohort has a precomputed rollup in
+lead_funnel_cohorts that is marked dirty when new events arrive and rebuilt
+from its events by a background sweep, so reading the funnel never scans
+raw events.
+"""
+import asyncio
+import logging
+from datetime import datetime
+from typing import List, Optional
+from pymongo import UpdateOne
+
+from database import db
+from services.commissions import period_key
+
+logger = logging.getLogger(__name__)
+
+# Stages in funnel order; "lost" is an exit, not a step
+FUNNEL_STAGES = ["new", "qualified", "proposition", "negotiation", "won"]
+
+FUNNEL_REBUILD_INTERVAL_SECONDS = 60
+BACKFILL_CHUNK_SIZE = 1000
+
+
+def stage_event(lead: dict, to_stage: str, user_id: str, date: Optional[datetime] = None) -> dict:
+    """
+    Event for `lead` (its state before the change) entering `to_stage`.
+    A lead without a stage is being created and records its initial stage.
+    """
+    date = date or datetime.utcnow()
+    from_stage = lead.get("stage")
+    entered_at = lead.get("stage_entered_at") or lead.get("created_at") or date
+    return {
+        "lead_id": str(lead["_id"]),
+        "cohort": period_key(lead.get("created_at") or date),
+        "assigned_to": lead.get("assigned_to"),
+        "from_stage": from_stage,
+        "to_stage": to_stage,
+        "dwell_seconds": (date - entered_at).total_seconds() if from_stage else None,
+        "changed_by": user_id,
+        "date": date
+    }
+
+
+async def record_stage_events(events: List[dict], session=None):
+    """Append stage events and mark their cohorts for rebuilding"""
+    if not events:
+        return
+    await db.lead_stage_events.insert_many(events, session=session)
+    cohorts = {event["cohort"] for event in events}
+    await db.lead_funnel_cohorts.bulk_write(
+        [
+            UpdateOne({"cohort": cohort}, {"$inc": {"revision": 1}}, upsert=True)
+            for cohort in cohorts
+        ],
+        ordered=False,
+        session=session
+    )
+
+
+def _median(field: str) -> dict:
+    """Median of a sorted array field"""
+    size = {"$size": f"${field}"}
+    return {
+        "$avg": [
+            {"$arrayElemAt": [f"${field}", {"$floor": {"$divide": [{"$subtract": [size, 1]}, 2]}}]},
+            {"$arrayElemAt": [f"${field}", {"$floor": {"$divide": [size, 2]}}]}
+        ]
+    }
+
+
+async def rebuild_cohort(cohort: str, revision: int) -> dict:
+    """Recompute one cohort's rollup from its events"""
+    result = await db.lead_stage_events.aggregate([
+        {"$match": {"cohort": cohort}},
+        {
+            "$facet": {
+                # Furthest funnel step each lead reached, and whether it was lost
+                "leads": [
+                    {
+                        "$group": {
+                            "_id": "$lead_id",
+                            "furthest": {"$max": {"$indexOfArray": [FUNNEL_STAGES, "$to_stage"]}},
+                            "lost": {"$max": {"$eq": ["$to_stage", "lost"]}}
+                        }
+                    },
+                    {
+                        "$group": {
+                            "_id": "$furthest",
+                            "count": {"$sum": 1},
+                            "lost": {"$sum": {"$cond": ["$lost", 1, 0]}}
+                        }
+                    }
+                ],
+                "dwell": [
+                    {"$match": {"from_stage": {"$ne": None}}},
+                    {"$sort": {"dwell_seconds": 1}},
+                    {"$group": {"_id": "$from_stage", "dwell": {"$push": "$dwell_seconds"}}},
+                    {"$project": {"exits": {"$size": "$dwell"}, "median_seconds": _median("dwell")}}
+                ]
+            }
+        }
+    ]).to_list(1)
+    facets = result[0]
+
+    furthest = {row["_id"]: row["count"] for row in facets["leads"]}
+    dwell = {row["_id"]: row for row in facets["dwell"]}
+
+    # A lead that reached a step also passed every earlier one
+    stages = []
+    reached = 0
+    for rank in range(len(FUNNEL_STAGES) - 1, -1, -1):
+        reached += furthest.get(rank, 0)
+        stage = FUNNEL_STAGES[rank]
+        stages.append({
+            "stage": stage,
+            "reached": reached,
+            "exits": dwell.get(stage, {}).get("exits", 0),
+            "median_dwell_seconds": dwell.get(stage, {}).get("median_seconds")
+        })
+    stages.reverse()
+
+    rollup = {
+        "leads": sum(row["count"] for row in facets["leads"]),
+        "lost": sum(row["lost"] for row in facets["leads"]),
+        "stages": stages,
+        "built_revision": revision,
+        "built_at": datetime.utcnow()
+    }
+    # A concurrent rebuild may already have stored a newer revision
+    await db.lead_funnel_cohorts.update_one(
+        {"cohort": cohort, "built_revision": {"$not": {"$gt": revision}}},
+        {"$set": rollup}
+    )
+    return {"cohort": cohort, "revision": revision, **rollup}
+
+
+async def rebuild_dirty_cohorts() -> int:
+    """Rebuild every cohort with events newer than its rollup"""
+    cohorts = await db.lead_funnel_cohorts.find(
+        {"$expr": {"$ne": ["$built_revision", "$revision"]}},
+        {"cohort": 1, "revision": 1}
+    ).to_list(None)
+    for cohort in cohorts:
+        await rebuild_cohort(cohort["cohort"], cohort["revision"])
+    return len(cohorts)
+
+
+async def funnel_rebuilder():
+    """Run rebuild_dirty_cohorts periodically until cancelled"""
+    while True:
+        try:
+            await rebuild_dirty_cohorts()
+        except Exception:
+            logger.exception("Funnel cohort rebuild failed")
+        await asyncio.sleep(FUNNEL_REBUILD_INTERVAL_SECONDS)
+
+
+async def funnel(start: Optional[str] = None, end: Optional[str] = None) -> List[dict]:
+    """Cohort rollups between two months, as last rebuilt"""
+    query = {}
+    if start or end:
+        query["cohort"] = {}
+        if start:
+            query["cohort"]["$gte"] = start
+        if end:
+            query["cohort"]["$lte"] = end
+
+    return await db.lead_funnel_cohorts.find(query).sort("cohort", 1).to_list(None)
+
+
+async def backfill_stage_events() -> int:
+    """Record the current stage of leads that have no history yet, then mark every cohort dirty"""
+    # Anti-join against the history, so no list of every known lead is built
+    unseeded = db.leads.aggregate([
+        {"$project": {"stage": 1, "assigned_to": 1, "created_at": 1}},
+        {
+            "$lookup": {
+                "from": "lead_stage_events",
+                "let": {"lead_id": {"$toString": "$_id"}},
+                "pipeline": [
+                    {"$match": {"$expr": {"$eq": ["$lead_id", "$$lead_id"]}}},
+                    {"$limit": 1},
+                    {"$project": {"_id": 1}}
+                ],
+                "as": "history"
+            }
+        },
+        {"$match": {"history": {"$size": 0}}}
+    ])
+    seeded = 0
+    events = []
+    async for lead in unseeded:
+        events.append(stage_event({**lead, "stage": None}, lead["stage"], "system", lead["created_at"]))
+        if len(events) >= BACKFILL_CHUNK_SIZE:
+            await db.lead_stage_events.insert_many(events)
+            seeded += len(events)
+            events = []
+    if events:
+        await db.lead_stage_events.insert_many(events)
+        seeded += len(events)
+    await db.lead_funnel_cohorts.update_many({}, {"$inc": {"revision": 1}})
+    cohorts = await db.lead_stage_events.distinct("cohort")
+    if cohorts:
+        await db.lead_funnel_cohorts.bulk_write(
+            [UpdateOne({"cohort": cohort}, {"$setOnInsert": {"revision": 1}}, upsert=True) for cohort in cohorts],
+            ordered=False
+        )
+    return seeded
@@ -0,0 +1,219 @@
+"""
+Bulk lead import
+
+Lead lists are streamed from CSV, normalized and deduplicated on a hashed
+key of the lead's email (unique index on leads.dedup_key), then inserted in
+unordered chunks. Uploads are stored in GridFS and imported by a job on the
+background queue, which reports progress per chunk. Leads that cannot take
+their key because another lead holds it are marked dedup_skipped.
+"""
+import csv
+import hashlib
+import io
+import re
+import tempfile
+from datetime import datetime
+from typing import List, Optional
+from bson import ObjectId
+from pydantic import ValidationError
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from motor.motor_asyncio import AsyncIOMotorGridFSBucket
+
+from database import db
+from models.lead import LeadCreate
+from services.search import search_keys
+from services.forecast import apply_forecast
+from services.lead_funnel import stage_event, record_stage_events
+from services.jobs import enqueue, register
+
+IMPORT_CHUNK_SIZE = 1000
+
+# Row errors kept on the job document; the rest are only counted
+MAX_REPORTED_ERRORS = 100
+
+DUPLICATE_KEY = 11000
+
+# migrations document recording that the one-off key backfill was queued
+DEDUP_BACKFILL = "lead_dedup_keys"
+
+import_files = AsyncIOMotorGridFSBucket(db, bucket_name="import_files")
+
+
+def normalize_email(email: str) -> str:
+    return email.strip().lower()
+
+
+def normalize_phone(phone: str) -> str:
+    """Digits only, in international form; 9-digit numbers are Portuguese"""
+    phone = phone.strip()
+    digits = re.sub(r"\D", "", phone)
+    if phone.startswith("+"):
+        return f"+{digits}"
+    if digits.startswith("00"):
+        return f"+{digits[2:]}"
+    if len(digits) == 9:
+        return f"+351{digits}"
+    return digits
+
+
+def dedup_key(email: str) -> str:
+    """Hash identifying a lead by its normalized email"""
+    return hashlib.sha1(normalize_email(email).encode("utf-8")).hexdigest()
+
+
+async def _key_leads(leads: List[dict], counts: dict):
+    skipped = []
+    try:
+        await db.leads.bulk_write(
+            [UpdateOne({"_id": lead["_id"]}, {"$set": {"dedup_key": dedup_key(lead["email"])}}) for lead in leads],
+            ordered=False
+        )
+    except BulkWriteError as e:
+        for error in e.details["writeErrors"]:
+            if error["code"] != DUPLICATE_KEY:
+                raise
+            skipped.append(leads[error["index"]]["_id"])
+    if skipped:
+        await db.leads.update_many({"_id": {"$in": skipped}}, {"$set": {"dedup_skipped": True}})
+    counts["keyed"] += len(leads) - len(skipped)
+    counts["skipped"] += len(skipped)
+
+
+async def backfill_dedup_keys() -> dict:
+    """Key leads written before dedup keys existed; duplicates among them are marked skipped"""
+    counts = {"keyed": 0, "skipped": 0}
+    leads = []
+    async for lead in db.leads.find(
+        {"dedup_key": {"$exists": False}, "dedup_skipped": {"$exists": False}},
+        {"email": 1}
+    ):
+        leads.append(lead)
+        if len(leads) >= IMPORT_CHUNK_SIZE:
+            await _key_leads(leads, counts)
+            leads = []
+    if leads:
+        await _key_leads(leads, counts)
+    return counts
+
+
+@register("leads.backfill_dedup_keys")
+async def backfill_dedup_keys_job(job: dict, progress) -> dict:
+    counts = await backfill_dedup_keys()
+    await db.migrations.update_one(
+        {"_id": DEDUP_BACKFILL},
+        {"$set": {"status": "done", "finished_at": datetime.utcnow()}}
+    )
+    return counts
+
+
+async def schedule_dedup_backfill():
+    """Queue the dedup key backfill once per database; leads written since carry a key or the skip mark"""
+    try:
+        await db.migrations.insert_one({"_id": DEDUP_BACKFILL, "status": "queued", "created_at": datetime.utcnow()})
+    except DuplicateKeyError:
+        return
+    await enqueue("leads.backfill_dedup_keys", {}, "system")
+
+
+def _reject(counts: dict, row: int, email: Optional[str], error: str):
+    counts["failed"] += 1
+    if len(counts["errors"]) < MAX_REPORTED_ERRORS:
+        counts["errors"].append({"row": row, "email": email, "error": error})
+
+
+async def _insert_chunk(chunk: List[dict], counts: dict):
+    """Insert a chunk of new leads, skipping those already present"""
+    keys = [lead["dedup_key"] for lead in chunk]
+    existing = set(await db.leads.distinct("dedup_key", {"dedup_key": {"$in": keys}}))
+    leads = [lead for lead in chunk if lead["dedup_key"] not in existing]
+    counts["duplicates"] += len(chunk) - len(leads)
+    if not leads:
+        return
+
+    # Leads imported concurrently by another job hit the unique index
+    failed = set()
+    try:
+        await db.leads.insert_many(leads, ordered=False)
+    except BulkWriteError as e:
+        for error in e.details["writeErrors"]:
+            if error["code"] != DUPLICATE_KEY:
+                raise
+            failed.add(error["index"])
+    counts["duplicates"] += len(failed)
+    inserted = [lead for index, lead in enumerate(leads) if index not in failed]
+    counts["inserted"] += len(inserted)
+
+    await apply_forecast([], inserted)
+    await record_stage_events([
+        stage_event({**lead, "stage": None}, lead["stage"], lead["assigned_to"], lead["created_at"])
+        for lead in inserted
+    ])
+
+
+@register("leads.import")
+async def import_leads_job(job: dict, progress) -> dict:
+    """Import the CSV stored for the job; retries re-read the file and skip rows already inserted"""
+    try:
+        counts = await _import_leads(job, progress)
+    except Exception:
+        # The upload is only needed for retries
+        if job["attempts"] >= job["max_attempts"]:
+            await import_files.delete(ObjectId(job["payload"]["file_id"]))
+        raise
+    await import_files.delete(ObjectId(job["payload"]["file_id"]))
+    return counts
+
+
+async def _import_leads(job: dict, progress) -> dict:
+    payload = job["payload"]
+    counts = {"processed": 0, "inserted": 0, "duplicates": 0, "failed": 0, "errors": []}
+    seen = set()
+    chunk = []
+
+    with tempfile.TemporaryFile() as spool:
+        await import_files.download_to_stream(ObjectId(payload["file_id"]), spool)
+        spool.seek(0)
+        reader = csv.DictReader(io.TextIOWrapper(spool, encoding="utf-8-sig", newline=""))
+        for row in reader:
+            counts["processed"] += 1
+            data = {k: v for k, v in row.items() if k and v not in (None, "")}
+            if data.get("email"):
+                data["email"] = normalize_email(data["email"])
+            if data.get("phone"):
+                data["phone"] = normalize_phone(data["phone"])
+            try:
+                lead = LeadCreate(**data).dict()
+            except ValidationError as e:
+                _reject(counts, reader.line_num, data.get("email"), "; ".join(
+                    f"{'.'.join(str(part) for part in error['loc'])}: {error['msg']}" for error in e.errors()
+                ))
+                continue
+
+            lead["dedup_key"] = dedup_key(lead["email"])
+            if lead["dedup_key"] in seen:
+                counts["duplicates"] += 1
+                continue
+            seen.add(lead["dedup_key"])
+
+            now = datetime.utcnow()
+            lead["assigned_to"] = lead.get("assigned_to") or job["created_by"]
+            lead["search_keys"] = search_keys("leads", lead)
+            lead["created_at"] = now
+            lead["updated_at"] = now
+            lead["stage_entered_at"] = now
+            chunk.append(lead)
+            if len(chunk) >= IMPORT_CHUNK_SIZE:
+                await _insert_chunk(chunk, counts)
+                chunk = []
+                await progress(**counts)
+
+    if chunk:
+        await _insert_chunk(chunk, counts)
+    return counts
+
+
+async def enqueue_lead_import(source, filename: Optional[str], user_id: str) -> ObjectId:
+    """Store an uploaded CSV and queue its import"""
+    file_id = await import_files.upload_from_stream(filename or "leads.csv", source)
+    return await enqueue("leads.import", {"file_id": str(file_id), "filename": filename}, user_id)
@@ -0,0 +1,210 @@
+"""
+General ledger posting and cost-center P&L
+
+Automatic postings reference accounts by chart-of-accounts code, resolved to
+the account's real ID through a cached code map, tagged with the "accounts"
+change token so account writes in any process reload it. Cached P&L summaries are
+tagged with the "ledger" change token, which is bumped once postings have
+committed, so postings from any process drop them; they also expire after
+PNL_TTL_SECONDS.
+"""
+import time
+from fastapi import HTTPException
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from database import db
+from services.commissions import period_key  # noqa: F401 - re-exported to routes
+from services import change_tokens
+
+# Chart of accounts codes used by automatic postings
+CASH = "1000"
+ACCOUNTS_RECEIVABLE = "1200"
+INVENTORY = "1500"
+REVENUE = "4000"
+COST_OF_GOODS_SOLD = "5000"
+
+# {"token", "by_code": {code: account}, "by_id": {id: account}}
+_chart: Optional[dict] = None
+
+PNL_TTL_SECONDS = 300
+TOKEN = "ledger"
+
+# (period, scope, key) -> {"token", "loaded_at", "summary"}
+_pnl_cache: Dict[Tuple[str, str, Optional[str]], dict] = {}
+
+
+async def get_chart() -> dict:
+    """Chart of accounts indexed by code and by ID, reloaded when the accounts token moves"""
+    global _chart
+    token = await change_tokens.current("accounts")
+    if _chart is None or _chart["token"] != token:
+        accounts = await db.accounts.find({}, {"code": 1, "name": 1, "type": 1}).to_list(None)
+        _chart = {
+            "token": token,
+            "by_code": {account["code"]: account for account in accounts},
+            "by_id": {str(account["_id"]): account for account in accounts}
+        }
+    return _chart
+
+
+async def invalidate_chart():
+    """Reload the chart of accounts in every process after an account write"""
+    global _chart
+    _chart = None
+    await change_tokens.bump("accounts")
+
+
+async def journal_line(
+    code: str,
+    description: str,
+    reference: str,
+    debit: float,
+    credit: float,
+    user_id: str,
+    cost_center_id: Optional[str] = None,
+    store_id: Optional[str] = None
+) -> dict:
+    """Build a posted journal entry against the account with the given code"""
+    global _chart
+    account = (await get_chart())["by_code"].get(code)
+    if not account:
+        # Accounts written outside the API (e.g. the seed script) bump no token
+        _chart = None
+        account = (await get_chart())["by_code"].get(code)
+    if not account:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Account with code {code} not found in chart of accounts"
+        )
+    return {
+        "date": datetime.utcnow(),
+        "reference": reference,
+        "description": description,
+        "account_id": str(account["_id"]),
+        "account_name": account["name"],
+        "debit": debit,
+        "credit": credit,
+        "status": "posted",
+        "cost_center_id": cost_center_id,
+        "store_id": store_id,
+        "created_by": user_id,
+        "created_at": datetime.utcnow()
+    }
+
+
+def period_bounds(period: str):
+    """First instant of the period and of the following month"""
+    year, month = (int(part) for part in period.split("-"))
+    start = datetime(year, month, 1)
+    end = datetime(year + 1, 1, 1) if month == 12 else datetime(year, month + 1, 1)
+    return start, end
+
+
+async def post_entries(entries: List[dict], session=None):
+    """
+    Insert journal entries and invalidate the cached P&L.
+    Inside a transaction, the caller invalidates with invalidate_pnl() once
+    it has committed, so a concurrent read cannot re-cache pre-commit totals.
+    """
+    if not entries:
+        return
+    await db.journal_entries.insert_many(entries, session=session)
+    if session is None:
+        await invalidate_pnl()
+
+
+async def invalidate_pnl():
+    """Drop cached P&L summaries in every process after postings commit"""
+    _pnl_cache.clear()
+    await change_tokens.bump(TOKEN)
+
+
+async def _cached_pnl(key: tuple, build):
+    # Read the token before the entries: postings committed during the
+    # aggregation bump it, so the result is cached under a stale token
+    token = await change_tokens.current(TOKEN)
+    cached = _pnl_cache.get(key)
+    if cached is not None and cached["token"] == token and time.monotonic() - cached["loaded_at"] < PNL_TTL_SECONDS:
+        return cached["summary"]
+    summary = await build()
+    _pnl_cache[key] = {"token": token, "loaded_at": time.monotonic(), "summary": summary}
+    return summary
+
+
+def _summarize(rows: List[dict], accounts: Dict[str, dict]) -> dict:
+    """Turn per-account debit/credit totals into revenue, expenses and net income"""
+    revenue = 0.0
+    expenses = 0.0
+    lines = []
+    for row in rows:
+        account = accounts.get(row["account_id"])
+        if not account or account["type"] not in ("revenue", "expense"):
+            continue
+        if account["type"] == "revenue":
+            amount = row["credit"] - row["debit"]
+            revenue += amount
+        else:
+            amount = row["debit"] - row["credit"]
+            expenses += amount
+        lines.append({
+            "account_id": row["account_id"],
+            "account_name": account["name"],
+            "type": account["type"],
+            "amount": round(amount, 2)
+        })
+    return {
+        "revenue": round(revenue, 2),
+        "expenses": round(expenses, 2),
+        "net_income": round(revenue - expenses, 2),
+        "accounts": lines
+    }
+
+
+async def _pnl_rows(period: str, match: dict, group_key: Optional[str] = None) -> List[dict]:
+    start, end = period_bounds(period)
+    group_id = {"account_id": "$account_id"}
+    if group_key:
+        group_id["key"] = f"${group_key}"
+    rows = await db.journal_entries.aggregate([
+        {"$match": {**match, "status": "posted", "date": {"$gte": start, "$lt": end}}},
+        {"$group": {"_id": group_id, "debit": {"$sum": "$debit"}, "credit": {"$sum": "$credit"}}}
+    ]).to_list(None)
+    return [
+        {
+            "account_id": row["_id"]["account_id"],
+            "key": row["_id"].get("key"),
+            "debit": row["debit"],
+            "credit": row["credit"]
+        }
+        for row in rows
+    ]
+
+
+async def cost_center_pnl(cost_center_id: str, period: str) -> dict:
+    """P&L of one cost center for a month, cached until new postings commit"""
+    async def build():
+        rows = await _pnl_rows(period, {"cost_center_id": cost_center_id})
+        return {"cost_center_id": cost_center_id, "period": period, **_summarize(rows, (await get_chart())["by_id"])}
+
+    return await _cached_pnl((period, "cost_center", cost_center_id), build)
+
+
+async def store_pnl_rollup(period: str) -> List[dict]:
+    """P&L of every store for a month in one aggregation, cached like cost_center_pnl"""
+    async def build():
+        rows = await _pnl_rows(period, {"store_id": {"$ne": None}}, group_key="store_id")
+        accounts = (await get_chart())["by_id"]
+
+        per_store: Dict[str, List[dict]] = {}
+        for row in rows:
+            per_store.setdefault(row["key"], []).append(row)
+
+        rollup = [
+            {"store_id": store_id, "period": period, **_summarize(store_rows, accounts)}
+            for store_id, store_rows in per_store.items()
+        ]
+        rollup.sort(key=lambda summary: summary["net_income"], reverse=True)
+        return rollup
+
+    return await _cached_pnl((period, "stores", None), build)
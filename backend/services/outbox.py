@@ -0,0 +1,149 @@
+"""
+Transactional outbox
+
+Write paths record domain events (order.approved, invoice.paid,
+stock.moved) in the outbox collection inside the same transaction as the
+change itself, so an event exists exactly when its change was committed.
+The dispatcher, run by the background workers, leases pending events and
+delivers them to the subscribers registered for their type. Each
+subscriber that succeeds is remembered on the event, so a retry only
+re-delivers to the subscribers that failed. Delivery is still at least
+once (a crash or an expired lease can repeat a subscriber), so subscribers
+that accumulate totals write through apply_once. Delivered events expire
+after DELIVERED_RETENTION_SECONDS.
+"""
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError
+
+from database import db
+
+logger = logging.getLogger(__name__)
+
+LEASE_SECONDS = 60
+POLL_SECONDS = 1
+RETRY_BASE_SECONDS = 10
+MAX_ATTEMPTS = 5
+DELIVERED_RETENTION_SECONDS = 7 * 24 * 60 * 60
+
+DUPLICATE_KEY = 11000
+
+# event type -> [(subscriber name, async handler(event))]
+subscribers: Dict[str, List[Tuple[str, Callable[[dict], Awaitable[None]]]]] = {}
+
+
+def subscribe(event_type: str, name: str):
+    """Decorator registering a named subscriber for an event type"""
+    def decorator(handler):
+        subscribers.setdefault(event_type, []).append((name, handler))
+        return handler
+    return decorator
+
+
+def event(event_type: str, payload: dict) -> dict:
+    now = datetime.utcnow()
+    return {
+        "type": event_type,
+        "payload": payload,
+        "status": "pending",
+        "attempts": 0,
+        "delivered": [],
+        "run_at": now,
+        "lease_until": None,
+        "created_at": now
+    }
+
+
+async def record_events(events: List[dict], session=None):
+    """Add events built with `event` to the outbox, normally inside the writer's transaction"""
+    if events:
+        await db.outbox.insert_many(events, session=session)
+
+
+async def apply_once(collection: str, updates: List[Tuple[dict, dict]], applied_id: str):
+    """
+    Apply upserting (filter, update) pairs at most once per `applied_id`.
+    Each document remembers the IDs applied to it in `applied`, so a
+    redelivered event matches nothing. Its upsert then collides with the
+    existing document on the collection's unique key and is retried without
+    upsert, which also covers two events creating the same document at once.
+    """
+    def operation(query: dict, update: dict, upsert: bool) -> UpdateOne:
+        return UpdateOne(
+            {**query, "applied": {"$ne": applied_id}},
+            {**update, "$addToSet": {"applied": applied_id}},
+            upsert=upsert
+        )
+
+    try:
+        await db[collection].bulk_write([operation(q, u, True) for q, u in updates], ordered=False)
+    except BulkWriteError as e:
+        retry = []
+        for error in e.details["writeErrors"]:
+            if error["code"] != DUPLICATE_KEY:
+                raise
+            retry.append(operation(*updates[error["index"]], False))
+        await db[collection].bulk_write(retry, ordered=False)
+
+
+async def claim(worker_id: str) -> Optional[dict]:
+    """Lease the oldest due event, including events whose lease expired"""
+    now = datetime.utcnow()
+    return await db.outbox.find_one_and_update(
+        {
+            "$or": [
+                {"status": "pending", "run_at": {"$lte": now}},
+                {"status": "processing", "lease_until": {"$lt": now}}
+            ]
+        },
+        {
+            "$set": {
+                "status": "processing",
+                "worker_id": worker_id,
+                "lease_until": now + timedelta(seconds=LEASE_SECONDS)
+            },
+            "$inc": {"attempts": 1}
+        },
+        sort=[("run_at", 1)],
+        return_document=ReturnDocument.AFTER
+    )
+
+
+async def deliver(outbox_event: dict):
+    """Deliver a claimed event to every subscriber it has not reached yet"""
+    owned = {"_id": outbox_event["_id"], "worker_id": outbox_event["worker_id"]}
+    try:
+        for name, handler in subscribers.get(outbox_event["type"], []):
+            if name in outbox_event["delivered"]:
+                continue
+            await handler(outbox_event)
+            await db.outbox.update_one(owned, {"$addToSet": {"delivered": name}})
+    except Exception as e:
+        logger.exception("Delivering %s %s failed", outbox_event["type"], outbox_event["_id"])
+        now = datetime.utcnow()
+        if outbox_event["attempts"] < MAX_ATTEMPTS:
+            update = {
+                "status": "pending",
+                "run_at": now + timedelta(seconds=RETRY_BASE_SECONDS * 2 ** (outbox_event["attempts"] - 1))
+            }
+        else:
+            update = {"status": "failed"}
+        await db.outbox.update_one(owned, {"$set": {**update, "error": str(e), "lease_until": None}})
+        return
+
+    await db.outbox.update_one(owned, {"$set": {
+        "status": "delivered", "lease_until": None, "delivered_at": datetime.utcnow()
+    }})
+
+
+async def run_dispatcher(worker_id: str):
+    """Deliver outbox events until cancelled"""
+    while True:
+        outbox_event = await claim(worker_id)
+        if outbox_event is None:
+            await asyncio.sleep(POLL_SECONDS)
+            continue
+        await deliver(outbox_event)
@@ -0,0 +1,146 @@
+"""
+Invoice payments
+
+Each payment is stored in the payments collection, applied to its invoice
+with an atomic $inc on paid/balance and posted as its own cash/receivables
+journal entry. Remittances apply many payments in one transaction, which
+also records invoice.paid for every invoice it settles.
+"""
+from datetime import datetime
+from typing import List, Optional
+from bson import ObjectId
+from pymongo import UpdateOne
+
+from database import db, run_transaction
+from services import ledger
+from services.credit import adjust_exposure
+from services import customer_overview
+from services.outbox import event, record_events
+from services.concurrency import VERSION_BUMP
+
+# Balances are floats; anything below half a cent counts as settled
+BALANCE_TOLERANCE = 0.005
+
+# Only issued, unsettled invoices take payments
+PAYABLE_STATUSES = ["sent", "overdue"]
+
+
+def payment_error(invoice: dict, amount: float) -> Optional[str]:
+    """Why a payment cannot be applied to an invoice, or None if it can"""
+    if invoice["status"] == "paid":
+        return f"Invoice {invoice['invoice_number']} is already paid"
+    if invoice["status"] not in PAYABLE_STATUSES:
+        return f"Invoice {invoice['invoice_number']} is {invoice['status']}; only sent or overdue invoices can be paid"
+    if amount > invoice["balance"] + BALANCE_TOLERANCE:
+        return f"Payment of {amount:.2f} exceeds balance {invoice['balance']:.2f} of invoice {invoice['invoice_number']}"
+    return None
+
+
+async def apply_payments(
+    applications: List[dict],
+    user_id: str,
+    method: str = "transfer",
+    reference: Optional[str] = None,
+    date: Optional[datetime] = None
+) -> List[dict]:
+    """
+    Apply payments to invoices in one transaction and return the payment records.
+    `applications` items are {"invoice": invoice document, "amount": float, "reference": optional str},
+    optionally with "guard" (extra filter on the invoice, e.g. its If-Match version)
+    and "set" (fields to update on the invoice together with the payment).
+    Raises ValueError, recording nothing, if an invoice changed concurrently.
+    """
+    now = datetime.utcnow()
+    date = date or now
+
+    # Several lines may pay the same invoice; guard the balance with their sum
+    per_invoice = {}
+    guards = {}
+    fields = {}
+    for application in applications:
+        invoice_id = application["invoice"]["_id"]
+        per_invoice[invoice_id] = round(per_invoice.get(invoice_id, 0) + application["amount"], 2)
+        guards.setdefault(invoice_id, {}).update(application.get("guard") or {})
+        fields.setdefault(invoice_id, {}).update(application.get("set") or {})
+
+    operations = [
+        UpdateOne(
+            {"_id": invoice_id, "balance": {"$gte": amount - BALANCE_TOLERANCE}, **guards[invoice_id]},
+            {"$inc": {"paid": amount, "balance": -amount, **VERSION_BUMP}, "$set": {**fields[invoice_id], "updated_at": now}}
+        )
+        for invoice_id, amount in per_invoice.items()
+    ]
+
+    # Tag postings with the store and cost center of the invoiced orders
+    order_ids = [ObjectId(a["invoice"]["order_id"]) for a in applications if ObjectId.is_valid(a["invoice"]["order_id"])]
+    orders = await db.orders.find({"_id": {"$in": order_ids}}, {"store_id": 1, "cost_center_id": 1}).to_list(None)
+    orders = {str(order["_id"]): order for order in orders}
+
+    payments = []
+    entries = []
+    exposure_deltas = {}
+    for application in applications:
+        invoice = application["invoice"]
+        amount = application["amount"]
+        payment_reference = application.get("reference") or reference
+        payments.append({
+            "invoice_id": str(invoice["_id"]),
+            "invoice_number": invoice["invoice_number"],
+            "customer_id": invoice["customer_id"],
+            "amount": amount,
+            "method": method,
+            "reference": payment_reference,
+            "date": date,
+            "created_by": user_id,
+            "created_at": now
+        })
+
+        open_delta, _ = exposure_deltas.get(invoice["customer_id"], (0, 0))
+        exposure_deltas[invoice["customer_id"]] = (open_delta - amount, 0)
+
+        order = orders.get(invoice["order_id"], {})
+        tags = {"cost_center_id": order.get("cost_center_id"), "store_id": order.get("store_id")}
+        description = f"Payment received from {invoice['customer_name']}"
+        entries += [
+            await ledger.journal_line(ledger.CASH, description, invoice["invoice_number"], amount, 0, user_id, **tags),
+            await ledger.journal_line(ledger.ACCOUNTS_RECEIVABLE, description, invoice["invoice_number"], 0, amount, user_id, **tags)
+        ]
+
+    async def record(session):
+        result = await db.invoices.bulk_write(operations, ordered=False, session=session)
+        if result.modified_count != len(operations):
+            raise ValueError("An invoice changed while applying payments; nothing was recorded")
+
+        await db.payments.insert_many(payments, session=session)
+        await ledger.post_entries(entries, session=session)
+        await adjust_exposure(exposure_deltas, session=session)
+        settled = await db.invoices.find(
+            {"_id": {"$in": list(per_invoice)}, "balance": {"$lte": BALANCE_TOLERANCE}, "status": {"$ne": "paid"}},
+            {"invoice_number": 1, "customer_id": 1, "order_id": 1, "total": 1},
+            session=session
+        ).to_list(None)
+        if settled:
+            await db.invoices.update_many(
+                {"_id": {"$in": [invoice["_id"] for invoice in settled]}},
+                {"$set": {"status": "paid", "balance": 0}, "$inc": VERSION_BUMP},
+                session=session
+            )
+            await record_events(
+                [
+                    event("invoice.paid", {
+                        "invoice_id": str(invoice["_id"]),
+                        "invoice_number": invoice["invoice_number"],
+                        "customer_id": invoice["customer_id"],
+                        "order_id": invoice["order_id"],
+                        "total": invoice["total"]
+                    })
+                    for invoice in settled
+                ],
+                session=session
+            )
+
+    await run_transaction(record)
+    await ledger.invalidate_pnl()
+    await customer_overview.invalidate(*exposure_deltas)
+
+    return payments
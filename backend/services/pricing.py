@@ -0,0 +1,125 @@
+"""
+Price index
+
+Maps (variant_id, tier) to the variant's price and commission, and keeps the
+legacy product-level price for products without variants, so order entry can
+resolve prices without loading full product documents. The index is built
+lazily from MongoDB and tagged with the "prices" change token, which every
+product write bumps, so a write in any process makes every process reload it.
+"""
+import asyncio
+from typing import Dict, List, Optional, Tuple
+
+from database import db
+from services import change_tokens
+
+DEFAULT_TIER = "normal"
+TOKEN = "prices"
+
+_index: Optional[dict] = None
+_index_token: Optional[str] = None
+_lock = asyncio.Lock()
+
+
+async def _load_index() -> dict:
+    tiers: Dict[Tuple[str, str], dict] = {}
+    products: Dict[str, dict] = {}
+    cursor = db.products.find(
+        {},
+        {"name": 1, "price": 1, "variants.variant_id": 1, "variants.name": 1, "variants.price_tiers": 1}
+    )
+    async for product in cursor:
+        product_id = str(product["_id"])
+        products[product_id] = {"name": product.get("name"), "price": product.get("price")}
+        for variant in product.get("variants") or []:
+            variant_id = variant.get("variant_id")
+            if not variant_id:
+                continue
+            for tier in variant.get("price_tiers", []):
+                tiers[(variant_id, tier["name"])] = {
+                    "product_id": product_id,
+                    "variant_name": variant.get("name"),
+                    "price": tier["price"],
+                    "commission_percent": tier["commission_percent"]
+                }
+    return {"tiers": tiers, "products": products}
+
+
+async def get_price_index() -> dict:
+    """Return the price index, reloading it when the prices token has moved"""
+    global _index, _index_token
+    # Read the token before the products: a write during the load leaves
+    # the new copy tagged with the old token, so it is reloaded next time
+    token = await change_tokens.current(TOKEN)
+    if _index is not None and _index_token == token:
+        return _index
+
+    async with _lock:
+        if _index is None or _index_token != token:
+            _index = await _load_index()
+            _index_token = token
+        return _index
+
+
+async def invalidate():
+    """Drop the price index in every process after a product write"""
+    global _index
+    _index = None
+    await change_tokens.bump(TOKEN)
+
+
+async def resolve_prices(variant_ids, tier: str) -> Dict[str, dict]:
+    """Resolve the price and commission of each variant for a tier"""
+    tiers = (await get_price_index())["tiers"]
+    resolved = {}
+    for variant_id in variant_ids:
+        entry = tiers.get((variant_id, tier))
+        if entry is not None:
+            resolved[variant_id] = entry
+    return resolved
+
+
+async def price_order_items(items: List[dict]) -> Tuple[List[dict], float, float]:
+    """
+    Price order items from the catalog, ignoring client-sent prices.
+    Returns the priced items, the order total and the total commission.
+    Raises ValueError when an item cannot be priced.
+    """
+    index = await get_price_index()
+    total = 0.0
+    total_commission = 0.0
+    priced = []
+
+    for item in items:
+        product = index["products"].get(item["product_id"])
+        if product is None:
+            raise ValueError(f"Product {item.get('product_name') or item['product_id']} not found")
+
+        if item.get("variant_id"):
+            tier = item.get("price_tier_name") or DEFAULT_TIER
+            entry = index["tiers"].get((item["variant_id"], tier))
+            if entry is None or entry["product_id"] != item["product_id"]:
+                raise ValueError(f"No '{tier}' price for variant {item['variant_id']} of {product['name']}")
+            price = entry["price"]
+            commission_percent = entry["commission_percent"]
+            item = {**item, "variant_name": entry["variant_name"] or item.get("variant_name"), "price_tier_name": tier}
+        else:
+            if product["price"] is None:
+                raise ValueError(f"Product {product['name']} has no price")
+            price = product["price"]
+            commission_percent = 0
+
+        line_total = item["quantity"] * price
+        commission_value = round(line_total * commission_percent / 100, 2)
+        total += line_total
+        total_commission += commission_value
+
+        priced.append({
+            **item,
+            "product_name": product["name"],
+            "price": price,
+            "commission_percent": commission_percent,
+            "commission_value": commission_value
+        })
+
+    return priced, round(total, 2), round(total_commission, 2)
@@ -0,0 +1,190 @@
+"""
+Bulk product import
+
+Catalogues are read from CSV or NDJSON, validated per row and upserted by
+SKU in unordered chunks. Uploads are stored in GridFS and imported by a job
+on the background queue, which reports progress per chunk. Stock is not
+imported: quantities only change through stock movements, which keep
+avg_cost in step.
+"""
+import csv
+import io
+import json
+import tempfile
+from datetime import datetime
+from typing import List, Optional
+from bson import ObjectId
+from pydantic import ValidationError
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from motor.motor_asyncio import AsyncIOMotorGridFSBucket
+
+from database import db
+from models.product import ProductCreate
+from services import pricing, change_tokens
+from services.search import search_keys
+from services.concurrency import VERSION_BUMP
+from services.jobs import enqueue, register
+
+IMPORT_CHUNK_SIZE = 1000
+
+# Row errors kept on the job document; the rest are only counted
+MAX_REPORTED_ERRORS = 100
+
+# Columns the import never writes
+IGNORED_COLUMNS = ("stock",)
+
+import_files = AsyncIOMotorGridFSBucket(db, bucket_name="import_files")
+
+
+def assign_variant_ids(product_dict: dict, stable: bool = False):
+    """Gerar IDs para variantes se não tiverem"""
+    for i, variant in enumerate(product_dict.get("variants") or []):
+        if not variant.get("variant_id"):
+            if stable:
+                # IDs derivados do SKU para que reimportações não alterem as variantes
+                variant["variant_id"] = f"{product_dict['sku']}-VAR-{i+1:03d}"
+            else:
+                variant["variant_id"] = f"VAR-{i+1:03d}-{datetime.utcnow().timestamp()}"
+
+
+def format_validation_error(error: ValidationError) -> str:
+    """Flatten a pydantic validation error into one line"""
+    return "; ".join(
+        f"{'.'.join(str(part) for part in err['loc'])}: {err['msg']}"
+        for err in error.errors()
+    )
+
+
+def iter_import_rows(stream, file_format: str):
+    """
+    Stream rows from a CSV or NDJSON text stream as (row_number, data, error).
+    CSV cells are strings; the optional `variants` column holds JSON.
+    """
+    if file_format == "ndjson":
+        for row_number, line in enumerate(stream, start=1):
+            if not line.strip():
+                continue
+            try:
+                yield row_number, json.loads(line), None
+            except json.JSONDecodeError as e:
+                yield row_number, None, f"Invalid JSON: {e.msg}"
+    else:
+        reader = csv.DictReader(stream)
+        for row in reader:
+            # Header is line 1, so data rows start at 2 like in a spreadsheet
+            row_number = reader.line_num
+            data = {k: v for k, v in row.items() if k and v not in (None, "")}
+            if "variants" in data:
+                try:
+                    data["variants"] = json.loads(data["variants"])
+                except json.JSONDecodeError as e:
+                    yield row_number, None, f"Invalid variants JSON: {e.msg}"
+                    continue
+            yield row_number, data, None
+
+
+def _reject(counts: dict, row: int, sku: Optional[str], error: str):
+    counts["failed"] += 1
+    if len(counts["errors"]) < MAX_REPORTED_ERRORS:
+        counts["errors"].append({"row": row, "sku": sku, "error": error})
+
+
+async def upsert_product_chunk(chunk: List[tuple], counts: dict):
+    """Apply a chunk of validated products as unordered SKU-keyed upserts"""
+    now = datetime.utcnow()
+    operations = []
+    for _, product, defaults in chunk:
+        product["updated_at"] = now
+        on_insert = {**defaults, "created_at": now}
+        if "cost" in product:
+            on_insert["avg_cost"] = product["cost"]
+        operations.append(
+            UpdateOne(
+                {"sku": product["sku"]},
+                {"$set": product, "$setOnInsert": on_insert, "$inc": VERSION_BUMP},
+                upsert=True
+            )
+        )
+
+    try:
+        result = await db.products.bulk_write(operations, ordered=False)
+        details = result.bulk_api_result
+    except BulkWriteError as e:
+        details = e.details
+        for write_error in details.get("writeErrors", []):
+            row_number, product, _ = chunk[write_error["index"]]
+            _reject(counts, row_number, product["sku"], write_error.get("errmsg", "Write failed"))
+
+    counts["inserted"] += details.get("nUpserted", 0)
+    counts["updated"] += details.get("nModified", 0)
+
+
+@register("products.import")
+async def import_products_job(job: dict, progress) -> dict:
+    """Import the file stored for the job; retries re-read it and upsert the same SKUs again"""
+    try:
+        counts = await _import_products(job, progress)
+    except Exception:
+        # The upload is only needed for retries
+        if job["attempts"] >= job["max_attempts"]:
+            await import_files.delete(ObjectId(job["payload"]["file_id"]))
+        raise
+    await import_files.delete(ObjectId(job["payload"]["file_id"]))
+    return counts
+
+
+async def _import_products(job: dict, progress) -> dict:
+    payload = job["payload"]
+    counts = {"processed": 0, "inserted": 0, "updated": 0, "failed": 0, "errors": []}
+    chunk = []
+
+    with tempfile.TemporaryFile() as spool:
+        await import_files.download_to_stream(ObjectId(payload["file_id"]), spool)
+        spool.seek(0)
+        stream = io.TextIOWrapper(spool, encoding="utf-8-sig", newline="")
+        for row_number, data, error in iter_import_rows(stream, payload["format"]):
+            counts["processed"] += 1
+            if error:
+                _reject(counts, row_number, None, error)
+                continue
+            if not isinstance(data, dict):
+                _reject(counts, row_number, None, "Row must be an object")
+                continue
+            for column in IGNORED_COLUMNS:
+                data.pop(column, None)
+            try:
+                product = ProductCreate(**data)
+            except ValidationError as e:
+                _reject(counts, row_number, data.get("sku"), format_validation_error(e))
+                continue
+
+            # Only columns present in the file overwrite existing products;
+            # defaults are applied when the SKU is new
+            product_dict = product.dict(exclude_unset=True)
+            defaults = {k: v for k, v in product.dict().items() if k not in product_dict and k not in IGNORED_COLUMNS}
+            if "variants" in product_dict:
+                product_dict["variants"] = [variant.dict() for variant in product.variants]
+            assign_variant_ids(product_dict, stable=True)
+            product_dict["search_keys"] = search_keys("products", product_dict)
+            chunk.append((row_number, product_dict, defaults))
+            if len(chunk) >= IMPORT_CHUNK_SIZE:
+                await upsert_product_chunk(chunk, counts)
+                chunk = []
+                await progress(**counts)
+
+    if chunk:
+        await upsert_product_chunk(chunk, counts)
+    await pricing.invalidate()
+    await change_tokens.bump("products")
+    return counts
+
+
+async def enqueue_product_import(source, filename: Optional[str], file_format: str, user_id: str) -> ObjectId:
+    """Store an uploaded catalogue and queue its import"""
+    file_id = await import_files.upload_from_stream(filename or f"products.{file_format}", source)
+    return await enqueue(
+        "products.import",
+        {"file_id": str(file_id), "filename": filename, "format": file_format},
+        user_id
+    )
@@ -0,0 +1,104 @@
+"""
+Accounts receivable
+
+Flips sent invoices past their due date to overdue on a schedule and
+builds the aging report.
+"""
+import asyncio
+import logging
+from datetime import datetime
+
+from database import db
+from services.concurrency import VERSION_BUMP
+from services import customer_overview
+
+logger = logging.getLogger(__name__)
+
+OVERDUE_SWEEP_INTERVAL_SECONDS = 60 * 60
+
+# Aging buckets by days past due; invoices not yet due fall in the first one
+AGING_BOUNDARIES = [0, 31, 61, 91]
+AGING_LABELS = {0: "0-30", 31: "31-60", 61: "61-90", "90+": "90+"}
+
+# Key of AGING_LABELS for an invoice's days_past_due
+AGING_BUCKET = {
+    "$switch": {
+        "branches": [
+            {"case": {"$lt": ["$days_past_due", upper]}, "then": lower}
+            for lower, upper in zip(AGING_BOUNDARIES, AGING_BOUNDARIES[1:])
+        ],
+        "default": "90+"
+    }
+}
+
+
+async def mark_overdue_invoices() -> int:
+    """Mark every sent invoice past its due date as overdue"""
+    now = datetime.utcnow()
+    result = await db.invoices.update_many(
+        {"status": "sent", "due_date": {"$lt": now}},
+        {"$set": {"status": "overdue", "updated_at": now}, "$inc": VERSION_BUMP}
+    )
+    if result.modified_count:
+        await customer_overview.invalidate_all()
+    return result.modified_count
+
+
+async def overdue_sweeper():
+    """Run mark_overdue_invoices periodically until cancelled"""
+    while True:
+        try:
+            marked = await mark_overdue_invoices()
+            if marked:
+                logger.info("Marked %d invoices as overdue", marked)
+        except Exception:
+            logger.exception("Overdue invoice sweep failed")
+        await asyncio.sleep(OVERDUE_SWEEP_INTERVAL_SECONDS)
+
+
+async def aging_report() -> dict:
+    """Open invoice balances per aging bucket and customer"""
+    now = datetime.utcnow()
+    rows = await db.invoices.aggregate([
+        {"$match": {"status": {"$in": ["sent", "overdue"]}, "balance": {"$gt": 0}}},
+        {
+            "$set": {
+                "days_past_due": {
+                    "$max": [0, {"$dateDiff": {"startDate": "$due_date", "endDate": now, "unit": "day"}}]
+                }
+            }
+        },
+        {
+            "$set": {
+                "bucket": AGING_BUCKET
+            }
+        },
+        # One row per customer and bucket, so no document grows with the ledger
+        {
+            "$group": {
+                "_id": {"customer_id": "$customer_id", "bucket": "$bucket"},
+                "customer_name": {"$first": "$customer_name"},
+                "balance": {"$sum": "$balance"}
+            }
+        }
+    ]).to_list(None)
+
+    totals = {label: 0.0 for label in AGING_LABELS.values()}
+    customers = {}
+    for row in rows:
+        label = AGING_LABELS[row["_id"]["bucket"]]
+        totals[label] = round(totals[label] + row["balance"], 2)
+        customer = customers.setdefault(row["_id"]["customer_id"], {
+            "customer_id": row["_id"]["customer_id"],
+            "customer_name": row["customer_name"],
+            **{name: 0.0 for name in AGING_LABELS.values()},
+            "total": 0.0
+        })
+        customer[label] = round(customer[label] + row["balance"], 2)
+        customer["total"] = round(customer["total"] + row["balance"], 2)
+
+    return {
+        "as_of": now,
+        "totals": totals,
+        "customers": sorted(customers.values(), key=lambda c: c["total"], reverse=True)
+    }
@@ -0,0 +1,118 @@
+"""
+Reference data cache
+
+Stores, warehouses, cost centers and the system settings are small and
+rarely change, so each process keeps them in memory. A collection's copy is
+tagged with the change token it was loaded under (services.change_tokens)
+and reloaded when the token moves: at once for this process's own writes,
+which bump the token, and within the token TTL for other processes. Where
+MongoDB supports change streams, a watcher drops copies as soon as any
+process writes, without waiting for the TTL.
+"""
+import asyncio
+import logging
+from datetime import datetime
+from typing import Dict, List, Optional
+from pymongo.errors import OperationFailure, PyMongoError
+
+from database import db
+from services import change_tokens
+
+logger = logging.getLogger(__name__)
+
+COLLECTIONS = ["stores", "warehouses", "cost_centers", "system_settings"]
+
+DEFAULT_SETTINGS = {
+    "company_name": "Empresa",
+    "company_email": "geral@empresa.pt",
+    "company_phone": "",
+    "company_website": "",
+    "company_address": "",
+    "base_currency": "EUR",
+    "timezone": "Europe/Lisbon"
+}
+
+# collection -> {"token": change token, "docs": {id: document}}
+_cache: Dict[str, dict] = {}
+
+
+async def _load(collection: str) -> dict:
+    # Token first: a write landing mid-load leaves the copy tagged as stale
+    token = await change_tokens.current(collection)
+    docs = await db[collection].find().to_list(None)
+    entry = {"token": token, "docs": {str(doc["_id"]): doc for doc in docs}}
+    _cache[collection] = entry
+    return entry
+
+
+async def _entry(collection: str) -> dict:
+    entry = _cache.get(collection)
+    if entry is None or entry["token"] != await change_tokens.current(collection):
+        entry = await _load(collection)
+    return entry
+
+
+async def load_all():
+    """Load every reference collection; called at startup"""
+    for collection in COLLECTIONS:
+        await _load(collection)
+
+
+def invalidate(*collections: str):
+    """Drop cached copies so the next read reloads them"""
+    for collection in collections or COLLECTIONS:
+        _cache.pop(collection, None)
+
+
+async def get_all(collection: str) -> List[dict]:
+    return list((await _entry(collection))["docs"].values())
+
+
+async def get(collection: str, document_id: Optional[str]) -> Optional[dict]:
+    if not document_id:
+        return None
+    return (await _entry(collection))["docs"].get(str(document_id))
+
+
+async def find_by(collection: str, field: str, value) -> Optional[dict]:
+    """First cached document whose `field` equals `value`"""
+    return next((doc for doc in await get_all(collection) if doc.get(field) == value), None)
+
+
+async def ensure_settings():
+    """Create the default settings document once, so reads never have to"""
+    now = datetime.utcnow()
+    result = await db.system_settings.update_one(
+        {},
+        {"$setOnInsert": {**DEFAULT_SETTINGS, "updated_at": now}},
+        upsert=True
+    )
+    if result.upserted_id:
+        await change_tokens.bump("system_settings")
+
+
+async def get_settings() -> dict:
+    """The settings document, or the defaults if it was never created"""
+    docs = await get_all("system_settings")
+    if docs:
+        return docs[0]
+    return {"_id": "default", **DEFAULT_SETTINGS, "updated_at": datetime.utcnow()}
+
+
+async def watch_changes():
+    """Drop cached copies on writes from any process, if change streams are available"""
+    pipeline = [{"$match": {"ns.coll": {"$in": COLLECTIONS}}}]
+    while True:
+        try:
+            async with db.watch(pipeline) as stream:
+                # Anything written while not watching may have been missed
+                invalidate()
+                async for change in stream:
+                    invalidate(change["ns"]["coll"])
+        except OperationFailure as e:
+            # Standalone servers have no change streams; the token TTL still applies
+            logger.info("Change streams unavailable, reference data relies on change tokens: %s", e)
+            return
+        except PyMongoError as e:
+            logger.warning("Reference data change stream interrupted: %s", e)
+            await asyncio.sleep(5)
@@ -0,0 +1,141 @@
+"""
+Time-bucketed sales rollups
+
+Approved orders are added to hourly and daily rollup documents per
+dimension (overall total, store, cost center, product and customer), so
+sales charts aggregate a few hundred buckets instead of the orders.
+Rollups are updated by an outbox subscriber to order.approved, at most
+once per order.
+"""
+from datetime import datetime
+
+from database import db
+from services.outbox import subscribe, apply_once
+from services.commissions import SOLD_STATUSES
+
+ROLLUP_COLLECTIONS = {
+    "hour": "sales_rollups_hourly",
+    "day": "sales_rollups_daily"
+}
+
+DIMENSIONS = ["total", "store", "cost_center", "product", "customer"]
+
+# Order field holding the key of each order-level dimension
+ORDER_DIMENSION_FIELDS = {
+    "store": "store_id",
+    "cost_center": "cost_center_id",
+    "customer": "customer_id"
+}
+
+
+def truncate(date: datetime, unit: str) -> datetime:
+    """Start of the hour or day containing a date"""
+    if unit == "hour":
+        return date.replace(minute=0, second=0, microsecond=0)
+    return date.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _rollup_update(bucket: datetime, dimension: str, key, revenue: float, quantity: int, name=None) -> tuple:
+    update = {
+        "$inc": {"revenue": revenue, "quantity": quantity, "order_count": 1}
+    }
+    if name is not None:
+        update["$set"] = {"name": name}
+    return {"bucket": bucket, "dimension": dimension, "key": key}, update
+
+
+def _merge_products(items: list) -> list:
+    # One update per product: an order listing a product twice would otherwise
+    # apply its second line to a bucket that already records the order
+    merged = {}
+    for item in items:
+        line = merged.setdefault(item["product_id"], {"revenue": 0, "quantity": 0, "name": item.get("product_name")})
+        line["revenue"] += item["quantity"] * (item.get("price") or 0)
+        line["quantity"] += item["quantity"]
+    return list(merged.items())
+
+
+async def record_order_sale(order: dict):
+    """Add an approved order to the hourly and daily rollups, unless it already was"""
+    quantity = sum(item["quantity"] for item in order["items"])
+
+    for unit, collection in ROLLUP_COLLECTIONS.items():
+        bucket = truncate(order["date"], unit)
+        operations = [_rollup_update(bucket, "total", None, order["total"], quantity)]
+        for dimension, field in ORDER_DIMENSION_FIELDS.items():
+            name = order.get("customer_name") if dimension == "customer" else None
+            operations.append(_rollup_update(bucket, dimension, order.get(field), order["total"], quantity, name))
+        for product_id, line in _merge_products(order["items"]):
+            operations.append(
+                _rollup_update(bucket, "product", product_id, line["revenue"], line["quantity"], line["name"])
+            )
+        await apply_once(collection, operations, str(order["_id"]))
+
+
+def _rebuild_pipeline(unit: str, dimension: str, collection: str) -> list:
+    pipeline = [{"$match": {"status": {"$in": SOLD_STATUSES}}}]
+    if dimension == "product":
+        pipeline += [
+            {"$unwind": "$items"},
+            {
+                "$set": {
+                    "_key": "$items.product_id",
+                    "_name": "$items.product_name",
+                    "_revenue": {"$multiply": ["$items.quantity", {"$ifNull": ["$items.price", 0]}]},
+                    "_quantity": "$items.quantity"
+                }
+            }
+        ]
+    else:
+        field = ORDER_DIMENSION_FIELDS.get(dimension)
+        pipeline.append({
+            "$set": {
+                "_key": f"${field}" if field else None,
+                "_name": "$customer_name" if dimension == "customer" else None,
+                "_revenue": "$total",
+                "_quantity": {"$sum": "$items.quantity"}
+            }
+        })
+    pipeline += [
+        {
+            "$group": {
+                "_id": {"bucket": {"$dateTrunc": {"date": "$date", "unit": unit}}, "key": "$_key"},
+                "name": {"$last": "$_name"},
+                "revenue": {"$sum": "$_revenue"},
+                "quantity": {"$sum": "$_quantity"},
+                "applied": {"$addToSet": {"$toString": "$_id"}}
+            }
+        },
+        {
+            "$project": {
+                "_id": 0,
+                "bucket": "$_id.bucket",
+                "dimension": dimension,
+                "key": {"$ifNull": ["$_id.key", None]},
+                "name": 1,
+                "revenue": 1,
+                "quantity": 1,
+                "order_count": {"$size": "$applied"},
+                "applied": 1
+            }
+        },
+        # The collection was emptied first, so every result is a new document
+        {"$merge": {"into": collection, "whenNotMatched": "insert"}}
+    ]
+    return pipeline
+
+
+@subscribe("order.approved", "sales_rollups")
+async def on_order_approved(event: dict):
+    await record_order_sale(event["payload"]["order"])
+
+
+async def rebuild_sales_rollups() -> dict:
+    """Recompute the hourly and daily rollups from the orders collection"""
+    counts = {}
+    for unit, collection in ROLLUP_COLLECTIONS.items():
+        await db[collection].delete_many({})
+        for dimension in DIMENSIONS:
+            await db.orders.aggregate(_rebuild_pipeline(unit, dimension, collection)).to_list(None)
+        counts[collection] = await db[collection].count_documents({})
+    return counts
@@ -0,0 +1,114 @@
+"""
+Search keys
+
+Searchable documents carry a `search_keys` array of normalized values
+(lowercase, accents stripped) maintained on write. An anchored regex on
+that multikey index serves prefix typeahead; MongoDB text indexes serve
+whole-word matches.
+"""
+import asyncio
+import re
+import unicodedata
+from typing import List, Optional
+from pymongo import UpdateOne
+
+from database import db
+
+# Portuguese collation ignoring case and accents ("joão" == "Joao")
+PT_COLLATION = {"locale": "pt", "strength": 1}
+
+# Fields indexed per collection
+SEARCH_FIELDS = {
+    "contacts": ["name", "trade_name", "nif", "email"],
+    "products": ["name", "sku"],
+    "leads": ["name", "contact", "email"]
+}
+
+TEXT_INDEX_FIELDS = {
+    "contacts": ["name", "trade_name", "email"],
+    "products": ["name", "sku", "description"],
+    "leads": ["name", "contact", "email"]
+}
+
+
+def normalize(value: Optional[str]) -> str:
+    """Lowercase and strip accents, e.g. 'Conceição' -> 'conceicao'"""
+    if not value:
+        return ""
+    decomposed = unicodedata.normalize("NFKD", str(value))
+    return "".join(c for c in decomposed if not unicodedata.combining(c)).lower().strip()
+
+
+def search_keys(collection: str, document: dict) -> List[str]:
+    """Normalized values of a document's searchable fields and of their words"""
+    keys = set()
+    for field in SEARCH_FIELDS[collection]:
+        value = normalize(document.get(field))
+        if value:
+            keys.add(value)
+            keys.update(word for word in re.split(r"[\s,.;@-]+", value) if len(word) > 1)
+    return sorted(keys)
+
+
+async def refresh_search_keys(collection: str, document_id):
+    """Recompute the search keys of a document after it was updated"""
+    fields = {field: 1 for field in SEARCH_FIELDS[collection]}
+    document = await db[collection].find_one({"_id": document_id}, fields)
+    if document:
+        await db[collection].update_one(
+            {"_id": document_id},
+            {"$set": {"search_keys": search_keys(collection, document)}}
+        )
+
+
+async def backfill_search_keys():
+    """Add search keys to documents written before they existed"""
+    for collection in SEARCH_FIELDS:
+        fields = {field: 1 for field in SEARCH_FIELDS[collection]}
+        operations = []
+        async for document in db[collection].find({"search_keys": {"$exists": False}}, fields):
+            operations.append(
+                UpdateOne({"_id": document["_id"]}, {"$set": {"search_keys": search_keys(collection, document)}})
+            )
+            if len(operations) >= 1000:
+                await db[collection].bulk_write(operations, ordered=False)
+                operations = []
+        if operations:
+            await db[collection].bulk_write(operations, ordered=False)
+
+
+async def _search_collection(collection: str, term: str, projection: dict, limit: int) -> List[dict]:
+    normalized = normalize(term)
+    prefix = {"search_keys": {"$regex": f"^{re.escape(normalized)}"}}
+    results = {}
+
+    async for document in db[collection].find(prefix, {**projection, "search_keys": 1}).limit(limit):
+        exact = normalized in document.pop("search_keys", [])
+        results[document["_id"]] = {"score": 3.0 if exact else 2.0, "document": document}
+
+    # Whole-word matches fill up what prefix matching did not find
+    if len(results) < limit:
+        text = db[collection].find(
+            {"$text": {"$search": term}},
+            {**projection, "score": {"$meta": "textScore"}}
+        ).sort([("score", {"$meta": "textScore"})]).limit(limit)
+        async for document in text:
+            score = document.pop("score")
+            results.setdefault(document["_id"], {"score": min(score, 1.9), "document": document})
+
+    return [
+        {"type": collection, "score": result["score"], "document": result["document"]}
+        for result in results.values()
+    ]
+
+
+async def search(term: str, limit: int = 10) -> List[dict]:
+    """Ranked matches across contacts, products and leads"""
+    batches = await asyncio.gather(
+        _search_collection("contacts", term, {"name": 1, "trade_name": 1, "nif": 1, "email": 1}, limit),
+        _search_collection("products", term, {"name": 1, "sku": 1, "category": 1}, limit),
+        _search_collection("leads", term, {"name": 1, "contact": 1, "email": 1, "stage": 1}, limit)
+    )
+    matches = [match for batch in batches for match in batch]
+    matches.sort(key=lambda match: match["score"], reverse=True)
+    return matches[:limit]
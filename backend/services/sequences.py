@@ -0,0 +1,41 @@
+"""
+Document number sequences
+
+Named counters in the `counters` collection hand out blocks of consecutive
+numbers with one atomic $inc, instead of scanning for the last document.
+"""
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from database import db
+
+
+async def allocate(name: str, count: int, initial_value, session=None) -> int:
+    """
+    Reserve `count` consecutive numbers and return the first one.
+    `initial_value` is an async callable giving the last number already used,
+    called once when the counter does not exist yet.
+    Inside a transaction the numbers are only consumed if it commits, so an
+    aborted transaction leaves no gap.
+    """
+    counter = await db.counters.find_one_and_update(
+        {"_id": name},
+        {"$inc": {"seq": count}},
+        return_document=ReturnDocument.AFTER,
+        session=session
+    )
+    if counter is None:
+        # Created outside the session: a duplicate key would abort the caller's
+        # transaction. A transaction that started before the counter existed
+        # then hits a write conflict below and is retried by run_transaction.
+        try:
+            await db.counters.insert_one({"_id": name, "seq": await initial_value()})
+        except DuplicateKeyError:
+            pass  # Another request created it first
+        counter = await db.counters.find_one_and_update(
+            {"_id": name},
+            {"$inc": {"seq": count}},
+            return_document=ReturnDocument.AFTER,
+            session=session
+        )
+    return counter["seq"] - count + 1
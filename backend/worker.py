@@ -0,0 +1,39 @@
+"""
+Background job worker
+
+Run from the repository root with `python -m backend.worker`. The number of
+concurrent jobs is taken from JOB_WORKERS (default 4).
+"""
+import asyncio
+import logging
+import os
+import sys
+from pathlib import Path
+
+# Modules import each other as top-level packages, like under server.py
+sys.path.insert(0, str(Path(__file__).parent))
+
+from database import client, ensure_indexes, ensure_replica_set  # noqa: E402
+from services.jobs import run_workers  # noqa: E402
+import services.job_handlers  # noqa: E402,F401 - registers job types
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+
+async def main():
+    await ensure_replica_set()
+    await ensure_indexes()
+    concurrency = int(os.environ.get("JOB_WORKERS", "4"))
+    logger.info("Starting %s job workers", concurrency)
+    try:
+        await run_workers(concurrency)
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,29 @@
+import pytest
+from fastapi import HTTPException
+
+from services.concurrency import parse_etag, version_filter
+
+
+@pytest.mark.parametrize("if_match", [None, "", "*", " * "])
+def test_version_filter_without_precondition(if_match):
+    assert version_filter(if_match) == {}
+
+
+def test_version_filter_matches_version():
+    assert version_filter('"3"') == {"version": 3}
+
+
+def test_version_filter_version_zero_matches_unversioned():
+    assert version_filter('"0"') == {"version": {"$in": [0, None]}}
+
+
+@pytest.mark.parametrize("tag", ['"3"', 'W/"3"', ' "3" '])
+def test_parse_etag(tag):
+    assert parse_etag(tag) == 3
+
+
+@pytest.mark.parametrize("tag", ['"abc"', "W/", '"3-gzip"'])
+def test_parse_etag_rejects_foreign_tags(tag):
+    with pytest.raises(HTTPException) as error:
+        parse_etag(tag)
+    assert error.value.status_code == 400
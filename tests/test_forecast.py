@@ -0,0 +1,33 @@
+from datetime import datetime
+
+from services.forecast import contribution
+
+CREATED = datetime(2026, 9, 20)
+
+
+def lead(**fields):
+    return {"assigned_to": "u1", "created_at": CREATED, **fields}
+
+
+def test_open_lead_is_weighted_by_probability():
+    key, amounts = contribution(lead(
+        stage="proposal", probability=40, expected_revenue=1000, expected_close_date=datetime(2026, 11, 5)
+    ))
+    assert key == ("u1", "2026-11")
+    assert amounts == {"lead_count": 1, "pipeline": 1000, "weighted": 400, "won": 0}
+
+
+def test_won_lead_counts_in_full():
+    _, amounts = contribution(lead(stage="won", probability=10, expected_revenue=500))
+    assert amounts == {"lead_count": 1, "pipeline": 500, "weighted": 500, "won": 500}
+
+
+def test_lead_without_close_date_uses_creation_month():
+    key, amounts = contribution(lead(stage="new"))
+    assert key == ("u1", "2026-09")
+    assert amounts["pipeline"] == 0
+    assert amounts["weighted"] == 0
+
+
+def test_lost_lead_adds_nothing():
+    assert contribution(lead(stage="lost", probability=50, expected_revenue=1000)) is None
@@ -0,0 +1,29 @@
+import hashlib
+
+import pytest
+
+from services.lead_import import dedup_key, normalize_email, normalize_phone
+
+
+@pytest.mark.parametrize("phone, expected", [
+    ("912 345 678", "+351912345678"),
+    ("+351 912-345-678", "+351912345678"),
+    ("+44 20 7946 0958", "+442079460958"),
+    ("0034 612 345 678", "+34612345678"),
+    ("(21) 234-56", "2123456"),
+])
+def test_normalize_phone(phone, expected):
+    assert normalize_phone(phone) == expected
+
+
+def test_normalize_email():
+    assert normalize_email("  Ana.Silva@Example.PT ") == "ana.silva@example.pt"
+
+
+def test_dedup_key_ignores_case_and_whitespace():
+    assert dedup_key(" Ana@Example.pt") == dedup_key("ana@example.pt")
+    assert dedup_key("ana@example.pt") == hashlib.sha1(b"ana@example.pt").hexdigest()
+
+
+def test_dedup_key_differs_per_email():
+    assert dedup_key("ana@example.pt") != dedup_key("rui@example.pt")
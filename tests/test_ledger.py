@@ -0,0 +1,11 @@
+from datetime import datetime
+
+from services.ledger import period_bounds
+
+
+def test_period_bounds():
+    assert period_bounds("2026-03") == (datetime(2026, 3, 1), datetime(2026, 4, 1))
+
+
+def test_period_bounds_december_rolls_over_year():
+    assert period_bounds("2026-12") == (datetime(2026, 12, 1), datetime(2027, 1, 1))
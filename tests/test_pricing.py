@@ -0,0 +1,80 @@
+import asyncio
+
+import pytest
+
+from services import pricing
+
+INDEX = {
+    "tiers": {
+        ("VAR-1", "normal"): {"product_id": "p1", "variant_name": "500ml", "price": 10.0, "commission_percent": 5},
+        ("VAR-1", "revenda"): {"product_id": "p1", "variant_name": "500ml", "price": 8.0, "commission_percent": 2.5},
+    },
+    "products": {
+        "p1": {"name": "Azeite", "price": 12.0},
+        "p2": {"name": "Vinagre", "price": 3.35},
+        "p3": {"name": "Sem preço", "price": None},
+    }
+}
+
+
+@pytest.fixture(autouse=True)
+def price_index(monkeypatch):
+    async def get_price_index():
+        return INDEX
+    monkeypatch.setattr(pricing, "get_price_index", get_price_index)
+
+
+def price(items):
+    return asyncio.run(pricing.price_order_items(items))
+
+
+def test_variant_uses_default_tier_and_commission():
+    priced, total, commission = price([{"product_id": "p1", "variant_id": "VAR-1", "quantity": 3, "price": 1}])
+    assert priced[0]["price"] == 10.0
+    assert priced[0]["price_tier_name"] == "normal"
+    assert priced[0]["variant_name"] == "500ml"
+    assert priced[0]["product_name"] == "Azeite"
+    assert priced[0]["commission_value"] == 1.5
+    assert (total, commission) == (30.0, 1.5)
+
+
+def test_variant_uses_requested_tier():
+    priced, total, commission = price([
+        {"product_id": "p1", "variant_id": "VAR-1", "price_tier_name": "revenda", "quantity": 2}
+    ])
+    assert priced[0]["price"] == 8.0
+    assert (total, commission) == (16.0, 0.4)
+
+
+def test_product_without_variant_has_no_commission():
+    priced, total, commission = price([{"product_id": "p2", "quantity": 3}])
+    assert priced[0]["commission_percent"] == 0
+    assert (total, commission) == (10.05, 0.0)
+
+
+def test_totals_sum_all_lines():
+    _, total, commission = price([
+        {"product_id": "p1", "variant_id": "VAR-1", "quantity": 1},
+        {"product_id": "p2", "quantity": 2}
+    ])
+    assert (total, commission) == (16.7, 0.5)
+
+
+def test_unknown_product():
+    with pytest.raises(ValueError, match="not found"):
+        price([{"product_id": "missing", "quantity": 1}])
+
+
+def test_missing_tier():
+    with pytest.raises(ValueError, match="No 'vip' price"):
+        price([{"product_id": "p1", "variant_id": "VAR-1", "price_tier_name": "vip", "quantity": 1}])
+
+
+def test_variant_of_another_product():
+    with pytest.raises(ValueError):
+        price([{"product_id": "p2", "variant_id": "VAR-1", "quantity": 1}])
+
+
+def test_product_without_price():
+    with pytest.raises(ValueError, match="has no price"):
+        price([{"product_id": "p3", "quantity": 1}])
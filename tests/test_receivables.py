@@ -0,0 +1,32 @@
+import pytest
+
+from services.receivables import AGING_BUCKET, AGING_LABELS
+
+
+def bucket(days_past_due):
+    """Evaluate AGING_BUCKET the way MongoDB's $switch does"""
+    for branch in AGING_BUCKET["$switch"]["branches"]:
+        field, upper = branch["case"]["$lt"]
+        assert field == "$days_past_due"
+        if days_past_due < upper:
+            return branch["then"]
+    return AGING_BUCKET["$switch"]["default"]
+
+
+@pytest.mark.parametrize("days, label", [
+    (0, "0-30"),
+    (30, "0-30"),
+    (31, "31-60"),
+    (60, "31-60"),
+    (61, "61-90"),
+    (90, "61-90"),
+    (91, "90+"),
+    (400, "90+"),
+])
+def test_aging_bucket_labels(days, label):
+    assert AGING_LABELS[bucket(days)] == label
+
+
+def test_every_bucket_has_a_label():
+    keys = [branch["then"] for branch in AGING_BUCKET["$switch"]["branches"]] + [AGING_BUCKET["$switch"]["default"]]
+    assert sorted(map(str, keys)) == sorted(map(str, AGING_LABELS))
@@ -0,0 +1,32 @@
+from services.search import normalize, search_keys
+
+
+def test_normalize_strips_accents_and_case():
+    assert normalize("  Conceição ") == "conceicao"
+    assert normalize("JOÃO") == "joao"
+
+
+def test_normalize_empty():
+    assert normalize(None) == ""
+    assert normalize("") == ""
+
+
+def test_search_keys_include_values_and_words():
+    keys = search_keys("contacts", {"name": "Café São João", "email": "Geral@Cafe-SJ.pt", "nif": "501234567"})
+    assert keys == sorted(keys)
+    assert "cafe sao joao" in keys
+    assert {"cafe", "sao", "joao"} <= set(keys)
+    assert "geral@cafe-sj.pt" in keys
+    assert {"geral", "sj", "pt"} <= set(keys)
+    assert "501234567" in keys
+
+
+def test_search_keys_skip_single_letters_and_unindexed_fields():
+    keys = search_keys("products", {"name": "Vinho A", "sku": "VIN-001", "description": "tinto"})
+    assert "a" not in keys
+    assert "tinto" not in keys
+    assert {"vinho a", "vinho", "vin-001", "vin", "001"} == set(keys)
+
+
+def test_search_keys_missing_fields():
+    assert search_keys("leads", {}) == []